@@ -4,13 +4,31 @@
 
 import os
 import json
+import hashlib
 import logging
+import queue
+import threading
+import time
 import traceback
-from flask import Flask, render_template, request, jsonify
-import requests
+from concurrent.futures import ThreadPoolExecutor, as_completed, TimeoutError as FutureTimeoutError
+from flask import Flask, Response, render_template, request, jsonify
 from datetime import datetime
 from lunar_python import Lunar, Solar
 
+from compression import MIN_TRAIN_SAMPLES
+from report_cache import ReportCache
+from chart_facts import FACTS_VERSION, compute_facts, format_facts
+from combined import build_combined_prompt, split_sections
+from local_report import build_local_report, is_local_report
+from prompts import REPORT_PROMPTS, SYSTEM_PROMPT, build_section_prompt, prompt_version
+from retrieval import RETRIEVAL_VERSION, format_references, get_retriever
+from singleflight import Coalescer, LeaseTable
+from jobs import JobQueue, JobRunner, QueueFullError
+from upstream import UpstreamClient
+from routing import CallCancelled, ModelRoute, ProviderRouter, SectionRoute, SectionRouter
+from resilience import CircuitBreaker, CircuitOpenError, Deadline, DeadlineExceeded, RetryBudget, UpstreamError, backoff_delay
+from limiter import AdaptiveLimiter, UpstreamBusyError, INTERACTIVE, BACKGROUND
+
 # 设置日志
 logging.basicConfig(
     level=logging.INFO,
@@ -43,6 +61,25 @@ DEEPSEEK_API_ENDPOINT = "https://api.deepseek.com/v1/chat/completions"
 DEEPSEEK_API_KEY = os.environ.get("DEEPSEEK_API_KEY", "sk-0e4af51d9cc945e785e913d3fc685fe1")
 DEEPSEEK_MODEL = "deepseek-chat"  # 使用DeepSeek模型
 
+# 上游HTTP客户端：每个worker共享一个连接池，连接保持keep-alive复用
+upstream_client = UpstreamClient(
+    pool_connections=int(os.environ.get("UPSTREAM_POOL_CONNECTIONS", 4)),
+    pool_maxsize=int(os.environ.get("UPSTREAM_POOL_MAXSIZE", 16)),
+    http2=os.environ.get("UPSTREAM_HTTP2", "0") == "1"
+)
+
+# 报告缓存配置：相同八字的报告直接从缓存返回，不再调用上游
+REPORT_CACHE_PATH = os.environ.get("REPORT_CACHE_PATH", "report_cache.db")
+report_cache = ReportCache(
+    REPORT_CACHE_PATH,
+    memory_size=int(os.environ.get("REPORT_CACHE_MEMORY_SIZE", 512)),
+    max_entries=int(os.environ.get("REPORT_CACHE_MAX_ENTRIES", 100000)),
+    ttl=int(os.environ.get("REPORT_CACHE_TTL_DAYS", 90)) * 86400,
+    compress=os.environ.get("REPORT_CACHE_COMPRESS", "1") == "1"
+)
+# 相同(八字, 部分)的并发生成合并为一次上游调用，租约表与缓存共用同一个数据库文件
+section_coalescer = Coalescer(LeaseTable(REPORT_CACHE_PATH))
+
 # 十二时辰对应表
 SHICHEN_MAP = {
     "子时": (23, 0),  # 23:00-00:59
@@ -278,89 +315,557 @@ def calculate_ten_gods(day_gan, gans, zhis):
     
     return result
 
-# 调用AI生成命理报告
-def generate_ai_report(bazi_info):
+# 报告部分并发生成的线程池大小（每个gunicorn worker内共享）
+REPORT_SECTION_WORKERS = int(os.environ.get("REPORT_SECTION_WORKERS", 3))
+section_executor = ThreadPoolExecutor(max_workers=REPORT_SECTION_WORKERS, thread_name_prefix="section")
+
+# 每个提示词附带的本地检索参考资料条数，0为不附带
+RETRIEVAL_TOP_K = int(os.environ.get("RETRIEVAL_TOP_K", 5))
+# 参考资料正文合计的最大字数，控制输入token
+RETRIEVAL_MAX_CHARS = int(os.environ.get("RETRIEVAL_MAX_CHARS", 1200))
+
+# 从本地命理资料索引中检索与命盘相关的条目，排成提示词中的参考资料段落；检索出错时不附带资料
+def chart_references(bazi):
+    if RETRIEVAL_TOP_K <= 0:
+        return ""
+    try:
+        return format_references(get_retriever().retrieve(bazi, RETRIEVAL_TOP_K, RETRIEVAL_MAX_CHARS))
+    except Exception as e:
+        logger.error(f"检索命理资料出错: {e}")
+        return ""
+
+# 是否在提示词中附带本地算出的命盘要点（五行分数、强弱、十神、格局、神煞、干支关系），
+# 模型不必自己推算，输出更短、更快
+CHART_FACTS_ENABLED = os.environ.get("CHART_FACTS", "1") == "1"
+
+# 提示词中随命盘变化的上下文：命盘要点和参考资料，接在写作要求之后、八字信息之前
+def prompt_context(bazi):
+    parts = []
+    if CHART_FACTS_ENABLED:
+        parts.append(format_facts(compute_facts(bazi)))
+    parts.append(chart_references(bazi))
+    return "\n\n".join(part for part in parts if part)
+
+# 提示词上下文的版本：命盘要点的开关和格式版本，参考资料的检索版本、条数、字数上限和语料哈希
+def context_version():
+    parts = [f"facts:{FACTS_VERSION}" if CHART_FACTS_ENABLED else "facts:off"]
+    if RETRIEVAL_TOP_K > 0:
+        parts.append(f"refs:{RETRIEVAL_VERSION}/{RETRIEVAL_TOP_K}/{RETRIEVAL_MAX_CHARS}/{get_retriever().corpus_hash}")
+    else:
+        parts.append("refs:off")
+    return ",".join(parts)
+
+# 各部分的提示词版本，报告缓存按此寻址；提示词或上下文配置改变后旧缓存即成为过期版本
+PROMPT_VERSIONS = {section: prompt_version(section, context_version()) for section in REPORT_PROMPTS}
+
+# 根据八字信息构建三个部分的提示词
+def build_report_prompts(bazi_info):
+    context = prompt_context(bazi_info['bazi'])
+    return {section: build_section_prompt(section, bazi_info['bazi'], context) for section in REPORT_PROMPTS}
+
+# 报告部分生成失败或超时时代替内容返回给用户的提示，这些提示绝不写入缓存
+SECTION_ERROR_MESSAGE = "生成{section}报告时发生错误，请稍后再试。"
+SECTION_TIMEOUT_MESSAGE = "生成{section}报告超时，请稍后再试。"
+REPORT_ERROR_MESSAGE = "生成报告时发生错误，请稍后再试。"
+
+# 内容是否为失败或超时的提示，而不是生成的报告
+def is_placeholder(section, content):
+    return content in (
+        SECTION_ERROR_MESSAGE.format(section=section),
+        SECTION_TIMEOUT_MESSAGE.format(section=section),
+        REPORT_ERROR_MESSAGE,
+        BUSY_MESSAGE
+    )
+
+# 提示词修改后，是否先返回旧版本提示词生成的缓存内容、同时在后台重新生成（stale-while-revalidate）
+STALE_WHILE_REVALIDATE = os.environ.get("STALE_WHILE_REVALIDATE", "1") == "1"
+# 过期缓存的后台重新生成每分钟最多提交多少个，所有worker合计
+STALE_REFRESH_PER_MINUTE = int(os.environ.get("STALE_REFRESH_PER_MINUTE", 20))
+# 过期缓存重新生成任务在任务队列中的客户端名
+STALE_REFRESH_CLIENT = "stale-refresh"
+
+class StaleStats(object):
+    """过期缓存的统计：返回给用户的次数（served）、提交的后台重新生成任务数（refreshes），
+    以及因已在排队或超过每分钟上限而未提交的次数（skipped）
+    """
+
+    def __init__(self):
+        self.counts = {"served": 0, "refreshes": 0, "skipped": 0}
+        self._lock = threading.Lock()
+
+    def record(self, kind):
+        with self._lock:
+            self.counts[kind] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self.counts)
+
+stale_stats = StaleStats()
+
+# 为过期缓存提交后台重新生成任务；同一部分已在排队或超过每分钟上限时跳过，下次读到时再提交
+def refresh_stale_section(bazi, section):
+    try:
+        job_id = job_queue.submit_limited(
+            {"bazi": bazi, "sections": [section]}, STALE_REFRESH_CLIENT, STALE_REFRESH_PER_MINUTE
+        )
+    except Exception as e:
+        logger.error(f"提交过期缓存的重新生成任务出错: {e}")
+        return
+    if job_id is None:
+        stale_stats.record("skipped")
+        return
+    stale_stats.record("refreshes")
+    logger.info(f"{section}报告缓存的提示词版本已过期，已提交后台重新生成任务 {job_id}: {bazi}")
+
+# 读取缓存中的报告部分，未命中返回None；依次查找该部分主路由和备用路由的模型生成的内容
+# stale_ok为真时（用户请求），当前提示词版本未命中但有旧版本的内容，先返回旧内容并提交后台重新生成
+def get_cached_section(bazi, section, stale_ok=False):
+    models = section_router.models(section)
+    for model in models:
+        content = report_cache.get(bazi, section, PROMPT_VERSIONS[section], model)
+        if content is not None:
+            return content
+    if not (stale_ok and STALE_WHILE_REVALIDATE):
+        return None
+    for model in models:
+        stale = report_cache.get_stale(bazi, section, PROMPT_VERSIONS[section], model)
+        if stale is not None:
+            stale_stats.record("served")
+            refresh_stale_section(bazi, section)
+            return stale[0]
+    return None
+
+# 写入成功生成的报告部分，按实际生成所用的模型存放；
+# 空内容、失败提示和本地简版报告不写入，重试时只需重新生成失败的部分
+def cache_section(bazi, section, content, model):
+    if not content or is_placeholder(section, content) or is_local_report(content):
+        return
+    report_cache.set(bazi, section, PROMPT_VERSIONS[section], model, content)
+
+# 报告部分的合并键：与主路由模型的缓存键一致，无论最终由哪条路由生成
+def section_key(bazi, section):
+    return ReportCache.make_key(bazi, section, PROMPT_VERSIONS[section], section_router.models(section)[0])
+
+# 调用上游生成报告部分并写入缓存，失败时抛出异常；后台生成不发对冲请求，避免额外消耗配额
+def generate_and_cache_section(bazi, section, deadline=None, priority=INTERACTIVE):
+    route = section_router.choose(section)
+    logger.info(f"调用上游服务生成{section}报告，模型路由: {route.name}")
+    report = provider_router.call(
+        build_section_prompt(section, bazi, prompt_context(bazi)), deadline,
+        priority=priority, hedge=priority == INTERACTIVE, route=route
+    )
+    cache_section(bazi, section, report, route.model)
+    return report
+
+# 生成单个报告部分，返回(报告内容, 错误)，各部分的结果与错误互不影响
+def generate_report_section(bazi, section, deadline=None, priority=INTERACTIVE):
+    cached = get_cached_section(bazi, section, stale_ok=priority == INTERACTIVE)
+    if cached is not None:
+        logger.info(f"{section}报告命中缓存: {bazi}")
+        return cached, None
+    
+    # 同一八字同一部分正在生成时，等待并共享那一次的结果；
+    # 后台生成单独合并，用户请求不会排在一个等待空闲配额的后台生成后面
+    key = section_key(bazi, section)
+    if priority != INTERACTIVE:
+        key = f"{key}:{priority}"
+    try:
+        report = section_coalescer.run(
+            key,
+            lambda: get_cached_section(bazi, section),
+            lambda: generate_and_cache_section(bazi, section, deadline, priority),
+            timeout=deadline.remaining() if deadline is not None else None
+        )
+        return report, None
+    except Exception as e:
+        logger.error(f"上游服务生成{section}报告出错: {e}")
+        return SECTION_ERROR_MESSAGE.format(section=section), e
+
+# 报告生成模式：parallel为每个部分单独调用上游、并发生成；
+# combined为一次调用生成所有未缓存的部分，命盘和写作要求只发送一次，输入token更少，但耗时接近三个部分顺序生成
+REPORT_GENERATION_MODE = os.environ.get("REPORT_GENERATION_MODE", "parallel")
+# 合并生成时单次调用的最大输出token数
+COMBINED_MAX_TOKENS = int(os.environ.get("COMBINED_MAX_TOKENS", 6000))
+
+# 合并生成所用的模型路由：各部分主路由的模型和温度都相同时返回其中一条，否则返回None（改为逐个部分生成）
+def combined_route(sections):
+    routes = [section_router.routes[section].primary for section in sections]
+    if len(set((route.model, route.temperature) for route in routes)) > 1:
+        return None
+    return routes[0]
+
+def generate_combined_sections(bazi, sections, route, deadline=None, priority=INTERACTIVE):
+    """一次上游调用生成多个报告部分，拆分后逐个写入缓存，返回拆出的部分{部分: 内容}
+
+    输出格式异常或被截断时，拆不出的部分不在返回值中，由调用方改为单独生成。
+    合并调用耗时较长，不发对冲请求，否则几乎每次都会触发、花费翻倍。
+    route为各部分共用的主路由（见combined_route），拆出的部分按其模型写入缓存，与单独生成时的缓存查找一致。
+    """
+    def lookup():
+        cached = dict((section, get_cached_section(bazi, section)) for section in sections)
+        return cached if all(content is not None for content in cached.values()) else None
+    
+    def generate():
+        logger.info(f"合并生成{', '.join(sections)}报告")
+        text = provider_router.call(
+            build_combined_prompt(REPORT_PROMPTS, bazi, sections, prompt_context(bazi)), deadline,
+            priority=priority, hedge=False, max_tokens=COMBINED_MAX_TOKENS, route=route
+        )
+        reports = split_sections(text, sections)
+        for section, content in reports.items():
+            cache_section(bazi, section, content, route.model)
+        missing = [section for section in sections if section not in reports]
+        if missing:
+            logger.warning(f"合并生成的输出中未能拆出{', '.join(missing)}，改为单独生成")
+        return reports
+    
+    key = hashlib.sha256("\x1f".join(["combined"] + [section_key(bazi, section) for section in sections]).encode('utf-8')).hexdigest()
+    if priority != INTERACTIVE:
+        key = f"{key}:{priority}"
+    return section_coalescer.run(key, lookup, generate, timeout=deadline.remaining() if deadline is not None else None)
+
+# 记录本次报告期间的上游连接复用情况（并发报告时为近似值）
+def log_connection_reuse(before):
+    after = upstream_client.snapshot()
+    if after.get("http2"):
+        return
+    requests_count = after["requests"] - before["requests"]
+    if requests_count <= 0:
+        return
+    opened = after["connections_opened"] - before["connections_opened"]
+    saved = max(requests_count - opened, 0) * after["avg_connect_ms"]
+    logger.info(f"本次报告上游请求{requests_count}次，新建连接{opened}个，连接复用约节省握手{saved:.0f}毫秒")
+
+# 上游繁忙时返回给用户的提示，以及建议客户端重试的间隔（秒），通过Retry-After响应头返回
+BUSY_MESSAGE = "当前请求较多，请稍后再试。"
+BUSY_RETRY_AFTER_SECONDS = 5
+
+# 单个报告请求的截止时间（秒），须小于gunicorn的worker超时（180秒），留出返回响应的余量
+REPORT_DEADLINE_SECONDS = float(os.environ.get("REPORT_DEADLINE_SECONDS", 170))
+
+# 后台任务（缓存预热、批量重新生成）的截止时间（秒），后台任务只用空闲配额，可以等得更久
+BACKGROUND_DEADLINE_SECONDS = float(os.environ.get("BACKGROUND_DEADLINE_SECONDS", 600))
+
+# 上游超时或熔断时，用户请求的失败部分改用本地规则生成的简版报告，而不是只返回失败提示；
+# 简版报告不写入缓存，页面上仍可重新生成AI解读。后台任务不受影响，照常记为失败
+LOCAL_FALLBACK_ENABLED = os.environ.get("LOCAL_FALLBACK", "1") == "1"
+
+class LocalReportStats(object):
+    """本地简版报告的统计：代替失败部分的次数（fallback）、即时预览次数（preview）及生成耗时"""
+
+    def __init__(self):
+        self.counts = {"fallback": 0, "preview": 0}
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, kind, seconds):
+        with self._lock:
+            self.counts[kind] += 1
+            self.total_seconds += seconds
+            self.max_seconds = max(self.max_seconds, seconds)
+
+    def snapshot(self):
+        with self._lock:
+            total = sum(self.counts.values())
+            return dict(self.counts, **{
+                "avg_ms": round(self.total_seconds / total * 1000, 3) if total else 0.0,
+                "max_ms": round(self.max_seconds * 1000, 3)
+            })
+
+local_report_stats = LocalReportStats()
+
+# 上游超时或熔断导致部分生成失败时，返回该部分的本地简版报告；其他失败或不适用时返回None
+def local_fallback(bazi, section, error, priority=INTERACTIVE):
+    if not LOCAL_FALLBACK_ENABLED or priority != INTERACTIVE:
+        return None
+    if not isinstance(error, (DeadlineExceeded, CircuitOpenError)):
+        return None
+    started = time.monotonic()
+    content = build_local_report(bazi, [section]).get(section)
+    if content is not None:
+        local_report_stats.record("fallback", time.monotonic() - started)
+        logger.warning(f"{section}报告因上游{'超时' if isinstance(error, DeadlineExceeded) else '熔断'}改用本地简版报告")
+    return content
+
+# 调用AI生成命理报告，on_section(section, content)在每个部分完成时回调
+def generate_ai_report(bazi_info, on_section=None, deadline=None, priority=INTERACTIVE, sections=None):
+    """并发生成各部分报告，deadline到期时返回已完成的部分，未完成的部分给出超时提示
+
+    priority为BACKGROUND时，上游调用只使用准入限制器窗口中的空闲部分，用户请求优先。
+    sections指定只生成其中几个部分（按需生成模式），默认生成全部。
+    用户请求中因超时或熔断失败的部分以本地简版报告代替（见local_fallback）。
+    """
+    sections = [section for section in REPORT_PROMPTS if sections is None or section in sections]
+    upstream_before = upstream_client.snapshot()
     try:
-        # 构建三个部分的提示词
-        prompts = {
-            "overview": f"""八字信息：{bazi_info['bazi']}\n你是一位八字教练，请根据以下命盘数据，撰写“命盘概览”模块，包含以下四部分：
-1. 【八字命盘展示】
-* 简洁文本方式列出年、月、日、时柱（带天干地支），并清晰标注“日主”。
-2. 【日主解读 · 我的内在之光】
-* 开篇解释“日主”概念（如：日主是你命盘中代表自我的核心能量）；
-* 分析日主五行属性、状态（得令/受制/得生等）及其在整张命盘中的互动；
-* 引出日主所象征的性格核心、行动风格和情绪表达方式；
-3. 【五行能量分布 · 我的内在气候】
-* 分析五行结构，指出偏旺/偏弱的元素；
-* 强调五行之间的互动关系（如：水火冲、木生火弱、土制水强等），并与情绪模式、身心体验或惯性反应相连结；
-4. 【反思邀请 · 我的共鸣写作】
-* 你在生活中，何时最感受到这种“日主”能量？
-* 哪种五行能量在你身上最常浮现？你如何与它相处？
-* 是否有经验让你意识到自己“失衡”了？你如何找回自己？
-请自由写下你此刻的共鸣、记忆或直觉……
-
-
-请以专业、客观的口吻撰写，避免使用过于玄学或迷信的表述，重点强调八字所反映的性格特点和潜能。
-""",
-            "ten_gods": f"""八字信息：{bazi_info['bazi']}\n你是一位具备心理学与古典命理素养的八字分析者，请针对命盘中的十神结构，撰写人格互动分析。每个十神模块包含以下结构：
-【十神名称】（如：正财、偏印等）
-1. 天赋之光 · 我如何闪耀？
-    * 分析该十神的正向特质、具体展现方式（如“正印带来安全感与包容力”）；
-2. 互动之舞 · 我与世界的关系
-    * 阐述该十神在社会关系、亲密关系或创造模式中的作用（如“偏财常见于行动导向的关系风格”）；
-3. 成长契机 · 我如何平衡？
-    * 识别该十神在命盘中处于何种状态（透出/藏干/有根/受制），点出挑战、转化方向；
-4. 反思邀请 · 与我对话
-    * 你是否认得出这种天赋？你在哪些时刻看见它？
-    * 你在互动中是否常常展现这种模式？它带来什么？
-    * 在你的人生中，它是否也曾带来困扰？你如何调和它？
-输入格式：
-* 每个十神的命盘结构描述（藏干/透干/合化等）
-""",
-            "action_guide": f"""八字信息：{bazi_info['bazi']}\n你是一位温柔而清晰的自我教练，请撰写“自我赋能与成长计划”模块，引导用户将认知转化为可落地的实践。模块结构如下：
-1. 【我的优势清单与运用策略】
-* 总结命盘中明显的优势特质（来自日主、十神、组合等）；
-* 提供如何具体运用这些特质的建议场景（如职场、人际、创作）；
-2. 【我的成长课题与应对智慧】
-* 点出用户当前命盘中可成长之处（五行失衡、过强或受克等）；
-* 给出温和可行的转化建议（身心练习、习惯建立、表达方式）；
-3. 【目标导航仪·自我书写】：
-* 简要提示命盘中的某些倾向（如偏印、比肩、食神等）可能对应的发展领域；
-* 提出 3 个开放式问题，帮助用户书写内心的答案；
-* 最后一句鼓励语，引导用户把书写变成一种仪式感的行动。
-
-
-"""
+        all_reports = {}
+        errors = {}
+        
+        # 合并模式：两个以上部分未缓存时一次调用生成，拆不出或调用失败的部分再单独生成；
+        # 各部分配置了不同的模型时无法合并，仍逐个部分生成
+        if REPORT_GENERATION_MODE == "combined":
+            missing = [
+                section for section in sections
+                if get_cached_section(bazi_info['bazi'], section, stale_ok=priority == INTERACTIVE) is None
+            ]
+            route = combined_route(missing) if len(missing) >= 2 else None
+            if route is not None:
+                try:
+                    combined = generate_combined_sections(bazi_info['bazi'], missing, route, deadline, priority)
+                except Exception as e:
+                    logger.error(f"合并生成报告出错，改为逐个部分生成: {e}")
+                    combined = {}
+                for section, report in combined.items():
+                    all_reports[section] = report
+                    if on_section is not None:
+                        on_section(section, report)
+        
+        # 其余部分并发提交到线程池，总耗时接近最慢的单个部分
+        futures = {
+            section_executor.submit(generate_report_section, bazi_info['bazi'], section, deadline, priority): section
+            for section in sections if section not in all_reports
         }
         
-        all_reports = {}
+        try:
+            for future in as_completed(futures, timeout=deadline.remaining() if deadline is not None else None):
+                section = futures[future]
+                report, error = future.result()
+                if error is not None:
+                    errors[section] = error
+                    report = local_fallback(bazi_info['bazi'], section, error, priority) or report
+                all_reports[section] = report
+                if on_section is not None:
+                    on_section(section, report)
+        except FutureTimeoutError:
+            # 仍在运行的部分会随截止时间一起结束，这里不再等待
+            for section in sections:
+                if section in all_reports:
+                    continue
+                errors[section] = DeadlineExceeded(f"{section}报告未在截止时间内完成")
+                all_reports[section] = local_fallback(bazi_info['bazi'], section, errors[section], priority) \
+                    or SECTION_TIMEOUT_MESSAGE.format(section=section)
+                if on_section is not None:
+                    on_section(section, all_reports[section])
+            logger.warning(f"报告超过{deadline.seconds:.0f}秒截止时间，返回已完成的部分")
         
-        # 由于Flowith API配额已过期，直接使用DeepSeek API
-        for section, prompt in prompts.items():
-            try:
-                logger.info(f"使用DeepSeek API生成{section}报告")
-                report = call_deepseek_api(prompt)
-            except Exception as e:
-                logger.error(f"DeepSeek API生成{section}报告出错: {e}")
-                report = f"生成{section}报告时发生错误，请稍后再试。"
-            
-            all_reports[section] = report
+        if errors:
+            logger.warning(f"部分报告生成失败: {', '.join(errors)}")
+        log_connection_reuse(upstream_before)
+        
+        # 所有部分都因上游繁忙未能发出时，交由调用方快速返回"繁忙"
+        if errors and len(errors) == len(sections) and all(isinstance(e, UpstreamBusyError) for e in errors.values()):
+            raise next(iter(errors.values()))
             
-        return all_reports
+        return {section: all_reports[section] for section in sections}
+    except UpstreamBusyError:
+        raise
     except Exception as e:
         logger.error(f"生成AI报告出错: {e}")
-        return {
-            "overview": "生成报告时发生错误，请稍后再试。",
-            "ten_gods": "生成报告时发生错误，请稍后再试。",
-            "action_guide": "生成报告时发生错误，请稍后再试。"
-        }
+        return {section: REPORT_ERROR_MESSAGE for section in sections}
+
+# 上游调用的重试与熔断配置
+UPSTREAM_MAX_ATTEMPTS = int(os.environ.get("UPSTREAM_MAX_ATTEMPTS", 3))
+# 可以重试的状态码：限流和服务端错误
+RETRYABLE_STATUS = (429, 500, 502, 503, 504)
+# 全局重试预算：重试次数不超过上游请求量的一定比例
+retry_budget = RetryBudget(ratio=float(os.environ.get("RETRY_BUDGET_RATIO", 0.2)))
+# 每个上游服务一个熔断器
+circuit_breakers = {
+    name: CircuitBreaker(
+        name,
+        failure_threshold=int(os.environ.get("BREAKER_FAILURE_THRESHOLD", 5)),
+        reset_timeout=float(os.environ.get("BREAKER_RESET_SECONDS", 30))
+    )
+    for name in ("deepseek", "flowith")
+}
+# 每个上游服务一个准入限制器，状态在SQLite中由所有worker共享
+LIMITER_DB_PATH = os.environ.get("LIMITER_DB_PATH", "limiter.db")
+upstream_limiters = {
+    name: AdaptiveLimiter(
+        name,
+        LIMITER_DB_PATH,
+        rate=float(os.environ.get("LIMITER_RATE", 5)),
+        burst=float(os.environ.get("LIMITER_BURST", 10)),
+        initial_window=int(os.environ.get("LIMITER_INITIAL_WINDOW", 8)),
+        max_window=int(os.environ.get("LIMITER_MAX_WINDOW", 32)),
+        latency_target=float(os.environ.get("LIMITER_LATENCY_TARGET", 20)),
+        max_waiters=int(os.environ.get("LIMITER_MAX_WAITERS", 32)),
+        max_wait=float(os.environ.get("LIMITER_MAX_WAIT", 10)),
+        background_reserve=float(os.environ.get("LIMITER_BACKGROUND_RESERVE", 0.25)),
+        background_max_wait=float(os.environ.get("LIMITER_BACKGROUND_MAX_WAIT", 60))
+    )
+    for name in ("deepseek", "flowith")
+}
+
+# 建立上游连接的超时时间（秒）
+UPSTREAM_CONNECT_TIMEOUT = float(os.environ.get("UPSTREAM_CONNECT_TIMEOUT", 10))
+# 剩余时间不足该值时不再发起新的上游尝试，一次生成通常至少需要这么久
+MIN_ATTEMPT_SECONDS = float(os.environ.get("MIN_ATTEMPT_SECONDS", 5))
+
+# 按截止时间的剩余时间计算本次尝试的(连接超时, 读取超时)，不够一次尝试时抛出DeadlineExceeded
+def attempt_timeout(deadline, read_timeout):
+    if deadline is None:
+        return (UPSTREAM_CONNECT_TIMEOUT, read_timeout)
+    remaining = deadline.remaining()
+    if remaining < MIN_ATTEMPT_SECONDS:
+        raise DeadlineExceeded(f"距截止时间仅剩{remaining:.1f}秒，不再发起上游调用")
+    return (min(UPSTREAM_CONNECT_TIMEOUT, remaining), min(read_timeout, remaining))
+
+# 等待调用许可的最长时间：拿到许可后还要留出一次尝试所需的时间
+def permit_wait(deadline):
+    if deadline is None:
+        return None
+    return deadline.remaining() - MIN_ATTEMPT_SECONDS
+
+# 截止时间内是否还来得及等待delay秒后再试一次
+def can_retry_before(deadline, delay):
+    return deadline is None or deadline.remaining() - delay >= MIN_ATTEMPT_SECONDS
+
+# 登记上游响应：状态码为200时上报首字节，并在调用被取消时关闭连接
+def track_response(ctx, response):
+    if ctx is None:
+        return
+    ctx.attach(response)
+    if response.status_code == 200:
+        ctx.mark_first_byte()
+
+# 重试前等待；调用已被取消时立即结束，不再重试
+def retry_wait(ctx, seconds):
+    if ctx is None:
+        time.sleep(seconds)
+        return
+    if ctx.cancel_event.wait(seconds):
+        raise CallCancelled("调用已被取消")
+
+def request_upstream(provider, url, headers, payload, timeout, read, ctx=None):
+    """向上游发送请求并用read(response)解析结果，失败时抛出UpstreamError
+
+    每次尝试前先取得该服务的调用许可，上游繁忙且等待超出预算时抛出UpstreamBusyError；
+    再经过熔断器，熔断中立即抛出CircuitOpenError；
+    限流、服务端错误、超时和连接中断在重试预算允许时带随机抖动退避后重试。
+    ctx带有截止时间时，连接/读取超时取timeout与剩余时间的较小值，
+    剩余时间不够再试一次时直接放弃重试。
+    """
+    breaker = circuit_breakers[provider]
+    deadline = ctx.deadline if ctx is not None else None
+    priority = ctx.priority if ctx is not None and ctx.priority else INTERACTIVE
+    retry_budget.record_request()
+    
+    for attempt in range(UPSTREAM_MAX_ATTEMPTS):
+        attempt_timeouts = attempt_timeout(deadline, timeout)
+        with upstream_limiters[provider].acquire(permit_wait(deadline), priority) as permit:
+            breaker.allow()
+            try:
+                response = upstream_client.post(url, headers=headers, json=payload, timeout=attempt_timeouts, stream=True)
+                permit.responded()
+                try:
+                    track_response(ctx, response)
+                    logger.info(f"{provider}状态码: {response.status_code}")
+                    if response.status_code != 200:
+                        if response.status_code == 429:
+                            permit.throttled()
+                        raise UpstreamError(
+                            f"{provider}调用失败: {response.status_code} - {response.text[:200]}",
+                            retryable=response.status_code in RETRYABLE_STATUS
+                        )
+                    result = read(response)
+                finally:
+                    response.close()
+                permit.succeeded()
+                breaker.record_success()
+                return result
+            except CallCancelled:
+                breaker.release()
+                raise
+            except UpstreamError as e:
+                error = e
+            except Exception as e:
+                # 超时、连接错误、响应读取中断等网络问题
+                error = UpstreamError(f"{provider}调用出错: {e}", retryable=True)
+        
+        if ctx is not None and ctx.cancelled:
+            breaker.release()
+            raise CallCancelled("调用已被取消")
+        if deadline is not None and deadline.expired():
+            # 被截短的超时不代表上游故障，不计入熔断
+            breaker.release()
+            raise DeadlineExceeded(f"{provider}调用未在截止时间内完成: {error}")
+        breaker.record_failure()
+        logger.error(f"调用{provider}失败 (尝试 {attempt+1}/{UPSTREAM_MAX_ATTEMPTS}): {error}")
+        
+        if not error.retryable or attempt >= UPSTREAM_MAX_ATTEMPTS - 1:
+            raise error
+        delay = backoff_delay(attempt)
+        if not can_retry_before(deadline, delay):
+            logger.warning(f"距截止时间仅剩{deadline.remaining():.1f}秒，{provider}不再重试")
+            raise error
+        if not retry_budget.try_retry():
+            logger.warning(f"重试预算已用完，{provider}不再重试")
+            raise error
+        retry_wait(ctx, delay)
+
+class TokenUsage(object):
+    """各上游服务累计的token用量，取自响应中的usage字段（仅反映当前worker进程）
+
+    DeepSeek在usage中给出输入里命中/未命中上下文缓存的token数，据此统计前缀缓存的命中率。
+    """
+
+    def __init__(self):
+        self.usage = {}
+        self._lock = threading.Lock()
+
+    def record(self, provider, usage):
+        with self._lock:
+            totals = self.usage.setdefault(provider, {
+                "calls": 0, "calls_without_usage": 0, "prompt_tokens": 0, "completion_tokens": 0,
+                "prompt_cache_hit_tokens": 0, "prompt_cache_miss_tokens": 0
+            })
+            totals["calls"] += 1
+            if not isinstance(usage, dict):
+                totals["calls_without_usage"] += 1
+                return
+            for field in ("prompt_tokens", "completion_tokens", "prompt_cache_hit_tokens", "prompt_cache_miss_tokens"):
+                totals[field] += usage.get(field) or 0
+        if "prompt_cache_hit_tokens" in usage:
+            logger.info(f"{provider}用量: 输入{usage.get('prompt_tokens')}个token（缓存命中{usage.get('prompt_cache_hit_tokens')}个），"
+                        f"输出{usage.get('completion_tokens')}个token")
+
+    def snapshot(self):
+        with self._lock:
+            result = {}
+            for provider, totals in self.usage.items():
+                result[provider] = dict(totals)
+                cached = totals["prompt_cache_hit_tokens"] + totals["prompt_cache_miss_tokens"]
+                result[provider]["prompt_cache_hit_ratio"] = round(totals["prompt_cache_hit_tokens"] / float(cached), 3) if cached else None
+            return result
+
+token_usage = TokenUsage()
+
+# 从OpenAI格式或其他格式的响应中提取报告正文，提取不到时抛出UpstreamError
+def extract_message_content(result, provider):
+    if isinstance(result, dict):
+        choices = result.get('choices')
+        if choices and 'message' in choices[0]:
+            return choices[0]['message']['content']
+        if isinstance(result.get('content'), str):
+            return result['content']
+        # 如果响应格式异常，但有数据，尝试提取可能的内容
+        for key, value in result.items():
+            if 'content' in key.lower() and isinstance(value, str):
+                return value
+    logger.warning(f"{provider}响应格式异常: {json.dumps(result, ensure_ascii=False)[:500]}")
+    raise UpstreamError(f"{provider}响应格式异常")
 
 # 调用Flowith API
-def call_flowith_api(prompt):
-    """调用Flowith API生成命理分析报告，带有重试机制和超时设置"""
-    max_retries = 3  # 最大重试次数
-    retry_delay = 2  # 重试间隔（秒）
-    timeout = 120    # 请求超时时间（秒）
+def call_flowith_api(prompt, ctx=None):
+    """调用Flowith API生成命理分析报告，失败时抛出UpstreamError
+
+    ctx为routing.CallContext时，拿到响应头即上报首字节，并可被对冲请求取消；
+    与DeepSeek一样按ctx中的模型路由和最大输出token数请求，对冲或改用Flowith时生成的仍是同一模型的内容。
+    """
+    timeout = 120 * output_scale(ctx)    # 读取超时时间（秒），按输出长度放宽，有截止时间时取两者较小值
     
     headers = {
         "Content-Type": "application/json",
@@ -370,228 +875,287 @@ def call_flowith_api(prompt):
     }
     
     # 根据Flowith API官方文档构建请求体
+    route = ctx.route if ctx is not None else None
     payload = {
         "messages": [
-            {"role": "system", "content": "请调用八字知识库内的知识。用细腻的文笔代入具体的场景，引发共鸣与思考。"},
+            {"role": "system", "content": SYSTEM_PROMPT},
             {"role": "user", "content": prompt}
         ],
-        "model": "deepseek-chat",
-        "stream": False,
-        "kb_list": ["0ce99dca-a06e-404b-b4f0-38c53198b38a"] 
+        "model": route.model if route is not None else DEEPSEEK_MODEL,
+        "temperature": route.temperature if route is not None else DEEPSEEK_TEMPERATURE,
+        "max_tokens": call_max_tokens(ctx),
+        "stream": False
     }
     
-    logger.info(f"调用Flowith API，请求数据: {json.dumps(payload, ensure_ascii=False)[:200]}...")
+    logger.info(f"调用Flowith API，{request_summary(payload, prompt)}...")
     
-    # 实现重试机制
-    for attempt in range(max_retries):
-        try:
-            # 发送请求，并指定超时时间
-            response = requests.post(
-                FLOWITH_ENDPOINT, 
-                headers=headers, 
-                json=payload,
-                timeout=timeout  # 设置请求超时时间
-            )
-            
-            if response.status_code == 200:
-                result = response.json()
-                logger.info(f"Flowith API响应成功: {json.dumps(result, ensure_ascii=False)[:200]}...")
-                
-                # Flowith API响应格式处理
-                if 'content' in result:
-                    return result['content']
-                elif 'choices' in result and len(result['choices']) > 0 and 'message' in result['choices'][0]:
-                    # 兼容OpenAI格式
-                    return result['choices'][0]['message']['content']
-                else:
-                    logger.warning(f"Flowith API响应格式异常: {json.dumps(result, ensure_ascii=False)}")
-                    # 如果响应格式异常，但有数据，尝试提取可能的内容
-                    if isinstance(result, dict) and any(key for key in result.keys() if 'content' in key.lower()):
-                        for key, value in result.items():
-                            if 'content' in key.lower() and isinstance(value, str):
-                                return value
-                    # 如果完全无法提取，返回错误信息
-                    return "生成报告时出现问题，响应格式异常。请稍后再试。"
-            else:
-                # 如果响应状态码不是200，记录错误并准备重试
-                error_msg = f"Flowith API调用失败 (尝试 {attempt+1}/{max_retries}): {response.status_code} - {response.text}"
-                logger.error(error_msg)
-                
-                # 如果不是最后一次尝试，等待后重试
-                if attempt < max_retries - 1:
-                    import time
-                    time.sleep(retry_delay * (attempt + 1))  # 每次重试的等待时间逐次增加
-                    continue
-                else:
-                    # 如果所有重试都失败，返回错误信息
-                    return f"抱歉，生成报告时出现问题(错误代码:{response.status_code})，请稍后再试。"
-                
-        except requests.exceptions.Timeout as e:
-            # 超时异常处理
-            logger.error(f"调用Flowith API超时 (尝试 {attempt+1}/{max_retries}): {e}")
-            if attempt < max_retries - 1:
-                import time
-                time.sleep(retry_delay * (attempt + 1))
-                continue
-            else:
-                return "抱歉，生成报告时连接超时，请稍后再试。"
-        
-        except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError) as e:
-            # 连接错误或块编码错误处理
-            logger.error(f"调用Flowith API连接错误 (尝试 {attempt+1}/{max_retries}): {e}")
-            if attempt < max_retries - 1:
-                import time
-                time.sleep(retry_delay * (attempt + 1))
-                continue
-            else:
-                return "抱歉，生成报告时网络连接出错，请稍后再试。"
-                
-        except Exception as e:
-            # 其他异常处理
-            logger.error(f"调用Flowith API未预期错误 (尝试 {attempt+1}/{max_retries}): {e}")
-            if attempt < max_retries - 1:
-                import time
-                time.sleep(retry_delay * (attempt + 1))
-                continue
-            else:
-                return f"抱歉，连接AI服务时出现问题: {str(e)[:100]}...，请稍后再试。"
-
-def call_deepseek_api(prompt):
-    """调用DeepSeek官方API生成命理分析报告"""
-    max_retries = 3  # 最大重试次数
-    retry_delay = 2  # 重试间隔（秒）
-    timeout = 90     # 增加超时时间至90秒，给API足够响应时间
+    def read(response):
+        result = response.json()
+        logger.info(f"Flowith API响应成功: {json.dumps(result, ensure_ascii=False)[:200]}...")
+        token_usage.record("flowith", result.get('usage') if isinstance(result, dict) else None)
+        return extract_message_content(result, "Flowith")
     
-    headers = {
+    return request_upstream("flowith", FLOWITH_ENDPOINT, headers, payload, timeout, read, ctx)
+
+# 构建DeepSeek API请求头
+def build_deepseek_headers():
+    return {
         "Content-Type": "application/json",
         "Authorization": f"Bearer {DEEPSEEK_API_KEY}"
     }
-    
-    # 构建请求体
+
+# 单个报告部分的最大输出token数
+DEEPSEEK_MAX_TOKENS = 2000
+
+# 默认的生成温度，未配置模型路由时使用
+DEEPSEEK_TEMPERATURE = 0.7
+
+# 本次调用的最大输出token数：合并生成指定的值 > 模型路由的配置 > 默认值
+def call_max_tokens(ctx):
+    if ctx is not None and ctx.max_tokens:
+        return ctx.max_tokens
+    if ctx is not None and ctx.route is not None:
+        return ctx.route.max_tokens
+    return DEEPSEEK_MAX_TOKENS
+
+# 本次调用的输出长度相对单个报告部分的倍数，读取超时按此放宽
+def output_scale(ctx):
+    return max(1.0, call_max_tokens(ctx) / float(DEEPSEEK_MAX_TOKENS))
+
+# 构建DeepSeek API请求体，stream=True时请求上游逐token返回；route为ModelRoute时使用其模型和参数
+def build_deepseek_payload(prompt, stream=False, max_tokens=None, route=None):
     payload = {
-        "model": DEEPSEEK_MODEL,
+        "model": route.model if route is not None else DEEPSEEK_MODEL,
         "messages": [
-            {"role": "system", "content": "请调用八字知识库内的知识，并会从来访者角度出发。用细腻的文笔代入具体的场景，引发共鸣与思考。"},
+            {"role": "system", "content": SYSTEM_PROMPT},
             {"role": "user", "content": prompt}
         ],
-        "temperature": 0.7,
-        "max_tokens": 2000,
-        "stream": False,
+        "temperature": route.temperature if route is not None else DEEPSEEK_TEMPERATURE,
+        "max_tokens": max_tokens or (route.max_tokens if route is not None else DEEPSEEK_MAX_TOKENS),
+        "stream": stream,
         "presence_penalty": 0.0,
         "frequency_penalty": 0.0
     }
+    if stream:
+        # 流式响应默认不带用量，要求上游在最后一个数据块中返回
+        payload["stream_options"] = {"include_usage": True}
+    return payload
+
+# 读取响应时输出进度日志的最小间隔（秒）
+PROGRESS_LOG_INTERVAL = 5.0
+# 读取响应体的块大小
+RESPONSE_CHUNK_SIZE = 16 * 1024
+
+def read_response_body(response, deadline=None):
+    """把流式响应体读入同一个bytearray并返回，读取中断时抛出异常
+
+    各块直接追加到bytearray（按需扩容，不为每块新建字符串），也不逐块解码：
+    json.loads直接接受UTF-8字节，解析时一次解码，跨块边界的多字节汉字也不会被截断成乱码。
+    进度日志按时间间隔输出。读取超时只限制单次等待，数据缓慢到达时由deadline限制总的读取时间。
+    """
+    body = bytearray()
+    chunk_count = 0
+    started = last_log = time.monotonic()
     
-    logger.info(f"调用DeepSeek API，请求数据: {json.dumps(payload, ensure_ascii=False)[:200]}...")
+    for chunk in response.iter_content(chunk_size=RESPONSE_CHUNK_SIZE):
+        if not chunk:
+            continue
+        if deadline is not None:
+            deadline.check()
+        body += chunk
+        chunk_count += 1
+        
+        now = time.monotonic()
+        if now - last_log >= PROGRESS_LOG_INTERVAL:
+            last_log = now
+            logger.info(f"正在读取数据: 已接收{chunk_count}个块，共{len(body)}字节，用时{now - started:.1f}秒")
     
-    # 实现重试机制
-    for attempt in range(max_retries):
-        try:
-            # 使用流式请求和分块传输，降低内存占用和超时风险
-            logger.info(f"开始调用DeepSeek API，超时设置为{timeout}秒")
-            response = requests.post(
-                DEEPSEEK_API_ENDPOINT, 
-                headers=headers, 
-                json=payload,
-                timeout=timeout,
-                stream=True  # 启用流式传输
-            )
-            
-            # 立即检查状态码
-            logger.info(f"DeepSeek API状态码: {response.status_code}")
-            
-            if response.status_code == 200:
-                # 分块读取响应内容，并定期输出进度信息
-                logger.info("开始分块读取响应内容...")
-                content = ""
-                chunk_count = 0
-                total_bytes = 0
+    logger.info(f"完成响应内容读取，总共接收{len(body)}字节数据")
+    return body
+
+# 日志中的请求摘要：模型和提示词开头，不为截取前200字而把整个请求体序列化一遍
+def request_summary(payload, prompt):
+    return f"模型{payload['model']}，提示词{len(prompt)}字: {prompt[:100]}"
+
+def call_deepseek_api(prompt, ctx=None):
+    """调用DeepSeek官方API生成命理分析报告，失败时抛出UpstreamError
+
+    ctx为routing.CallContext时，拿到响应头即上报首字节，并可被对冲请求取消。
+    """
+    timeout = 90 * output_scale(ctx)     # 读取超时90秒，按输出长度放宽；有截止时间时取两者较小值
+    
+    headers = build_deepseek_headers()
+    
+    # 构建请求体
+    payload = build_deepseek_payload(prompt, max_tokens=call_max_tokens(ctx), route=ctx.route if ctx is not None else None)
+    
+    logger.info(f"调用DeepSeek API，{request_summary(payload, prompt)}...")
+    
+    def read(response):
+        # 响应体读入一个bytearray，直接按UTF-8字节解析，不另外生成一份文本
+        result = json.loads(read_response_body(response, ctx.deadline if ctx is not None else None))
+        
+        token_usage.record("deepseek", result.get('usage') if isinstance(result, dict) else None)
+        content = extract_message_content(result, f"DeepSeek {payload['model']}模型")
+        logger.info(f"DeepSeek API响应成功: {content[:200]}...")
+        return content
+    
+    return request_upstream("deepseek", DEEPSEEK_API_ENDPOINT, headers, payload, timeout, read, ctx)
+
+def stream_deepseek_api(prompt, cancel_event=None, deadline=None, route=None, priority=INTERACTIVE):
+    """以流式方式调用DeepSeek API，逐段产出模型生成的文本增量
+
+    只在尚未产出任何内容时重试；一旦开始向调用方输出，中途失败直接抛出异常。
+    cancel_event被设置时（例如浏览器断开连接）停止读取并关闭上游连接；
+    deadline到期时停止读取并抛出DeadlineExceeded。route为ModelRoute时使用其模型和参数。
+    流式输出无法在两个上游之间对冲，固定调用DeepSeek。
+    """
+    timeout = 90     # 等待上游首个数据的超时时间（秒）
+    breaker = circuit_breakers["deepseek"]
+    
+    headers = build_deepseek_headers()
+    payload = build_deepseek_payload(prompt, stream=True, route=route)
+    
+    logger.info(f"流式调用DeepSeek API，{request_summary(payload, prompt)}...")
+    retry_budget.record_request()
+    
+    for attempt in range(UPSTREAM_MAX_ATTEMPTS):
+        attempt_timeouts = attempt_timeout(deadline, timeout)
+        emitted = False
+        with upstream_limiters["deepseek"].acquire(permit_wait(deadline), priority) as permit:
+            breaker.allow()
+            try:
+                response = upstream_client.post(
+                    DEEPSEEK_API_ENDPOINT,
+                    headers=headers,
+                    json=payload,
+                    timeout=attempt_timeouts,
+                    stream=True
+                )
+                permit.responded()
                 
                 try:
-                    # 设置更小的块大小和进度报告
-                    for chunk in response.iter_content(chunk_size=512):
-                        if chunk:
-                            chunk_text = chunk.decode('utf-8', errors='replace')  # 使用错误替换模式避免解码错误
-                            content += chunk_text
-                            chunk_count += 1
-                            total_bytes += len(chunk)
-                            
-                            # 每接收几个块输出一次进度信息
-                            if chunk_count % 5 == 0:
-                                logger.info(f"正在读取数据: 已接收{chunk_count}个块，共{total_bytes}字节")
-                except Exception as read_err:
-                    # 捕获并记录读取过程中的错误
-                    logger.error(f"读取响应内容时出错: {read_err}")
-                    # 如果已经读取了一些内容，尝试继续JSON解析
-                    if len(content) < 10:  # 如果内容太少，无法解析
-                        raise Exception(f"响应内容读取失败，只收到{len(content)}字节数据")
-                
-                logger.info(f"完成响应内容读取，总共接收{total_bytes}字节数据")
-                
-                # 解析JSON结果
-                logger.info(f"已成功读取响应内容，大小: {len(content)}字节")
-                result = json.loads(content)
-                logger.info(f"DeepSeek API响应成功: {json.dumps(result, ensure_ascii=False)[:200]}...")
-                
-                # DeepSeek API响应格式处理
-                if 'choices' in result and len(result['choices']) > 0 and 'message' in result['choices'][0]:
-                    # DeepSeek API使用OpenAI格式的响应
-                    return result['choices'][0]['message']['content']
-                else:
-                    logger.warning(f"DeepSeek {DEEPSEEK_MODEL}模型响应格式异常: {json.dumps(result, ensure_ascii=False)}")
-                    # 如果响应格式异常，但有数据，尝试提取可能的内容
-                    if isinstance(result, dict) and any(key for key in result.keys() if 'content' in key.lower()):
-                        for key, value in result.items():
-                            if 'content' in key.lower() and isinstance(value, str):
-                                return value
-                    # 如果完全无法提取，返回错误信息
-                    return "生成报告时出现问题，响应格式异常。请稍后再试。"
-            else:
-                # 如果响应状态码不是200，记录错误并准备重试
-                error_msg = f"DeepSeek {DEEPSEEK_MODEL}模型调用失败 (尝试 {attempt+1}/{max_retries}): {response.status_code} - {response.text}"
-                logger.error(error_msg)
-                
-                # 如果不是最后一次尝试，等待后重试
-                if attempt < max_retries - 1:
-                    import time
-                    time.sleep(retry_delay * (attempt + 1))  # 每次重试的等待时间逐次增加
-                    continue
-                else:
-                    # 如果所有重试都失败，返回错误信息
-                    return f"抱歉，生成报告时出现问题(错误代码:{response.status_code})，请稍后再试。"
-                
-        except requests.exceptions.Timeout as e:
-            # 超时异常处理
-            logger.error(f"调用DeepSeek {DEEPSEEK_MODEL}模型超时 (尝试 {attempt+1}/{max_retries}): {e}")
-            if attempt < max_retries - 1:
-                import time
-                time.sleep(retry_delay * (attempt + 1))
-                continue
-            else:
-                return "抱歉，生成报告时连接超时，请稍后再试。"
-        
-        except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError) as e:
-            # 连接错误或块编码错误处理
-            logger.error(f"调用DeepSeek {DEEPSEEK_MODEL}模型连接错误 (尝试 {attempt+1}/{max_retries}): {e}")
-            if attempt < max_retries - 1:
-                import time
-                time.sleep(retry_delay * (attempt + 1))
-                continue
-            else:
-                return "抱歉，生成报告时网络连接出错，请稍后再试。"
-                
-        except Exception as e:
-            # 其他异常处理
-            logger.error(f"调用DeepSeek {DEEPSEEK_MODEL}模型未预期错误 (尝试 {attempt+1}/{max_retries}): {e}")
-            if attempt < max_retries - 1:
-                import time
-                time.sleep(retry_delay * (attempt + 1))
-                continue
-            else:
-                return f"抱歉，连接DeepSeek {DEEPSEEK_MODEL}模型时出现问题: {str(e)[:100]}...，请稍后再试。"
-    
+                    if response.status_code != 200:
+                        if response.status_code == 429:
+                            permit.throttled()
+                        raise UpstreamError(
+                            f"DeepSeek {payload['model']}模型流式调用失败: {response.status_code} - {response.text[:200]}",
+                            retryable=response.status_code in RETRYABLE_STATUS
+                        )
+                    # 上游按SSE格式返回：每行 "data: {...}"，以 "data: [DONE]" 结束；用量在最后一个数据块中
+                    usage = None
+                    for line in response.iter_lines(decode_unicode=False):
+                        if cancel_event is not None and cancel_event.is_set():
+                            logger.info("客户端已断开，停止读取DeepSeek流式响应")
+                            breaker.release()
+                            return
+                        if deadline is not None:
+                            deadline.check()
+                        if not line or not line.startswith(b"data:"):
+                            continue
+                        data = line[5:].strip()
+                        if data == b"[DONE]":
+                            break
+                        chunk = json.loads(data)
+                        usage = chunk.get('usage') or usage
+                        choices = chunk.get('choices') or []
+                        if not choices:
+                            continue
+                        text = (choices[0].get('delta') or {}).get('content')
+                        if text:
+                            emitted = True
+                            yield text
+                    token_usage.record("deepseek", usage)
+                    permit.succeeded()
+                    breaker.record_success()
+                    return
+                finally:
+                    response.close()
+            except UpstreamError as e:
+                error = e
+            except Exception as e:
+                error = UpstreamError(f"DeepSeek {payload['model']}模型流式调用出错: {e}", retryable=True)
+        
+        if deadline is not None and deadline.expired():
+            # 被截短的超时不代表上游故障，不计入熔断
+            breaker.release()
+            raise DeadlineExceeded(f"DeepSeek流式调用未在截止时间内完成: {error}")
+        breaker.record_failure()
+        logger.error(f"流式调用DeepSeek {payload['model']}模型出错 (尝试 {attempt+1}/{UPSTREAM_MAX_ATTEMPTS}): {error}")
+        if emitted or not error.retryable or attempt >= UPSTREAM_MAX_ATTEMPTS - 1:
+            raise error
+        delay = backoff_delay(attempt)
+        if not can_retry_before(deadline, delay):
+            logger.warning(f"距截止时间仅剩{deadline.remaining():.1f}秒，DeepSeek流式调用不再重试")
+            raise error
+        if not retry_budget.try_retry():
+            logger.warning("重试预算已用完，DeepSeek流式调用不再重试")
+            raise error
+        time.sleep(delay)
 
+# 上游服务：成功返回报告文本，失败抛出异常，供路由器统计错误率并切换服务
+PROVIDERS = {
+    "deepseek": call_deepseek_api,
+    "flowith": call_flowith_api
+}
 
+# 参与路由的上游服务，排在前面的为默认主服务；默认只用DeepSeek、不发对冲请求，
+# 设为"deepseek,flowith"时启用Flowith作为备用服务和对冲目标
+UPSTREAM_PROVIDERS = [name.strip() for name in os.environ.get("UPSTREAM_PROVIDERS", "deepseek").split(",") if name.strip()]
+provider_router = ProviderRouter(
+    dict((name, PROVIDERS[name]) for name in UPSTREAM_PROVIDERS),
+    # 熔断中的服务排到最后，也不作为对冲目标
+    available=lambda name: circuit_breakers[name].available(),
+    # 本地限流和截止时间到期不是上游服务的问题，不计入其错误率
+    neutral_errors=(UpstreamBusyError, DeadlineExceeded),
+    hedge_percentile=float(os.environ.get("HEDGE_PERCENTILE", 0.9)),
+    default_hedge_delay=float(os.environ.get("HEDGE_DEFAULT_DELAY", 20))
+)
+
+def load_section_routes(config):
+    """解析各报告部分的模型路由配置，未配置的部分使用默认模型和参数
 
+    config形如 {"ten_gods": {"model": ..., "max_tokens": ..., "temperature": ...,
+    "slo_seconds": 总耗时SLO, "ttft_slo_seconds": 首字节SLO, "fallback": {"model": ..., "max_tokens": ...}}}，
+    备用路由中未给出的参数沿用主路由的值。
+    """
+    unknown = set(config) - set(REPORT_PROMPTS)
+    if unknown:
+        raise ValueError(f"模型路由配置中有未知的报告部分: {', '.join(sorted(unknown))}")
+    
+    def make_route(name, values, base):
+        return ModelRoute(
+            name,
+            values.get("model", base.model),
+            int(values.get("max_tokens", base.max_tokens)),
+            float(values.get("temperature", base.temperature))
+        )
+    
+    default = ModelRoute("default", DEEPSEEK_MODEL, DEEPSEEK_MAX_TOKENS, DEEPSEEK_TEMPERATURE)
+    routes = {}
+    for section in REPORT_PROMPTS:
+        entry = config.get(section, {})
+        primary = make_route(f"{section}/primary", entry, default)
+        fallback = make_route(f"{section}/fallback", entry["fallback"], primary) if entry.get("fallback") else None
+        routes[section] = SectionRoute(primary, fallback, entry.get("slo_seconds"), entry.get("ttft_slo_seconds"))
+    return routes
+
+# 模型路由配置：JSON字符串，或JSON文件的路径
+def read_section_routes_config(value):
+    if not value:
+        return {}
+    if value.lstrip().startswith("{"):
+        return json.loads(value)
+    with open(value, encoding='utf-8') as f:
+        return json.load(f)
+
+# 各报告部分的模型路由：主路由持续超出延迟SLO时，改由备用路由（更快或更小的模型）生成
+section_router = SectionRouter(
+    load_section_routes(read_section_routes_config(os.environ.get("SECTION_ROUTES", ""))),
+    provider_router,
+    slo_percentile=float(os.environ.get("ROUTE_SLO_PERCENTILE", 0.9)),
+    probe_every=int(os.environ.get("ROUTE_PROBE_EVERY", 10))
+)
 
 @app.route('/')
 def index():
@@ -618,14 +1182,80 @@ def index():
     
     return render_template('index.html', years=years, months=months, days=days, shichens=shichens)
 
+# 解析出生信息请求体，返回(年, 月, 日, 时辰)
+def parse_birth_request(data):
+    year = int(data.get('year'))
+    month = int(data.get('month'))
+    day = int(data.get('day'))
+    shichen = data.get('shichen')
+    return year, month, day, shichen
+
+# 请求方的标识，用于公平调度：部署在反向代理之后时取X-Forwarded-For中的第一个地址
+def client_key():
+    forwarded = request.headers.get('X-Forwarded-For', '')
+    if forwarded:
+        return forwarded.split(',')[0].strip()
+    return request.remote_addr or ''
+
+# 客户端提交过多任务时的响应
+def queue_full_response(error):
+    logger.warning(f"拒绝报告请求: {error}")
+    return jsonify({"error": "您提交的报告请求过多，请等待已提交的报告完成后再试。"}), 429, {"Retry-After": str(BUSY_RETRY_AFTER_SECONDS)}
+
+# 按需生成模式下立即生成的部分；其余部分在前端打开时经 /generate_report/section 生成
+LAZY_EAGER_SECTIONS = ("overview",)
+
+class LazyStats(object):
+    """按需生成的统计：推迟了多少个未缓存的部分，之后又有多少个被请求并实际调用了上游
+
+    两者之差即省下的上游调用数。推迟和请求可能落在不同worker，按进程统计时为近似值。
+    """
+
+    def __init__(self):
+        self.lazy_reports = 0
+        self.deferred_sections = 0
+        self.requested_sections = 0
+        self.generated_on_demand = 0
+        self._lock = threading.Lock()
+
+    def defer(self, bazi_info):
+        deferred = [section for section in REPORT_PROMPTS if section not in LAZY_EAGER_SECTIONS]
+        cost = report_cost(bazi_info, deferred)
+        with self._lock:
+            self.lazy_reports += 1
+            self.deferred_sections += cost
+
+    def requested(self, generated):
+        with self._lock:
+            self.requested_sections += 1
+            if generated:
+                self.generated_on_demand += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "lazy_reports": self.lazy_reports,
+                "deferred_sections": self.deferred_sections,
+                "requested_sections": self.requested_sections,
+                "generated_on_demand": self.generated_on_demand,
+                "upstream_calls_avoided": max(self.deferred_sections - self.generated_on_demand, 0)
+            }
+
+lazy_stats = LazyStats()
+
+# 请求是否使用按需生成模式，是则返回本次只生成的部分，否则返回None（生成全部）
+def requested_sections(data):
+    if data.get('lazy'):
+        return list(LAZY_EAGER_SECTIONS)
+    return None
+
 @app.route('/generate_report', methods=['POST'])
 def generate_report():
+    """生成报告（旧接口）：各部分都已缓存时返回200和完整报告，
+    否则提交报告任务并返回202、任务状态和Location: /reports/<id>，客户端按异步任务轮询进度
+    """
     try:
-        data = request.json
-        year = int(data.get('year'))
-        month = int(data.get('month'))
-        day = int(data.get('day'))
-        shichen = data.get('shichen')
+        year, month, day, shichen = parse_birth_request(request.json)
         
         # 记录请求详情
         logger.info(f"收到生成报告请求: 年={year}, 月={month}, 日={day}, 时辰={shichen}")
@@ -641,26 +1271,55 @@ def generate_report():
             return jsonify({"error": "计算八字信息失败"}), 400
         
         logger.info(f"八字计算成功: {bazi_info['bazi']}")
+        sections = requested_sections(request.json)
         
-        # 尝试使用generate_ai_report函数
+        # 各部分都已缓存时直接返回；否则提交任务并立即返回202，由客户端轮询 /reports/<id>，
+        # 不在请求线程里等待生成，避免长时间占用gunicorn的同步worker
         try:
-            logger.info("尝试使用generate_ai_report函数生成报告...")
-            reports = generate_ai_report(bazi_info)
-            logger.info("使用generate_ai_report生成报告成功")
+            reports = dict(
+                (section, get_cached_section(bazi_info['bazi'], section, stale_ok=True))
+                for section in REPORT_PROMPTS if sections is None or section in sections
+            )
+            if any(content is None for content in reports.values()):
+                payload = {"year": year, "month": month, "day": day, "shichen": shichen}
+                if sections is not None:
+                    payload["sections"] = sections
+                job_id = job_queue.submit(payload, client=client_key(), cost=report_cost(bazi_info, sections))
+                if sections is not None:
+                    lazy_stats.defer(bazi_info)
+                logger.info(f"已提交报告任务 {job_id}，返回任务地址")
+                job = job_queue.get(job_id)
+                job["bazi_info"] = bazi_info
+                return jsonify(job), 202, {"Location": f"/reports/{job_id}"}
+            failed = []
+            logger.info("各部分均已缓存")
+        except QueueFullError as full:
+            return queue_full_response(full)
         except Exception as api_err:
-            # 如果API调用出错，生成默认内容
-            logger.error(f"API调用出错: {api_err}，使用预设模板")
-            reports = {
-                "overview": f"八字信息：{bazi_info['bazi']}\n\n在传统五行学说中，您的八字中包含了重要的信息。目前由于网络原因，我们无法生成详细分析。请稍后再试。",
-                "ten_gods": "十神分析暂时无法生成，请稍后再试。",
-                "action_guide": "行动指南暂时无法生成，请稍后再试。"
-            }
+            # 如果提交任务出错，改用本地规则生成的简版报告；关闭本地简版报告时使用预设模板
+            logger.error(f"提交报告任务出错: {api_err}，使用本地简版报告或预设模板")
+            reports = build_local_report(bazi_info['bazi'], sections) if LOCAL_FALLBACK_ENABLED else {}
+            failed = []
+            if not reports:
+                reports = {
+                    "overview": f"八字信息：{bazi_info['bazi']}\n\n在传统五行学说中，您的八字中包含了重要的信息。目前由于网络原因，我们无法生成详细分析。请稍后再试。",
+                    "ten_gods": "十神分析暂时无法生成，请稍后再试。",
+                    "action_guide": "行动指南暂时无法生成，请稍后再试。"
+                }
+                failed = list(reports)
         
         # 组合结果
         result = {
             "bazi_info": bazi_info,
-            "reports": reports
+            "reports": reports,
+            # 失败或超时的部分，可经 /generate_report/regenerate 单独重新生成
+            "failed": failed,
+            # 以本地简版报告代替的部分，同样可以重新生成AI解读
+            "fallback": [section for section, content in reports.items() if is_local_report(content)]
         }
+        if sections is not None:
+            result["deferred"] = [section for section in REPORT_PROMPTS if section not in reports]
+            lazy_stats.defer(bazi_info)
         
         logger.info("返回报告结果")
         return jsonify(result)
@@ -670,6 +1329,493 @@ def generate_report():
         error_details = {"error": f"处理请求时出错: {str(e)}", "traceback": traceback.format_exc()}
         return jsonify(error_details), 500
 
+# 报告任务队列：生成报告在后台线程执行，不再长时间占用gunicorn的同步worker
+# 所有接口的报告都经过这个队列，按客户端做差额轮询，单个客户端无法占满所有执行线程
+JOB_DB_PATH = os.environ.get("JOB_DB_PATH", "jobs.db")
+job_queue = JobQueue(
+    JOB_DB_PATH,
+    quantum=len(REPORT_PROMPTS),
+    client_max_running=int(os.environ.get("JOB_CLIENT_MAX_RUNNING", 2)),
+    client_max_queued=int(os.environ.get("JOB_CLIENT_MAX_QUEUED", 5)),
+    heavy_client_jobs=int(os.environ.get("JOB_HEAVY_CLIENT_JOBS", 10)),
+    background_max_running=int(os.environ.get("JOB_BACKGROUND_MAX_RUNNING", 1))
+)
+
+# 任务开销：需要调用上游生成的报告部分数，已缓存的部分几乎不占上游配额
+def report_cost(bazi_info, sections=None):
+    sections = list(REPORT_PROMPTS) if sections is None else sections
+    if not bazi_info:
+        return len(sections)
+    return sum(1 for section in sections if get_cached_section(bazi_info['bazi'], section) is None)
+
+# 执行报告任务：计算八字后逐个部分写入进度，前端轮询时即可看到已完成的部分
+def run_report_job(job):
+    payload = job["payload"]
+    if "bazi" in payload:
+        # 过期缓存的重新生成任务（见refresh_stale_section）只有八字，没有出生信息
+        bazi_info = {"bazi": payload["bazi"]}
+    else:
+        year, month, day, shichen = parse_birth_request(payload)
+        hour = SHICHEN_MAP.get(shichen, (0, 0))[0]
+        bazi_info = calculate_bazi(year, month, day, hour)
+    if not bazi_info:
+        raise ValueError("计算八字信息失败")
+    job_queue.set_bazi_info(job["id"], bazi_info)
+    
+    priority = job.get("priority", INTERACTIVE)
+    seconds = REPORT_DEADLINE_SECONDS if priority == INTERACTIVE else BACKGROUND_DEADLINE_SECONDS
+    try:
+        reports = generate_ai_report(
+            bazi_info,
+            on_section=lambda section, content: job_queue.set_section(job["id"], section, content),
+            deadline=Deadline(seconds),
+            priority=priority,
+            sections=payload.get("sections")
+        )
+    except UpstreamBusyError:
+        if payload.get("on_demand"):
+            for _ in payload["sections"]:
+                lazy_stats.requested(False)
+        raise UpstreamBusyError(BUSY_MESSAGE)
+    # 按需生成的部分完成后计入统计，得到AI报告的才算实际调用了上游
+    if payload.get("on_demand"):
+        for section, content in reports.items():
+            lazy_stats.requested(not is_placeholder(section, content) and not is_local_report(content))
+
+# 提交后台报告任务（缓存预热、提示词变更后的批量重新生成），返回任务ID；各部分均已缓存时返回None
+def submit_background_report(year, month, day, shichen, client=BACKGROUND):
+    hour = SHICHEN_MAP.get(shichen, (0, 0))[0]
+    cost = report_cost(calculate_bazi(year, month, day, hour))
+    if cost == 0:
+        return None
+    return job_queue.submit(
+        {"year": year, "month": month, "day": day, "shichen": shichen},
+        client=client, cost=cost, priority=BACKGROUND
+    )
+
+job_runner = JobRunner(job_queue, run_report_job, workers=int(os.environ.get("JOB_WORKERS", 2)))
+
+# 收到第一个请求时启动任务执行线程，重启前遗留的排队任务也会继续执行
+@app.before_request
+def start_job_runner():
+    job_runner.start()
+
+@app.route('/reports', methods=['POST'])
+def submit_report_job():
+    try:
+        year, month, day, shichen = parse_birth_request(request.json)
+    except Exception as e:
+        return jsonify({"error": f"出生信息格式错误: {str(e)}"}), 400
+    
+    hour = SHICHEN_MAP.get(shichen, (0, 0))[0]
+    bazi_info = calculate_bazi(year, month, day, hour)
+    payload = {"year": year, "month": month, "day": day, "shichen": shichen}
+    sections = requested_sections(request.json)
+    if sections is not None:
+        payload["sections"] = sections
+    try:
+        job_id = job_queue.submit(payload, client=client_key(), cost=report_cost(bazi_info, sections))
+    except QueueFullError as e:
+        return queue_full_response(e)
+    if sections is not None:
+        lazy_stats.defer(bazi_info)
+    logger.info(f"已提交报告任务 {job_id}: 年={year}, 月={month}, 日={day}, 时辰={shichen}")
+    return jsonify(job_queue.get(job_id)), 202
+
+# 解析单个部分的请求：出生信息加部分名，返回(出生信息载荷, 八字信息, 部分)，格式错误时抛出ValueError
+def parse_section_request(data):
+    data = data or {}
+    section = data.get('section')
+    if section not in REPORT_PROMPTS:
+        raise ValueError(f"未知的报告部分: {section}")
+    try:
+        year, month, day, shichen = parse_birth_request(data)
+    except Exception as e:
+        raise ValueError(f"出生信息格式错误: {str(e)}")
+    bazi_info = calculate_bazi(year, month, day, SHICHEN_MAP.get(shichen, (0, 0))[0])
+    if not bazi_info:
+        raise ValueError("计算八字信息失败")
+    return {"year": year, "month": month, "day": day, "shichen": shichen}, bazi_info, section
+
+@app.route('/generate_report/section', methods=['POST'])
+def generate_section():
+    """按需生成单个报告部分：已缓存时返回200和内容，否则提交只含该部分的报告任务，
+    返回202、任务状态和Location: /reports/<id>，客户端轮询任务取得该部分
+
+    请求体为出生信息加 {"section": 部分名}，200时返回 {"section", "content", "cached", "fallback"}；
+    fallback为true时content是上游超时或熔断后的本地简版报告。
+    """
+    try:
+        payload, bazi_info, section = parse_section_request(request.json)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    
+    content = get_cached_section(bazi_info['bazi'], section, stale_ok=True)
+    if content is not None:
+        lazy_stats.requested(False)
+        return jsonify({"section": section, "content": content, "cached": True, "fallback": is_local_report(content)})
+    
+    logger.info(f"按需生成{section}报告: {bazi_info['bazi']}")
+    # on_demand：任务完成后计入按需生成的统计（见run_report_job）
+    payload = dict(payload, sections=[section], on_demand=True)
+    try:
+        job_id = job_queue.submit(payload, client=client_key(), cost=report_cost(bazi_info, [section]))
+    except QueueFullError as full:
+        return queue_full_response(full)
+    job = job_queue.get(job_id)
+    job["bazi_info"] = bazi_info
+    return jsonify(job), 202, {"Location": f"/reports/{job_id}"}
+
+@app.route('/generate_report/regenerate', methods=['POST'])
+def regenerate_section():
+    """重新生成报告中失败的一个部分，其余部分从缓存返回，重试只花一次上游调用
+
+    请求体为出生信息加 {"section": 部分名}。该部分已在缓存中（如其他请求已生成成功）时返回200和
+    {"bazi_info", "section", "reports", "failed", "fallback"}；reports中未缓存的其他部分为null，
+    fallback列出仍只得到本地简版报告的部分。
+    否则提交只含该部分的报告任务，返回202和Location: /reports/<id>?siblings=1，
+    轮询到任务结束时reports给出该部分和已缓存的其他部分。
+    """
+    try:
+        payload, bazi_info, section = parse_section_request(request.json)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    
+    content = get_cached_section(bazi_info['bazi'], section, stale_ok=True)
+    if content is not None:
+        reports = cached_sibling_reports(bazi_info, section)
+        reports[section] = content
+        return jsonify({
+            "bazi_info": bazi_info,
+            "section": section,
+            "reports": reports,
+            "failed": [],
+            "fallback": [section] if is_local_report(content) else []
+        })
+    
+    logger.info(f"重新生成{section}报告: {bazi_info['bazi']}")
+    try:
+        job_id = job_queue.submit(
+            dict(payload, sections=[section]), client=client_key(), cost=report_cost(bazi_info, [section])
+        )
+    except QueueFullError as full:
+        return queue_full_response(full)
+    job = job_queue.get(job_id)
+    job["bazi_info"] = bazi_info
+    return jsonify(job), 202, {"Location": f"/reports/{job_id}?siblings=1"}
+
+# 报告中其他部分的缓存内容，未缓存的为None；重新生成单个部分时与该部分一起返回
+def cached_sibling_reports(bazi_info, section):
+    return {name: get_cached_section(bazi_info['bazi'], name, stale_ok=True) for name in REPORT_PROMPTS if name != section}
+
+@app.route('/generate_report/preview', methods=['POST'])
+def generate_report_preview():
+    """即时预览：只用本地规则生成三个部分的简版报告，不调用上游、不经任务队列
+
+    请求体与 /generate_report 相同，返回 {"bazi_info", "reports", "preview": true}。
+    """
+    try:
+        year, month, day, shichen = parse_birth_request(request.json)
+    except Exception as e:
+        return jsonify({"error": f"出生信息格式错误: {str(e)}"}), 400
+    bazi_info = calculate_bazi(year, month, day, SHICHEN_MAP.get(shichen, (0, 0))[0])
+    if not bazi_info:
+        return jsonify({"error": "计算八字信息失败"}), 400
+    
+    started = time.monotonic()
+    reports = build_local_report(bazi_info['bazi'], preview=True)
+    local_report_stats.record("preview", time.monotonic() - started)
+    return jsonify({"bazi_info": bazi_info, "reports": reports, "preview": True})
+
+@app.route('/reports/<job_id>', methods=['GET'])
+def get_report_job(job_id):
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({"error": "任务不存在"}), 404
+    # 已结束但失败或超时的部分，前端据此显示"重新生成"按钮
+    job["failed_sections"] = [section for section, content in job["sections"].items() if is_placeholder(section, content)]
+    job["fallback_sections"] = [section for section, content in job["sections"].items() if is_local_report(content)]
+    # 重新生成单个部分的任务结束后，再从缓存取出其余部分一起返回
+    if request.args.get("siblings") and job["status"] in ("done", "failed") and job["bazi_info"]:
+        reports = {}
+        for section in job["sections"]:
+            reports.update(cached_sibling_reports(job["bazi_info"], section))
+        reports.update(job["sections"])
+        job["reports"] = reports
+    return jsonify(job)
+
+# SSE心跳间隔（秒），防止代理在上游长时间无输出时断开连接
+SSE_HEARTBEAT_SECONDS = 15
+
+# 将事件编码为SSE格式
+def format_sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+@app.route('/generate_report/stream', methods=['POST'])
+def generate_report_stream():
+    """以Server-Sent Events方式流式返回报告
+
+    事件顺序：bazi（命盘信息）→ 各部分的 delta（文本增量）/ section_done / section_error → done
+    上游超时或熔断时，section_done带 "fallback": true，内容为本地简版报告。
+    流式请求不经任务队列执行，但与该客户端运行中的任务一起受client_max_running限制，超出时返回429。
+    """
+    try:
+        year, month, day, shichen = parse_birth_request(request.json)
+        logger.info(f"收到流式生成报告请求: 年={year}, 月={month}, 日={day}, 时辰={shichen}")
+        
+        hour = SHICHEN_MAP.get(shichen, (0, 0))[0]
+        bazi_info = calculate_bazi(year, month, day, hour)
+        
+        if not bazi_info:
+            logger.error("计算八字信息失败")
+            return jsonify({"error": "计算八字信息失败"}), 400
+    except Exception as e:
+        logger.error(f"流式生成报告请求处理出错: {e}")
+        return jsonify({"error": f"处理请求时出错: {str(e)}"}), 500
+    
+    logger.info(f"八字计算成功: {bazi_info['bazi']}")
+    try:
+        stream_id = job_queue.start_stream(
+            {"year": year, "month": month, "day": day, "shichen": shichen}, client=client_key()
+        )
+    except QueueFullError as e:
+        return queue_full_response(e)
+    prompts = build_report_prompts(bazi_info)
+    events = queue.Queue()
+    cancel_event = threading.Event()
+    deadline = Deadline(REPORT_DEADLINE_SECONDS)
+    
+    # 在线程池中流式生成单个部分，把增量放入事件队列
+    def produce(section, prompt):
+        cached = get_cached_section(bazi_info['bazi'], section, stale_ok=True)
+        if cached is not None:
+            events.put(("section_done", {"section": section, "content": cached, "cached": True}))
+            return
+        
+        # 由本请求领头生成时逐段转发增量；已有相同生成在进行时只等待最终结果
+        def stream_and_cache():
+            route = section_router.choose(section)
+            parts = []
+            started = time.monotonic()
+            first_token = None
+            try:
+                for text in stream_deepseek_api(prompt, cancel_event, deadline, route):
+                    if first_token is None:
+                        first_token = time.monotonic() - started
+                    parts.append(text)
+                    events.put(("delta", {"section": section, "text": text}))
+            except (UpstreamBusyError, DeadlineExceeded):
+                raise
+            except Exception:
+                provider_router.record_route(route.name, first_token, time.monotonic() - started, False)
+                raise
+            if cancel_event.is_set():
+                raise Exception("客户端已断开，生成未完成")
+            provider_router.record_route(route.name, first_token, time.monotonic() - started, True)
+            content = "".join(parts)
+            cache_section(bazi_info['bazi'], section, content, route.model)
+            return content
+        
+        try:
+            content = section_coalescer.run(
+                section_key(bazi_info['bazi'], section),
+                lambda: get_cached_section(bazi_info['bazi'], section),
+                stream_and_cache,
+                timeout=deadline.remaining()
+            )
+            events.put(("section_done", {"section": section, "content": content}))
+        except UpstreamBusyError as e:
+            logger.warning(f"上游繁忙，流式生成{section}报告未发出: {e}")
+            events.put(("section_error", {"section": section, "error": BUSY_MESSAGE, "busy": True}))
+        except Exception as e:
+            logger.error(f"流式生成{section}报告出错: {e}")
+            content = local_fallback(bazi_info['bazi'], section, e)
+            if content is not None:
+                events.put(("section_done", {"section": section, "content": content, "fallback": True}))
+            else:
+                events.put(("section_error", {"section": section, "error": SECTION_ERROR_MESSAGE.format(section=section)}))
+    
+    def generate():
+        # 首个事件立即返回命盘，前端可以先渲染八字表格
+        yield format_sse("bazi", bazi_info)
+        for section, prompt in prompts.items():
+            section_executor.submit(produce, section, prompt)
+        
+        pending = set(prompts)
+        try:
+            while pending:
+                if deadline.expired():
+                    # 截止时间已到，未完成的部分以超时结束，已输出的内容保留
+                    logger.warning(f"流式报告超过{deadline.seconds:.0f}秒截止时间，未完成部分: {', '.join(sorted(pending))}")
+                    timeout = DeadlineExceeded("流式报告未在截止时间内完成")
+                    for section in sorted(pending):
+                        content = local_fallback(bazi_info['bazi'], section, timeout)
+                        if content is not None:
+                            yield format_sse("section_done", {"section": section, "content": content, "fallback": True})
+                        else:
+                            yield format_sse("section_error", {"section": section, "error": SECTION_TIMEOUT_MESSAGE.format(section=section)})
+                    break
+                try:
+                    event, data = events.get(timeout=max(min(SSE_HEARTBEAT_SECONDS, deadline.remaining()), 0.01))
+                except queue.Empty:
+                    if not deadline.expired():
+                        yield ": keep-alive\n\n"
+                    continue
+                if event in ("section_done", "section_error"):
+                    pending.discard(data["section"])
+                yield format_sse(event, data)
+            yield format_sse("done", {})
+        finally:
+            # 正常结束或客户端断开时，通知仍在运行的上游读取停止
+            cancel_event.set()
+    
+    response = Response(generate(), mimetype='text/event-stream', headers={'X-Accel-Buffering': 'no'})
+    # 响应关闭时（含客户端在首个事件前断开）释放该客户端的并发名额
+    response.call_on_close(lambda: job_queue.finish_stream(stream_id))
+    return response
+
+# 批量报告：单次请求最多包含的出生记录数，以及每个worker内同时生成的报告部分数上限（所有批量请求共享）
+BATCH_MAX_RECORDS = int(os.environ.get("BATCH_MAX_RECORDS", 100))
+BATCH_CONCURRENCY = int(os.environ.get("BATCH_CONCURRENCY", 4))
+batch_executor = ThreadPoolExecutor(max_workers=BATCH_CONCURRENCY, thread_name_prefix="batch")
+
+# 将一条结果编码为NDJSON的一行
+def format_ndjson(data):
+    return json.dumps(data, ensure_ascii=False) + "\n"
+
+@app.route('/generate_reports/batch', methods=['POST'])
+def generate_reports_batch():
+    """批量生成报告，以NDJSON（每行一个JSON）按完成顺序流式返回
+
+    请求体为 {"records": [{"id": 可选, "year":, "month":, "day":, "shichen":}, ...]}。
+    先一次算出所有命盘并按八字去重，已缓存的部分直接返回，只有缺失的部分提交上游生成，
+    并发数受BATCH_CONCURRENCY限制。每条记录一行：{"index", "id", "bazi_info", "reports", "errors"}，
+    记录无效时为 {"index", "id", "error"}；最后一行为 {"summary": {...}}。
+    """
+    data = request.get_json(silent=True) or {}
+    records = data.get('records') if isinstance(data, dict) else data
+    if not isinstance(records, list) or not records:
+        return jsonify({"error": "请求体须包含非空的records列表"}), 400
+    if len(records) > BATCH_MAX_RECORDS:
+        return jsonify({"error": f"单次最多提交{BATCH_MAX_RECORDS}条出生记录，本次为{len(records)}条"}), 400
+    
+    deadline = Deadline(REPORT_DEADLINE_SECONDS)
+    invalid = []    # [(序号, 记录ID, 错误)]
+    charts = {}     # 八字 -> 命盘信息
+    members = {}    # 八字 -> [(序号, 记录ID)]
+    for index, record in enumerate(records):
+        record_id = record.get('id', index) if isinstance(record, dict) else index
+        try:
+            year, month, day, shichen = parse_birth_request(record)
+            bazi_info = calculate_bazi(year, month, day, SHICHEN_MAP.get(shichen, (0, 0))[0])
+        except Exception as e:
+            invalid.append((index, record_id, f"出生信息格式错误: {str(e)}"))
+            continue
+        if not bazi_info:
+            invalid.append((index, record_id, "计算八字信息失败"))
+            continue
+        charts.setdefault(bazi_info['bazi'], bazi_info)
+        members.setdefault(bazi_info['bazi'], []).append((index, record_id))
+    
+    # 各命盘已缓存的部分直接取出，其余的记为待生成
+    reports = dict((bazi, {}) for bazi in charts)
+    errors = dict((bazi, []) for bazi in charts)
+    missing = []
+    for bazi in charts:
+        for section in REPORT_PROMPTS:
+            cached = get_cached_section(bazi, section, stale_ok=True)
+            if cached is None:
+                missing.append((bazi, section))
+            else:
+                reports[bazi][section] = cached
+    logger.info(f"收到批量报告请求: {len(records)}条记录，{len(charts)}个不同命盘，需生成{len(missing)}个报告部分")
+    
+    def chart_lines(bazi):
+        for index, record_id in members[bazi]:
+            yield format_ndjson({
+                "index": index,
+                "id": record_id,
+                "bazi_info": charts[bazi],
+                "reports": {section: reports[bazi][section] for section in REPORT_PROMPTS},
+                "errors": errors[bazi]
+            })
+    
+    def generate():
+        for index, record_id, error in invalid:
+            yield format_ndjson({"index": index, "id": record_id, "error": error})
+        
+        # 全部命中缓存的命盘最先返回
+        for bazi in charts:
+            if len(reports[bazi]) == len(REPORT_PROMPTS):
+                yield from chart_lines(bazi)
+        
+        futures = dict(
+            (batch_executor.submit(generate_report_section, bazi, section, deadline), (bazi, section))
+            for bazi, section in missing
+        )
+        generated = 0
+        try:
+            for future in as_completed(futures, timeout=deadline.remaining()):
+                bazi, section = futures[future]
+                report, error = future.result()
+                reports[bazi][section] = report
+                if error is None:
+                    generated += 1
+                else:
+                    errors[bazi].append(section)
+                if len(reports[bazi]) == len(REPORT_PROMPTS):
+                    yield from chart_lines(bazi)
+        except FutureTimeoutError:
+            logger.warning(f"批量报告超过{deadline.seconds:.0f}秒截止时间，未完成的部分以超时返回")
+            for bazi in charts:
+                if len(reports[bazi]) == len(REPORT_PROMPTS):
+                    continue
+                for section in REPORT_PROMPTS:
+                    if section not in reports[bazi]:
+                        reports[bazi][section] = SECTION_TIMEOUT_MESSAGE.format(section=section)
+                        errors[bazi].append(section)
+                yield from chart_lines(bazi)
+        finally:
+            # 客户端断开或超时时，撤下还未开始的生成
+            for future in futures:
+                future.cancel()
+        
+        yield format_ndjson({"summary": {
+            "records": len(records),
+            "invalid": len(invalid),
+            "charts": len(charts),
+            "cached_sections": len(charts) * len(REPORT_PROMPTS) - len(missing),
+            "generated_sections": generated,
+            "failed_sections": sum(len(sections) for sections in errors.values())
+        }})
+    
+    return Response(generate(), mimetype='application/x-ndjson', headers={'X-Accel-Buffering': 'no'})
+
+# 运行指标：上游连接复用、报告缓存命中等，仅反映当前worker进程
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return jsonify({
+        "upstream": upstream_client.snapshot(),
+        "providers": provider_router.snapshot(),
+        # 各报告部分的模型路由及其首字节时间、总耗时的滚动统计
+        "section_routes": section_router.snapshot(),
+        "circuit_breakers": {name: breaker.snapshot() for name, breaker in circuit_breakers.items()},
+        "retry_budget": retry_budget.snapshot(),
+        "upstream_limiters": {name: limiter.snapshot() for name, limiter in upstream_limiters.items()},
+        # 最近一小时报告任务的排队等待时间，按客户端类别（normal/heavy）统计，所有worker共享
+        "report_queue_wait": job_queue.wait_stats(),
+        # 按需生成模式推迟的部分与之后实际生成的部分，差值为省下的上游调用
+        "lazy_sections": lazy_stats.snapshot(),
+        # 本地简版报告代替超时或熔断部分的次数、即时预览次数和生成耗时
+        "local_reports": local_report_stats.snapshot(),
+        # 本地命理资料索引的语料规模、建索引耗时和检索耗时
+        "retrieval": get_retriever().snapshot() if RETRIEVAL_TOP_K > 0 else None,
+        "report_cache": report_cache.stats(),
+        # 提示词修改后先返回旧版本缓存的次数，以及提交和跳过的后台重新生成任务数
+        "stale_cache": stale_stats.snapshot(),
+        "token_usage": token_usage.snapshot()
+    })
+
 # 添加直接返回静态文件内容的路由，解决Render.com部署问题
 # 同时支持新旧两种路径
 @app.route('/style.css')
@@ -696,6 +1842,41 @@ def serve_js():
         logger.error(f"读取JS文件失败: {e}")
         return "", 500
 
+# 管理命令：FLASK_APP=app flask cache-stats
+@app.cli.command("cache-stats")
+def cache_stats_command():
+    """按报告部分、提示词版本和模型统计报告缓存的条目数，标出已过期的提示词版本"""
+    rows = report_cache.version_counts()
+    if not rows:
+        print("报告缓存为空")
+        return
+    totals = {"current": 0, "stale": 0}
+    print(f"{'部分':<14}{'提示词版本':<16}{'模型':<24}{'条目数':>8}  {'最近写入':<19}  状态")
+    for section, version, model, count, latest in rows:
+        current = version == PROMPT_VERSIONS.get(section)
+        totals["current" if current else "stale"] += count
+        written = datetime.fromtimestamp(latest).strftime('%Y-%m-%d %H:%M:%S')
+        print(f"{section:<14}{version:<16}{model:<24}{count:>8}  {written:<19}  {'当前' if current else '过期'}")
+    print(f"当前版本 {totals['current']} 条，过期版本 {totals['stale']} 条")
+
+# 管理命令：FLASK_APP=app flask cache-compress
+@app.cli.command("cache-compress")
+def cache_compress_command():
+    """用已有报告的随机样本重新训练压缩字典，并把其余条目改用新字典压缩"""
+    if not report_cache.codec.enabled:
+        print("未启用压缩（REPORT_CACHE_COMPRESS=0或未安装zstandard）")
+        return
+    dict_id = report_cache.train_dictionary()
+    if not dict_id:
+        print(f"报告缓存条目不足{MIN_TRAIN_SAMPLES}个或训练失败，未生成新字典")
+        return
+    started = time.monotonic()
+    rewritten, before, after = report_cache.recompress()
+    ratio = before / float(after) if after else 0.0
+    print(f"压缩字典{dict_id}：改写{rewritten}个条目，{before / 1024:.1f}KB → {after / 1024:.1f}KB"
+          f"（压缩比{ratio:.2f}），用时{time.monotonic() - started:.1f}秒")
+    print(f"数据库文件的空闲页留给之后的写入复用，如需立即缩小文件可执行 sqlite3 {REPORT_CACHE_PATH} VACUUM")
+
 if __name__ == '__main__':
     # 本地开发环境
     app.run(debug=True, host='0.0.0.0', port=8090)
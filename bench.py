@@ -0,0 +1,336 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# 性能基准脚本
+#
+# 用法：
+#   python bench.py assemble [--rounds 2000]   上游响应体拼装的CPU与内存分配对比
+#   python bench.py generate [--charts 3] [--modes sequential,parallel,combined]
+#                                               三种报告生成模式的延迟和token用量对比（会真实调用上游）
+#   python bench.py retrieve [--charts 200]     本地命理资料检索的建索引和单次检索耗时
+#   python bench.py facts [--charts 3]          提示词带与不带命盘要点时的输出token和耗时对比（会真实调用上游）
+#   python bench.py storage [--samples 1000] [--synthetic]    报告缓存zstd字典压缩的压缩比和读取耗时（需安装zstandard）
+
+import argparse
+import datetime
+import json
+import logging
+import os
+import statistics
+import tempfile
+import time
+import tracemalloc
+
+# 基准测试时关闭应用的INFO日志，避免日志输出干扰计时
+logging.disable(logging.INFO)
+
+import app
+import chart_facts
+import compression
+import local_report
+import retrieval
+from db import get_connection
+from report_cache import ReportCache
+
+# 模拟网络上陆续到达的数据块大小
+NETWORK_CHUNK_SIZE = 512
+
+class FakeResponse(object):
+    """回放预先切好的数据块的假响应，切块本身不计入测量"""
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+
+    def iter_content(self, chunk_size=512):
+        return iter(self.chunks)
+
+def sample_response_body():
+    """构造一个与真实报告体量相当（约6KB中文）的DeepSeek响应体"""
+    paragraph = "【日主解读 · 我的内在之光】日主是你命盘中代表自我的核心能量，丙火生于辰月，温暖而明亮。"
+    content = "\n".join([paragraph] * 60)
+    result = {"choices": [{"message": {"role": "assistant", "content": content}}]}
+    return json.dumps(result, ensure_ascii=False).encode('utf-8')
+
+def legacy_assemble(response):
+    """旧实现：每512字节解码一次并拼接字符串，每5块输出一次日志"""
+    content = ""
+    chunk_count = 0
+    total_bytes = 0
+    for chunk in response.iter_content(chunk_size=512):
+        if chunk:
+            chunk_text = chunk.decode('utf-8', errors='replace')
+            content += chunk_text
+            chunk_count += 1
+            total_bytes += len(chunk)
+            if chunk_count % 5 == 0:
+                app.logger.info(f"正在读取数据: 已接收{chunk_count}个块，共{total_bytes}字节")
+    return json.loads(content)
+
+def current_assemble(response):
+    """新实现：与call_deepseek_api相同，读入一个bytearray后直接按UTF-8字节解析"""
+    return json.loads(app.read_response_body(response))
+
+def measure(fn, chunks, rounds):
+    started = time.process_time()
+    for _ in range(rounds):
+        fn(FakeResponse(chunks))
+    cpu = time.process_time() - started
+
+    tracemalloc.start()
+    fn(FakeResponse(chunks))
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return cpu / rounds * 1e6, peak
+
+def bench_assemble(args):
+    body = sample_response_body()
+    chunks = [body[i:i + NETWORK_CHUNK_SIZE] for i in range(0, len(body), NETWORK_CHUNK_SIZE)]
+    legacy_text = legacy_assemble(FakeResponse(chunks))["choices"][0]["message"]["content"]
+    current_text = current_assemble(FakeResponse(chunks))["choices"][0]["message"]["content"]
+    print(f"响应体大小: {len(body)}字节，轮数: {args.rounds}")
+    print(f"旧实现乱码字符数: {legacy_text.count(chr(0xFFFD))}，新实现乱码字符数: {current_text.count(chr(0xFFFD))}")
+    print(f"{'实现':<8}{'CPU/次(µs)':>14}{'峰值内存(B)':>14}")
+    for name, fn in (("旧实现", legacy_assemble), ("新实现", current_assemble)):
+        cpu_us, peak = measure(fn, chunks, args.rounds)
+        print(f"{name:<8}{cpu_us:>14.1f}{peak:>14}")
+
+def sample_charts(count):
+    """从1990年起每隔37天、轮换时辰取count个不同的命盘"""
+    charts = []
+    seen = set()
+    day = datetime.date(1990, 1, 1)
+    shichens = list(app.SHICHEN_MAP.values())
+    while len(charts) < count:
+        hour = shichens[len(seen) % len(shichens)][0]
+        bazi_info = app.calculate_bazi(day.year, day.month, day.day, hour)
+        if bazi_info and bazi_info['bazi'] not in seen:
+            seen.add(bazi_info['bazi'])
+            charts.append(bazi_info)
+        day += datetime.timedelta(days=37)
+    return charts
+
+def generate_sequential(bazi_info):
+    """三次调用依次生成"""
+    return dict(
+        (section, app.generate_report_section(bazi_info['bazi'], section)[0]) for section in app.REPORT_PROMPTS
+    )
+
+def generate_parallel(bazi_info):
+    """三次调用并发生成"""
+    app.REPORT_GENERATION_MODE = "parallel"
+    return app.generate_ai_report(bazi_info)
+
+def generate_combined(bazi_info):
+    """一次调用生成全部部分"""
+    app.REPORT_GENERATION_MODE = "combined"
+    return app.generate_ai_report(bazi_info)
+
+GENERATE_MODES = {
+    "sequential": generate_sequential,
+    "parallel": generate_parallel,
+    "combined": generate_combined
+}
+
+def usage_totals():
+    snapshot = app.token_usage.snapshot().values()
+    return (sum(usage["calls"] for usage in snapshot),
+            sum(usage["prompt_tokens"] for usage in snapshot),
+            sum(usage["completion_tokens"] for usage in snapshot),
+            sum(usage["prompt_cache_hit_tokens"] for usage in snapshot))
+
+def bench_generate(args):
+    charts = sample_charts(args.charts)
+    modes = [mode.strip() for mode in args.modes.split(",") if mode.strip()]
+    cache_dir = tempfile.mkdtemp(prefix="bench_cache_")
+    print(f"命盘数: {len(charts)}，每种模式使用同样的命盘和空缓存")
+    print(f"{'模式':<12}{'P50耗时(s)':>12}{'平均耗时(s)':>12}{'调用/命盘':>10}{'输入token/命盘':>16}{'输出token/命盘':>16}{'输入缓存命中':>12}{'失败部分':>10}")
+    for mode in modes:
+        # 每种模式换一个空的报告缓存，保证都从上游生成
+        app.report_cache = ReportCache(os.path.join(cache_dir, f"{mode}.db"))
+        calls_before, prompt_before, completion_before, hit_before = usage_totals()
+        latencies = []
+        failed = 0
+        for bazi_info in charts:
+            started = time.monotonic()
+            reports = GENERATE_MODES[mode](bazi_info)
+            latencies.append(time.monotonic() - started)
+            failed += sum(1 for section, content in reports.items() if app.is_placeholder(section, content))
+        calls, prompt_tokens, completion_tokens, hit_tokens = usage_totals()
+        n = float(len(charts))
+        prompt_used = prompt_tokens - prompt_before
+        hit_ratio = (hit_tokens - hit_before) / float(prompt_used) if prompt_used else 0.0
+        print(f"{mode:<12}{statistics.median(latencies):>12.1f}{statistics.mean(latencies):>12.1f}"
+              f"{(calls - calls_before) / n:>10.1f}{prompt_used / n:>16.0f}"
+              f"{(completion_tokens - completion_before) / n:>16.0f}{hit_ratio:>12.1%}{failed:>10}")
+
+def bench_retrieve(args):
+    charts = [bazi_info['bazi'] for bazi_info in sample_charts(args.charts)]
+    started = time.monotonic()
+    retriever = retrieval.Retriever(retrieval.load_classic_passages() + retrieval.load_rule_passages())
+    build_ms = (time.monotonic() - started) * 1000
+    snapshot = retriever.snapshot()
+    print(f"语料: {snapshot['passages']}条 {snapshot['sources']}，读取语料并建索引用时{build_ms:.1f}ms")
+    latencies = []
+    hits = 0
+    for bazi in charts:
+        started = time.perf_counter()
+        passages = retriever.retrieve(bazi, app.RETRIEVAL_TOP_K, app.RETRIEVAL_MAX_CHARS)
+        latencies.append((time.perf_counter() - started) * 1000)
+        hits += len(passages)
+    latencies.sort()
+    print(f"命盘数: {len(charts)}，平均每个命盘{hits / float(len(charts)):.1f}条资料")
+    print(f"检索耗时(ms): P50 {statistics.median(latencies):.3f}，"
+          f"P99 {latencies[int(len(latencies) * 0.99) - 1]:.3f}，最大 {latencies[-1]:.3f}")
+    print(f"示例 {charts[0]}:\n{retrieval.format_references(retriever.retrieve(charts[0], app.RETRIEVAL_TOP_K, app.RETRIEVAL_MAX_CHARS))}")
+
+def bench_facts(args):
+    charts = sample_charts(args.charts)
+    cache_dir = tempfile.mkdtemp(prefix="bench_cache_")
+    started = time.perf_counter()
+    for bazi_info in charts:
+        chart_facts.format_facts(chart_facts.compute_facts(bazi_info['bazi']))
+    compute_us = (time.perf_counter() - started) / len(charts) * 1e6
+    print(f"命盘数: {len(charts)}，每个部分单独生成；计算命盘要点平均{compute_us:.0f}µs")
+    print(f"{'命盘要点':<10}{'P50耗时/部分(s)':>16}{'平均耗时/部分(s)':>16}{'输入token/部分':>16}{'输出token/部分':>16}{'失败部分':>10}")
+    for enabled in (False, True):
+        app.CHART_FACTS_ENABLED = enabled
+        app.report_cache = ReportCache(os.path.join(cache_dir, f"facts_{int(enabled)}.db"))
+        calls_before, prompt_before, completion_before, _ = usage_totals()
+        latencies = []
+        failed = 0
+        for bazi_info in charts:
+            for section in app.REPORT_PROMPTS:
+                section_started = time.monotonic()
+                _, error = app.generate_report_section(bazi_info['bazi'], section)
+                latencies.append(time.monotonic() - section_started)
+                failed += error is not None
+        calls, prompt_tokens, completion_tokens, _ = usage_totals()
+        n = float(max(calls - calls_before, 1))
+        print(f"{'带' if enabled else '不带':<10}{statistics.median(latencies):>16.1f}{statistics.mean(latencies):>16.1f}"
+              f"{(prompt_tokens - prompt_before) / n:>16.0f}{(completion_tokens - completion_before) / n:>16.0f}{failed:>10}")
+
+# 用缓存中的报告测量时至少需要的报告部分数
+STORAGE_MIN_SAMPLES = 100
+
+def storage_samples(count, synthetic=False):
+    """压缩基准用的报告文本，返回[(文本, 是否为本地简版报告)]
+
+    默认只取报告缓存中已有的AI报告；synthetic为真时不足的部分用本地简版报告补足。
+    简版报告由固定模板拼成，彼此重复度远高于AI报告，用它测出的压缩比会明显偏高。
+    """
+    samples = [(text, False) for text in app.report_cache.sample_contents(count)]
+    if synthetic and len(samples) < count:
+        for bazi_info in sample_charts((count - len(samples)) // len(app.REPORT_PROMPTS) + 1):
+            samples.extend((text, True) for text in local_report.build_local_report(bazi_info['bazi']).values())
+    return samples[:count]
+
+def read_latencies(cache, keys, memory, rounds=1):
+    """逐个读取keys共rounds轮，返回每次读取的耗时（微秒）；memory为假时每次读取前清空LRU，测量的是磁盘读取"""
+    latencies = []
+    for _ in range(rounds):
+        for key in keys:
+            if not memory:
+                cache._memory.clear()
+            started = time.perf_counter()
+            cache.get(*key)
+            latencies.append((time.perf_counter() - started) * 1e6)
+    return latencies
+
+def bench_storage(args):
+    if compression.zstandard is None:
+        print("未安装zstandard，无法测量压缩（pip install zstandard）")
+        return
+    zstandard = compression.zstandard
+    samples = storage_samples(args.samples, args.synthetic)
+    synthetic = sum(1 for _, is_synthetic in samples if is_synthetic)
+    if len(samples) - synthetic < STORAGE_MIN_SAMPLES and not args.synthetic:
+        print(f"报告缓存中只有{len(samples)}个报告部分，至少需要{STORAGE_MIN_SAMPLES}个；"
+              f"可先用pregen.py预生成，或加--synthetic用本地简版报告补足（压缩比会偏高）")
+        return
+    # 一半样本训练字典，另一半测量，压缩比不会因为字典里恰好有测量样本而偏高
+    train = [text for text, _ in samples[::2]]
+    test_samples = samples[1::2]
+    test = [text for text, _ in test_samples]
+    raw = sum(len(text.encode('utf-8')) for text in test)
+    print(f"样本: {len(samples)}个报告部分（缓存中的报告{len(samples) - synthetic}个，本地简版报告{synthetic}个），"
+          f"训练{len(train)}个、测量{len(test)}个，平均{raw / float(len(test)) / 1024:.1f}KB")
+    if synthetic:
+        print(f"注意：{synthetic / float(len(samples)):.0%}的样本是本地简版报告，由固定模板拼成，"
+              f"下表的压缩比高于真实报告" + ("；真实报告的压缩比见“仅缓存”一行" if synthetic < len(samples) else ""))
+
+    plain = zstandard.ZstdCompressor(level=compression.ZSTD_LEVEL)
+    plain_size = sum(len(plain.compress(text.encode('utf-8'))) for text in test)
+
+    cache_dir = tempfile.mkdtemp(prefix="bench_storage_")
+    caches = {
+        "不压缩": ReportCache(os.path.join(cache_dir, "plain.db"), memory_size=len(test), compress=False),
+        "字典压缩": ReportCache(os.path.join(cache_dir, "zstd.db"), memory_size=len(test))
+    }
+    compressed = caches["字典压缩"]
+    started = time.monotonic()
+    dict_id = compressed.codec.train(train)
+    train_seconds = time.monotonic() - started
+    if not dict_id:
+        print("训练字典失败，样本可能太少")
+        return
+    dict_size = sum(len(compressed.codec.encode(text)) for text in test)
+    print(f"字典: {len(compressed.codec._dictionary(dict_id).as_bytes()) / 1024:.1f}KB，训练用时{train_seconds:.2f}秒")
+    print(f"{'方式':<16}{'总大小(KB)':>12}{'平均/部分(KB)':>14}{'压缩比':>8}")
+    rows = [("原文", raw, raw, len(test)), ("zstd", raw, plain_size, len(test)), ("zstd+字典", raw, dict_size, len(test))]
+    real = [text for text, is_synthetic in test_samples if not is_synthetic]
+    if synthetic and real:
+        real_raw = sum(len(text.encode('utf-8')) for text in real)
+        rows.append(("zstd+字典(仅缓存)", real_raw, sum(len(compressed.codec.encode(text)) for text in real), len(real)))
+    for name, original, size, count in rows:
+        print(f"{name:<16}{size / 1024:>12.1f}{size / 1024 / count:>14.2f}{original / float(size):>8.2f}")
+
+    keys = [(f"bench{index}", "overview", "bench", "bench") for index in range(len(test))]
+    for cache in caches.values():
+        for key, text in zip(keys, test):
+            cache.set(*key, text)
+    # 先读一遍不计时：首次读取要建立连接、创建解压器并载入字典，是每个线程一次性的开销
+    for cache in caches.values():
+        read_latencies(cache, keys, False)
+    print(f"读取{args.rounds}轮")
+    print(f"{'读取':<10}{'方式':<10}{'P50(µs)':>10}{'P99(µs)':>10}{'平均(µs)':>10}")
+    for memory in (False, True):
+        for name, cache in caches.items():
+            latencies = sorted(read_latencies(cache, keys, memory, args.rounds))
+            print(f"{'内存LRU' if memory else 'SQLite':<10}{name:<10}{statistics.median(latencies):>10.1f}"
+                  f"{latencies[int(len(latencies) * 0.99) - 1]:>10.1f}{statistics.mean(latencies):>10.1f}")
+    for name, cache in caches.items():
+        get_connection(cache.path).execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        print(f"{name}的数据库文件: {os.path.getsize(cache.path) / 1024:.0f}KB")
+
+def main():
+    parser = argparse.ArgumentParser(description="AI命理教练性能基准")
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+
+    assemble = subparsers.add_parser("assemble", help="上游响应体拼装的CPU与内存分配对比")
+    assemble.add_argument("--rounds", type=int, default=2000)
+    assemble.set_defaults(func=bench_assemble)
+
+    generate = subparsers.add_parser("generate", help="三种报告生成模式的延迟和token用量对比（会真实调用上游）")
+    generate.add_argument("--charts", type=int, default=3, help="每种模式生成的命盘数")
+    generate.add_argument("--modes", default="sequential,parallel,combined", help="逗号分隔的模式")
+    generate.set_defaults(func=bench_generate)
+
+    retrieve = subparsers.add_parser("retrieve", help="本地命理资料检索的建索引和单次检索耗时")
+    retrieve.add_argument("--charts", type=int, default=200, help="检索的命盘数")
+    retrieve.set_defaults(func=bench_retrieve)
+
+    facts = subparsers.add_parser("facts", help="提示词带与不带命盘要点时的输出token和耗时对比（会真实调用上游）")
+    facts.add_argument("--charts", type=int, default=3, help="生成的命盘数")
+    facts.set_defaults(func=bench_facts)
+
+    storage = subparsers.add_parser("storage", help="报告缓存zstd字典压缩的压缩比和读取耗时（需安装zstandard）")
+    storage.add_argument("--samples", type=int, default=1000, help="参与测量的报告部分数，一半训练字典、一半测量")
+    storage.add_argument("--synthetic", action="store_true", help="缓存中的报告不足时用本地简版报告补足（压缩比偏高）")
+    storage.add_argument("--rounds", type=int, default=5, help="读取耗时测量的轮数")
+    storage.set_defaults(func=bench_storage)
+
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# 命盘要点：在本地算出五行分数、日主强弱、十神、藏干、格局、神煞和干支关系，排成提示词中的要点段落
+#
+# 只给模型八字时，它要先自己推算日主强弱、五行多寡和十神，这部分推理既占输出token又拖慢生成，
+# 推算结果还常常前后不一。这些都是确定的计算，在本地几十微秒就能算完。
+# 算法沿用bazi.py：天干每个5分，地支按藏干本气/中气/余气计分（月令计两次），
+# 比劫印枭四类天干的分数合计为强弱值，以29为中值；强根看日主在四支的长生、帝旺、临官（建禄）。
+# bazi.py依赖的datas等模块不在本仓库中，藏干、十神、五行取自lunar_python的对照表，其余对照表在下面列出。
+
+from lunar_python.util import LunarUtil
+
+GANS = "甲乙丙丁戊己庚辛壬癸"
+ZHIS = "子丑寅卯辰巳午未申酉戌亥"
+PILLAR_NAMES = ("年", "月", "日", "时")
+
+# 命盘要点的格式版本，计入提示词版本：修改算法或format_facts的排版时加一，已有缓存随之成为过期版本
+FACTS_VERSION = 1
+
+# 强弱值的中值，与bazi.py一致
+STRONG_MEDIAN = 29
+
+# 藏干分数：按藏干个数分别为[8]、[本气5, 中气3]、[本气5, 中气2, 余气1]
+HIDDEN_WEIGHTS = {1: (8,), 2: (5, 3), 3: (5, 2, 1)}
+
+# 十二长生：日干在子支时的序号，阳干顺行、阴干逆行（与lunar_python的地势计算相同）
+CHANG_SHENG = ("长生", "沐浴", "冠带", "临官", "帝旺", "衰", "病", "死", "墓", "绝", "胎", "养")
+CHANG_SHENG_OFFSET = {"甲": 1, "丙": 10, "戊": 10, "庚": 7, "壬": 4,
+                      "乙": 6, "丁": 9, "己": 9, "辛": 0, "癸": 3}
+
+# 天干五合及合化五行
+GAN_HE = {"甲己": "土", "乙庚": "金", "丙辛": "水", "丁壬": "木", "戊癸": "火"}
+# 地支六合、相害
+ZHI_LIU_HE = ("子丑", "寅亥", "卯戌", "辰酉", "巳申", "午未")
+ZHI_HAI = ("子未", "丑午", "寅巳", "卯辰", "申亥", "酉戌")
+# 地支相刑：无礼之刑、恃势之刑、无恩之刑；自刑在同一地支出现两次时成立
+ZHI_XING = ("子卯", "寅巳", "巳申", "申寅", "丑戌", "戌未", "未丑")
+ZHI_SELF_XING = "辰午酉亥"
+# 地支三合局：(三支, 合化五行)，中间一支为旺地，含旺地的两支为半合
+ZHI_SAN_HE = (("申子辰", "水"), ("亥卯未", "木"), ("寅午戌", "火"), ("巳酉丑", "金"))
+
+# 神煞：天乙贵人、文昌、禄神、羊刃按日干查地支
+TIAN_YI = {"甲": "丑未", "戊": "丑未", "庚": "丑未", "乙": "子申", "己": "子申",
+           "丙": "亥酉", "丁": "亥酉", "壬": "卯巳", "癸": "卯巳", "辛": "寅午"}
+WEN_CHANG = {"甲": "巳", "乙": "午", "丙": "申", "丁": "酉", "戊": "申",
+             "己": "酉", "庚": "亥", "辛": "子", "壬": "寅", "癸": "卯"}
+LU_SHEN = {"甲": "寅", "乙": "卯", "丙": "巳", "丁": "午", "戊": "巳",
+           "己": "午", "庚": "申", "辛": "酉", "壬": "亥", "癸": "子"}
+YANG_REN = {"甲": "卯", "丙": "午", "戊": "午", "庚": "酉", "壬": "子"}
+# 驿马、桃花、华盖按年支或日支所在的三合局查地支
+SAN_HE_SHENS = {
+    "申子辰": {"驿马": "寅", "桃花": "酉", "华盖": "辰"},
+    "寅午戌": {"驿马": "申", "桃花": "卯", "华盖": "戌"},
+    "巳酉丑": {"驿马": "亥", "桃花": "午", "华盖": "丑"},
+    "亥卯未": {"驿马": "巳", "桃花": "子", "华盖": "未"},
+}
+
+def parse_bazi(bazi):
+    """把“甲子 乙丑 丙寅 丁卯”拆成(天干列表, 地支列表)，格式不对时返回None"""
+    pillars = bazi.split()
+    if len(pillars) != 4 or any(
+        len(pillar) != 2 or pillar[0] not in GANS or pillar[1] not in ZHIS for pillar in pillars
+    ):
+        return None
+    return [pillar[0] for pillar in pillars], [pillar[1] for pillar in pillars]
+
+def hidden_stems(zhi):
+    """地支藏干及分数[(天干, 分数)]，本气在前"""
+    stems = LunarUtil.ZHI_HIDE_GAN[zhi]
+    return list(zip(stems, HIDDEN_WEIGHTS[len(stems)]))
+
+def ten_god(me, gan):
+    return LunarUtil.SHI_SHEN[me + gan]
+
+def chang_sheng(me, zhi):
+    index = CHANG_SHENG_OFFSET[me] + (ZHIS.index(zhi) if GANS.index(me) % 2 == 0 else -ZHIS.index(zhi))
+    return CHANG_SHENG[index % 12]
+
+def _pairs(items):
+    for i in range(len(items)):
+        for j in range(i + 1, len(items)):
+            yield i, j
+
+def _relations(gans, zhis):
+    """天干五合，地支六合、冲、刑、害、三合与半合，各条注明所在的柱"""
+    relations = []
+    for i, j in _pairs(gans):
+        pair = "".join(sorted((gans[i], gans[j]), key=GANS.index))
+        if pair in GAN_HE:
+            relations.append(f"{PILLAR_NAMES[i]}干{PILLAR_NAMES[j]}干{pair}合（化{GAN_HE[pair]}）")
+    for i, j in _pairs(zhis):
+        a, b = zhis[i], zhis[j]
+        where = f"{PILLAR_NAMES[i]}支{PILLAR_NAMES[j]}支"
+        if a + b in ZHI_LIU_HE or b + a in ZHI_LIU_HE:
+            relations.append(f"{where}{a}{b}六合")
+        if abs(ZHIS.index(a) - ZHIS.index(b)) == 6:
+            relations.append(f"{where}{a}{b}相冲")
+        if a + b in ZHI_XING or b + a in ZHI_XING or (a == b and a in ZHI_SELF_XING):
+            relations.append(f"{where}{a}{b}{'自刑' if a == b else '相刑'}")
+        if a + b in ZHI_HAI or b + a in ZHI_HAI:
+            relations.append(f"{where}{a}{b}相害")
+    for members, element in ZHI_SAN_HE:
+        present = [zhi for zhi in members if zhi in zhis]
+        if len(present) == 3:
+            relations.append(f"{members}三合{element}局")
+        elif len(present) == 2 and members[1] in present:
+            relations.append(f"{''.join(present)}半合{element}局")
+    return relations
+
+def _shens(gans, zhis):
+    """神煞{名称: [所在的柱]}"""
+    me = gans[2]
+    found = {}
+
+    def add(name, zhi_set, skip=()):
+        places = [PILLAR_NAMES[i] for i, zhi in enumerate(zhis) if zhi in zhi_set and i not in skip]
+        if places:
+            found.setdefault(name, [])
+            found[name].extend(place for place in places if place not in found[name])
+
+    add("天乙贵人", TIAN_YI[me])
+    add("文昌", WEN_CHANG[me])
+    add("禄神", LU_SHEN[me])
+    if me in YANG_REN:
+        add("羊刃", YANG_REN[me])
+    # 以年支和日支起算，不算起算的那一支自身
+    for base in (0, 2):
+        for members, shens in SAN_HE_SHENS.items():
+            if zhis[base] in members:
+                for name, zhi in shens.items():
+                    add(name, zhi, skip=(base,))
+    return found
+
+def _ge(gans, zhis):
+    """格局：月令藏干透出天干者取透出的十神，都不透取本气；比肩为建禄格，阳干劫财为阳刃格"""
+    me = gans[2]
+    stems = [stem for stem, _ in hidden_stems(zhis[1])]
+    transparent = [stem for stem in stems if stem in (gans[0], gans[1], gans[3])]
+    god = ten_god(me, (transparent or stems)[0])
+    if god == "比肩":
+        return "建禄格"
+    if god == "劫财":
+        return "阳刃格" if GANS.index(me) % 2 == 0 else "月劫格"
+    return f"{god}格"
+
+def compute_facts(bazi):
+    """计算命盘要点，返回dict；八字格式不对时返回None"""
+    parsed = parse_bazi(bazi)
+    if parsed is None:
+        return None
+    gans, zhis = parsed
+    me = gans[2]
+
+    scores = dict((element, 0) for element in "金木水火土")
+    gan_scores = dict((gan, 0) for gan in GANS)
+    for gan in gans:
+        scores[LunarUtil.WU_XING_GAN[gan]] += 5
+        gan_scores[gan] += 5
+    for zhi in zhis + [zhis[1]]:
+        for stem, weight in hidden_stems(zhi):
+            scores[LunarUtil.WU_XING_GAN[stem]] += weight
+            gan_scores[stem] += weight
+
+    strong = sum(score for gan, score in gan_scores.items()
+                 if ten_god(me, gan) in ("比肩", "劫财", "正印", "偏印"))
+    me_status = [chang_sheng(me, zhi) for zhi in zhis]
+    zhi_shens = [ten_god(me, hidden_stems(zhi)[0][0]) for zhi in zhis]
+    gan_shens = [ten_god(me, gan) if index != 2 else "日主" for index, gan in enumerate(gans)]
+    # 没有长生、帝旺、临官时，比肩与墓库合计超过2个也算有根
+    rooted = any(status in ("长生", "帝旺", "临官") for status in me_status) or \
+        (gan_shens + zhi_shens).count("比肩") + me_status.count("墓") > 2
+
+    return {
+        "me": me,
+        "me_element": LunarUtil.WU_XING_GAN[me],
+        "month_zhi": zhis[1],
+        "scores": scores,
+        "gan_scores": dict((gan, score) for gan, score in gan_scores.items() if score),
+        "strong": strong,
+        "is_strong": strong >= STRONG_MEDIAN,
+        "weak": not rooted,
+        "me_status": me_status,
+        "gan_shens": gan_shens,
+        "zhi_shens": zhi_shens,
+        "hidden": [[(stem, ten_god(me, stem)) for stem, _ in hidden_stems(zhi)] for zhi in zhis],
+        "ge": _ge(gans, zhis),
+        "shens": _shens(gans, zhis),
+        "relations": _relations(gans, zhis)
+    }
+
+def format_facts(facts):
+    """把命盘要点排成提示词段落，没有要点时返回空字符串"""
+    if not facts:
+        return ""
+    ranked = sorted(facts["scores"].items(), key=lambda item: -item[1])
+    lines = [
+        "命盘要点（由排盘程序算出，请直接采用，不必重新推算）：",
+        f"- 日主：{facts['me']}{facts['me_element']}，生于{facts['month_zhi']}月；"
+        f"强弱值{facts['strong']}（中值{STRONG_MEDIAN}），{'身强' if facts['is_strong'] else '身弱'}；"
+        f"强根：{'无' if facts['weak'] else '有'}",
+        "- 五行分数：" + " ".join(f"{element}{score}" for element, score in ranked)
+        + f"（最旺{ranked[0][0]}，最弱{ranked[-1][0]}）",
+        "- 天干分数：" + " ".join(f"{gan}{score}" for gan, score in facts["gan_scores"].items()),
+        "- 天干十神：" + " ".join(f"{PILLAR_NAMES[i]}干{god}" for i, god in enumerate(facts["gan_shens"]) if i != 2),
+        "- 地支藏干：" + " ".join(
+            f"{PILLAR_NAMES[i]}支" + "/".join(f"{stem}{god}" for stem, god in hidden)
+            for i, hidden in enumerate(facts["hidden"])
+        ),
+        "- 日主十二长生：" + " ".join(f"{PILLAR_NAMES[i]}支{status}" for i, status in enumerate(facts["me_status"])),
+        f"- 格局：{facts['ge']}",
+        "- 神煞：" + ("；".join(f"{name}（{''.join(places)}柱）" for name, places in facts["shens"].items()) or "无"),
+        "- 干支关系：" + ("；".join(facts["relations"]) or "无"),
+    ]
+    return "\n".join(lines)
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# 合并生成：一次上游调用写出多个报告部分，再按分隔标记拆回各部分
+#
+# 分开调用时，每个提示词都要重复发送命盘和大段写作要求，输入token和往返开销都是三份；
+# 合并后命盘只发送一次。输出用单独成行的分隔标记区分各部分，比让模型输出JSON更稳：
+# 长篇中文Markdown放进JSON字符串容易出现未转义的引号和换行，被截断时整段都无法解析。
+
+import json
+import re
+
+from prompts import CHART_TEMPLATE
+
+# 各部分之前单独成行的分隔标记，全部写完后以END标记结束
+SECTION_MARKER = "=====【{section}】====="
+END_SECTION = "END"
+
+# 识别分隔标记：容忍模型加上的Markdown标题、加粗、引用符号、空格，
+# 以及全角/半角括号和等号个数的差异
+MARKER_PATTERN = re.compile(
+    r"^[ \t>#*`_]*[=＝]{2,}\s*[【\[]?\s*([A-Za-z_]+)\s*[】\]]?\s*[=＝]{2,}[ \t*`_]*$",
+    re.M
+)
+
+def build_combined_prompt(instructions, bazi, sections, context=""):
+    """把多个部分的写作要求合并为一个提示词，每个部分的要求前注明其分隔标记
+
+    与单个部分的提示词一样，不变的说明和写作要求在前，命盘相关的上下文和命盘只出现一次并放在末尾，
+    生成同样几个部分的请求之间共享可被上游缓存的前缀。
+    """
+    parts = [
+        f"请依次撰写以下{len(sections)}个模块。每个模块开头单独一行写出该模块的分隔标记，"
+        f"全部写完后单独一行写出{SECTION_MARKER.format(section=END_SECTION)}。"
+        "分隔标记必须原样输出，不要输出JSON或其他说明。\n"
+    ]
+    for index, section in enumerate(sections, 1):
+        parts.append(
+            f"\n模块{index}，分隔标记：{SECTION_MARKER.format(section=section)}\n"
+            f"{instructions[section].strip()}\n"
+        )
+    if context:
+        parts.append(f"\n{context}\n")
+    parts.append(f"\n{CHART_TEMPLATE.format(bazi=bazi)}")
+    return "".join(parts)
+
+def split_sections(text, sections):
+    """把合并生成的输出拆回各部分，返回{部分: 内容}，只包含完整拆出的部分
+
+    按分隔标记切分；同一部分出现多次时取第一段非空内容。
+    最后一个部分之后没有END标记时视为输出被截断，丢弃该部分。
+    找不到任何分隔标记时，尝试按JSON对象（可带```json代码块）解析。
+    """
+    if not text:
+        return {}
+    wanted = dict((section.lower(), section) for section in sections)
+    matches = list(MARKER_PATTERN.finditer(text))
+    if not matches:
+        return _split_json(text, sections)
+
+    result = {}
+    for index, match in enumerate(matches):
+        name = match.group(1).lower()
+        if index + 1 >= len(matches):
+            # 最后一个标记之后没有END，内容可能不完整
+            break
+        section = wanted.get(name)
+        if section is None or section in result:
+            continue
+        content = text[match.end():matches[index + 1].start()].strip()
+        if content:
+            result[section] = content
+    return result
+
+def _split_json(text, sections):
+    body = text.strip()
+    fenced = re.match(r"^```(?:json)?\s*(.*?)\s*```$", body, re.S)
+    if fenced:
+        body = fenced.group(1)
+    try:
+        data = json.loads(body)
+    except ValueError:
+        return {}
+    if not isinstance(data, dict):
+        return {}
+    return dict(
+        (section, data[section].strip())
+        for section in sections
+        if isinstance(data.get(section), str) and data[section].strip()
+    )
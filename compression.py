@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# 报告内容的zstd字典压缩：用已有报告训练字典，写入缓存时压缩，读取时按帧头中的字典ID透明解压
+#
+# 单个报告部分只有几KB，单独压缩时压缩器来不及学到重复的内容；但不同命盘的报告共用大量措辞，
+# 如固定的小标题【日主解读 · 我的内在之光】、五行和十神的术语。把这些共有的片段训练成字典后，
+# 每个条目只需记录与字典不同的部分，压缩率比不带字典高得多。
+#
+# 压缩后的条目以BLOB存放，未压缩的条目仍是TEXT，两者可以混存：旧条目照常读取，新写入的才压缩。
+# 字典保存在报告缓存同一个SQLite文件的report_dicts表中，多个worker共用；
+# zstd帧头带有字典ID，用哪个字典压缩的条目就用哪个字典解压，重新训练字典后旧条目仍可读取。
+# zstandard是可选依赖，未安装时不压缩，已压缩的条目读不出来，按未命中处理。
+
+import logging
+import threading
+import time
+
+from db import get_connection
+
+logger = logging.getLogger(__name__)
+
+try:
+    import zstandard
+except ImportError:  # 未安装zstandard时报告按原文存储
+    zstandard = None
+
+# 压缩级别：报告生成一次要几十秒，写入时多花一两毫秒换更高的压缩率是值得的，解压速度与级别基本无关
+ZSTD_LEVEL = 9
+# 字典大小上限（字节）
+DICT_SIZE = 64 * 1024
+# 至少有多少个条目才训练字典，样本太少时训练出的字典没有代表性
+MIN_TRAIN_SAMPLES = 200
+# 训练时最多取多少个条目作为样本
+MAX_TRAIN_SAMPLES = 2000
+
+class ReportCodec(object):
+    """报告内容的编解码：encode把文本压缩为bytes（不压缩时原样返回），decode把存储的值还原为文本
+
+    压缩器和解压器不是线程安全的，每个线程各持有一份，按字典ID区分。
+    """
+
+    def __init__(self, path, enabled=True, level=ZSTD_LEVEL):
+        self.path = path
+        self.enabled = enabled and zstandard is not None
+        self.level = level
+        self.dict_id = 0  # 当前用于压缩的字典，0为尚未训练、不带字典压缩
+        self._dicts = {}
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        if enabled and zstandard is None:
+            logger.warning("未安装zstandard，报告缓存不压缩")
+        conn = get_connection(path)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS report_dicts (
+                dict_id INTEGER PRIMARY KEY,
+                data BLOB NOT NULL,
+                samples INTEGER NOT NULL,
+                created_at REAL NOT NULL
+            )
+        """)
+        if self.enabled:
+            self.load_latest()
+
+    def load_latest(self):
+        """改用最近训练的字典压缩，返回其字典ID（没有字典时为0）"""
+        row = get_connection(self.path).execute(
+            "SELECT dict_id FROM report_dicts ORDER BY created_at DESC LIMIT 1"
+        ).fetchone()
+        if row is not None and self._dictionary(row[0]) is not None:
+            self.dict_id = row[0]
+        return self.dict_id
+
+    def _dictionary(self, dict_id):
+        with self._lock:
+            dictionary = self._dicts.get(dict_id)
+        if dictionary is not None:
+            return dictionary
+        row = get_connection(self.path).execute(
+            "SELECT data FROM report_dicts WHERE dict_id = ?", (dict_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        dictionary = zstandard.ZstdCompressionDict(bytes(row[0]))
+        with self._lock:
+            self._dicts[dict_id] = dictionary
+        return dictionary
+
+    def _compressor(self):
+        compressors = getattr(self._local, 'compressors', None)
+        if compressors is None:
+            compressors = self._local.compressors = {}
+        dict_id = self.dict_id
+        compressor = compressors.get(dict_id)
+        if compressor is None:
+            if dict_id:
+                compressor = zstandard.ZstdCompressor(level=self.level, dict_data=self._dictionary(dict_id))
+            else:
+                compressor = zstandard.ZstdCompressor(level=self.level)
+            compressors[dict_id] = compressor
+        return compressor
+
+    def _decompressor(self, dict_id):
+        decompressors = getattr(self._local, 'decompressors', None)
+        if decompressors is None:
+            decompressors = self._local.decompressors = {}
+        decompressor = decompressors.get(dict_id)
+        if decompressor is None:
+            if dict_id:
+                dictionary = self._dictionary(dict_id)
+                if dictionary is None:
+                    raise ValueError(f"找不到压缩字典{dict_id}")
+                decompressor = zstandard.ZstdDecompressor(dict_data=dictionary)
+            else:
+                decompressor = zstandard.ZstdDecompressor()
+            decompressors[dict_id] = decompressor
+        return decompressor
+
+    def encode(self, text):
+        if not self.enabled:
+            return text
+        return self._compressor().compress(text.encode('utf-8'))
+
+    def decode(self, value):
+        """还原存储的值；压缩的条目无法解压（未安装zstandard或字典缺失）时抛出ValueError"""
+        if isinstance(value, str):
+            return value
+        if zstandard is None:
+            raise ValueError("报告缓存条目已压缩，但未安装zstandard")
+        value = bytes(value)
+        dict_id = zstandard.get_frame_parameters(value).dict_id
+        return self._decompressor(dict_id).decompress(value).decode('utf-8')
+
+    def is_current(self, value):
+        """存储的值是否已用当前字典压缩"""
+        if not self.enabled or isinstance(value, str):
+            return not self.enabled
+        return zstandard.get_frame_parameters(bytes(value)).dict_id == self.dict_id
+
+    def train(self, samples, dict_size=DICT_SIZE):
+        """用报告文本样本训练字典并保存，之后写入的条目改用该字典压缩；返回字典ID，未启用压缩或训练失败时返回0"""
+        if not self.enabled or not samples:
+            return 0
+        started = time.monotonic()
+        data = [sample.encode('utf-8') for sample in samples]
+        # 字典不应大于样本总量的十分之一，否则相当于把样本原样存进字典
+        size = min(dict_size, sum(len(sample) for sample in data) // 10)
+        try:
+            dictionary = zstandard.train_dictionary(size, data, level=self.level)
+        except zstandard.ZstdError as e:
+            logger.warning(f"训练报告压缩字典失败: {e}")
+            return 0
+        dict_id = dictionary.dict_id()
+        get_connection(self.path).execute(
+            "INSERT OR REPLACE INTO report_dicts (dict_id, data, samples, created_at) VALUES (?, ?, ?, ?)",
+            (dict_id, dictionary.as_bytes(), len(samples), time.time())
+        )
+        with self._lock:
+            self._dicts[dict_id] = dictionary
+        self.dict_id = dict_id
+        logger.info(f"已用{len(samples)}个报告训练压缩字典{dict_id}（{len(dictionary.as_bytes())}字节），"
+                    f"用时{time.monotonic() - started:.2f}秒")
+        return dict_id
+
+    def snapshot(self):
+        return {"enabled": self.enabled, "dict_id": self.dict_id}
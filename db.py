@@ -0,0 +1,29 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# SQLite连接工具，供报告缓存等需要在多个gunicorn worker之间共享的数据使用
+
+import os
+import sqlite3
+import threading
+
+_local = threading.local()
+
+def get_connection(path):
+    """获取当前线程的SQLite连接（每个线程、每个数据库文件一个连接）
+
+    连接使用自动提交模式，需要原子操作时由调用方显式执行 BEGIN IMMEDIATE。
+    启用WAL日志，多个进程可以同时读、一个进程写而互不阻塞。
+    """
+    conns = getattr(_local, 'conns', None)
+    if conns is None:
+        conns = _local.conns = {}
+
+    conn = conns.get(path)
+    if conn is None:
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        conn = sqlite3.connect(path, timeout=30, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conns[path] = conn
+    return conn
@@ -0,0 +1,474 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# 报告生成任务队列：提交后立即返回任务ID，由后台线程执行，前端轮询进度
+#
+# 任务保存在SQLite中，多个gunicorn worker共享同一个队列；
+# 进程重启后，排队中的任务继续执行，心跳超时的运行中任务重新排队。
+# 领取任务时按客户端做差额轮询（DRR），单个客户端大量提交也不会挤占其他用户。
+# 后台任务（缓存预热、批量重新生成）只在没有用户任务排队时执行，且同时运行的数量有上限。
+
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+
+from db import get_connection
+from limiter import INTERACTIVE, BACKGROUND
+
+logger = logging.getLogger(__name__)
+
+class QueueFullError(Exception):
+    """该客户端排队中的任务已达上限"""
+
+class JobQueue(object):
+    """SQLite持久化的任务队列
+
+    每个任务属于一个客户端（如IP），cost为任务的预估开销（如需要调用上游的报告部分数）。
+    每个客户端最多client_max_queued个任务排队、client_max_running个任务同时运行；
+    提交过于频繁（heavy_window秒内超过heavy_client_jobs个）的客户端记为"heavy"类，
+    其余为"normal"类，后台任务为"background"类，按类统计排队等待时间。
+    后台任务不受单客户端排队上限限制，只在没有用户任务排队时领取，最多background_max_running个同时运行。
+    """
+
+    def __init__(self, path, stale_after=300, retention=86400, quantum=3,
+                 client_max_running=2, client_max_queued=5, heavy_client_jobs=10, heavy_window=600,
+                 background_max_running=1):
+        self.path = path
+        self.stale_after = stale_after  # 运行中任务超过该时间没有心跳即视为执行者已崩溃
+        self.retention = retention      # 已结束任务的保留时间
+        self.quantum = quantum          # 每轮为客户端增加的额度，不小于单个任务的最大cost
+        self.client_max_running = client_max_running
+        self.client_max_queued = client_max_queued
+        self.heavy_client_jobs = heavy_client_jobs
+        self.heavy_window = heavy_window
+        self.background_max_running = background_max_running
+        conn = get_connection(path)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                status TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                bazi_info TEXT,
+                error TEXT,
+                owner TEXT,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                created_at REAL NOT NULL,
+                started_at REAL,
+                heartbeat_at REAL,
+                finished_at REAL
+            )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status, created_at)")
+        # 旧版本创建的表没有客户端相关的列
+        columns = set(row[1] for row in conn.execute("PRAGMA table_info(jobs)"))
+        for column, definition in (("client", "TEXT NOT NULL DEFAULT ''"),
+                                   ("client_class", "TEXT NOT NULL DEFAULT 'normal'"),
+                                   ("cost", "REAL NOT NULL DEFAULT 1"),
+                                   ("priority", "TEXT NOT NULL DEFAULT 'interactive'")):
+            if column not in columns:
+                conn.execute(f"ALTER TABLE jobs ADD COLUMN {column} {definition}")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_client ON jobs (client, status)")
+        # 每个客户端的DRR额度和最近一次被调度的时间
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS job_clients (
+                client TEXT PRIMARY KEY,
+                deficit REAL NOT NULL,
+                served_at REAL NOT NULL
+            )
+        """)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS job_sections (
+                job_id TEXT NOT NULL,
+                section TEXT NOT NULL,
+                content TEXT NOT NULL,
+                PRIMARY KEY (job_id, section)
+            )
+        """)
+
+    def submit(self, payload, client="", cost=1, priority=INTERACTIVE):
+        """提交任务并返回任务ID，该客户端排队的任务已达上限时抛出QueueFullError"""
+        job_id = uuid.uuid4().hex
+        conn = get_connection(self.path)
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if priority == BACKGROUND:
+                client_class = BACKGROUND
+            else:
+                queued = conn.execute(
+                    "SELECT COUNT(*) FROM jobs WHERE client = ? AND status = 'queued'", (client,)
+                ).fetchone()[0]
+                if queued >= self.client_max_queued:
+                    conn.execute("ROLLBACK")
+                    raise QueueFullError(f"客户端{client}已有{queued}个任务在排队")
+                recent = conn.execute(
+                    "SELECT COUNT(*) FROM jobs WHERE client = ? AND created_at > ?", (client, now - self.heavy_window)
+                ).fetchone()[0]
+                client_class = "heavy" if recent >= self.heavy_client_jobs else "normal"
+            conn.execute(
+                "INSERT INTO jobs (id, status, payload, client, client_class, cost, priority, created_at) "
+                "VALUES (?, 'queued', ?, ?, ?, ?, ?, ?)",
+                (job_id, json.dumps(payload, ensure_ascii=False), client, client_class, cost, priority, now)
+            )
+            conn.execute("COMMIT")
+        except QueueFullError:
+            raise
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return job_id
+
+    def submit_limited(self, payload, client, limit, window=60, cost=1, priority=BACKGROUND):
+        """提交任务并返回任务ID，以下情况不提交并返回None：
+        该客户端已有相同载荷的任务在排队或运行，或window秒内已提交了limit个任务。
+        检查与插入在同一事务内完成，多个worker同时提交时也不会超过上限。
+        """
+        job_id = uuid.uuid4().hex
+        body = json.dumps(payload, ensure_ascii=False)
+        conn = get_connection(self.path)
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            pending = conn.execute(
+                "SELECT 1 FROM jobs WHERE client = ? AND payload = ? AND status IN ('queued', 'running') LIMIT 1",
+                (client, body)
+            ).fetchone()
+            recent = conn.execute(
+                "SELECT COUNT(*) FROM jobs WHERE client = ? AND created_at > ?", (client, now - window)
+            ).fetchone()[0]
+            if pending is not None or recent >= limit:
+                conn.execute("ROLLBACK")
+                return None
+            conn.execute(
+                "INSERT INTO jobs (id, status, payload, client, client_class, cost, priority, created_at) "
+                "VALUES (?, 'queued', ?, ?, ?, ?, ?, ?)",
+                (job_id, body, client, BACKGROUND if priority == BACKGROUND else "normal", cost, priority, now)
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return job_id
+
+    def start_stream(self, payload, client=""):
+        """登记一个流式请求并返回其ID，该客户端运行中的任务和流式请求已达client_max_running时抛出QueueFullError
+
+        流式请求不经队列执行，但以'streaming'状态记入任务表：与运行中的任务一起计入该客户端的并发上限，
+        领取任务时该客户端也会因此少拿执行线程。请求结束时调用finish_stream；
+        进程崩溃留下的记录在stale_after秒后由claim标记为失败。
+        """
+        stream_id = uuid.uuid4().hex
+        conn = get_connection(self.path)
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            active = conn.execute(
+                "SELECT COUNT(*) FROM jobs WHERE client = ? AND status IN ('running', 'streaming')", (client,)
+            ).fetchone()[0]
+            if active >= self.client_max_running:
+                conn.execute("ROLLBACK")
+                raise QueueFullError(f"客户端{client}已有{active}个报告正在生成")
+            recent = conn.execute(
+                "SELECT COUNT(*) FROM jobs WHERE client = ? AND created_at > ?", (client, now - self.heavy_window)
+            ).fetchone()[0]
+            conn.execute(
+                "INSERT INTO jobs (id, status, payload, client, client_class, cost, priority, created_at, heartbeat_at) "
+                "VALUES (?, 'streaming', ?, ?, ?, ?, ?, ?, ?)",
+                (stream_id, json.dumps(payload, ensure_ascii=False), client,
+                 "heavy" if recent >= self.heavy_client_jobs else "normal", 0, INTERACTIVE, now, now)
+            )
+            conn.execute("COMMIT")
+        except QueueFullError:
+            raise
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return stream_id
+
+    def finish_stream(self, stream_id):
+        get_connection(self.path).execute(
+            "UPDATE jobs SET status = 'done', finished_at = ? WHERE id = ? AND status = 'streaming'",
+            (time.time(), stream_id)
+        )
+
+    def claim(self, owner):
+        """按客户端做差额轮询（DRR），原子地领取下一个任务，没有可执行的任务时返回None
+
+        轮到一个客户端时为其增加quantum的额度，额度够支付队首任务的cost就执行它，
+        额度有剩余时下次继续服务该客户端；运行中任务已达上限的客户端本轮跳过。
+        有用户任务排队时只在用户任务中选择，后台任务等到用户任务全部领取后才执行。
+        """
+        conn = get_connection(self.path)
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # 执行者崩溃留下的任务重新排队
+            conn.execute(
+                "UPDATE jobs SET status = 'queued', owner = NULL "
+                "WHERE status = 'running' AND heartbeat_at < ?",
+                (now - self.stale_after,)
+            )
+            # 进程崩溃时未结束的流式请求不再计入客户端的并发
+            conn.execute(
+                "UPDATE jobs SET status = 'failed', error = '流式请求未正常结束', finished_at = ? "
+                "WHERE status = 'streaming' AND heartbeat_at < ?",
+                (now, now - self.stale_after)
+            )
+            job = self._pick(conn, now)
+            if job is None:
+                conn.execute("COMMIT")
+                return None
+            conn.execute(
+                "UPDATE jobs SET status = 'running', owner = ?, attempts = attempts + 1, "
+                "started_at = ?, heartbeat_at = ? WHERE id = ?",
+                (owner, now, now, job["id"])
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return job
+
+    def _pick(self, conn, now):
+        # 先看用户任务；没有用户任务排队时，在后台任务运行数未达上限的前提下领取后台任务
+        priority = INTERACTIVE
+        if conn.execute(
+            "SELECT 1 FROM jobs WHERE status = 'queued' AND priority = ? LIMIT 1", (INTERACTIVE,)
+        ).fetchone() is None:
+            priority = BACKGROUND
+            running_background = conn.execute(
+                "SELECT COUNT(*) FROM jobs WHERE status = 'running' AND priority = ?", (BACKGROUND,)
+            ).fetchone()[0]
+            if running_background >= self.background_max_running:
+                return None
+
+        # 每个客户端最早排队的任务，以及排队数
+        heads = {}
+        queued = {}
+        for job_id, payload, client, cost in conn.execute(
+            "SELECT id, payload, client, cost FROM jobs WHERE status = 'queued' AND priority = ? ORDER BY created_at",
+            (priority,)
+        ):
+            queued[client] = queued.get(client, 0) + 1
+            if client not in heads:
+                heads[client] = {"id": job_id, "payload": json.loads(payload), "cost": cost}
+        if not heads:
+            return None
+
+        running = dict(conn.execute(
+            "SELECT client, COUNT(*) FROM jobs WHERE status IN ('running', 'streaming') GROUP BY client"
+        ).fetchall())
+        eligible = [client for client in heads if running.get(client, 0) < self.client_max_running]
+        if not eligible:
+            return None
+
+        state = dict((row[0], [row[1], row[2]]) for row in conn.execute(
+            "SELECT client, deficit, served_at FROM job_clients"
+        ))
+        for client in eligible:
+            state.setdefault(client, [0.0, 0.0])
+
+        # 上次服务的客户端额度仍够支付队首任务时继续服务它，否则按最久未服务的顺序轮转并补充额度
+        last = max(state, key=lambda client: state[client][1])
+        if last in eligible and state[last][1] > 0 and state[last][0] >= heads[last]["cost"]:
+            chosen = last
+        else:
+            ring = sorted(eligible, key=lambda client: state[client][1])
+            chosen = None
+            while chosen is None:
+                for client in ring:
+                    state[client][0] += self.quantum
+                    if state[client][0] >= heads[client]["cost"]:
+                        chosen = client
+                        break
+
+        deficit = state[chosen][0] - heads[chosen]["cost"]
+        if queued[chosen] <= 1:
+            deficit = 0.0  # 队列清空的客户端不保留额度
+        state[chosen] = [deficit, now]
+        conn.executemany(
+            "INSERT OR REPLACE INTO job_clients (client, deficit, served_at) VALUES (?, ?, ?)",
+            [(client, values[0], values[1]) for client, values in state.items() if client in eligible]
+        )
+        job = heads[chosen]
+        return {"id": job["id"], "payload": job["payload"], "priority": priority}
+
+    def heartbeat(self, job_ids):
+        if not job_ids:
+            return
+        conn = get_connection(self.path)
+        now = time.time()
+        conn.executemany("UPDATE jobs SET heartbeat_at = ? WHERE id = ?", [(now, job_id) for job_id in job_ids])
+
+    def set_bazi_info(self, job_id, bazi_info):
+        get_connection(self.path).execute(
+            "UPDATE jobs SET bazi_info = ? WHERE id = ?",
+            (json.dumps(bazi_info, ensure_ascii=False), job_id)
+        )
+
+    def set_section(self, job_id, section, content):
+        get_connection(self.path).execute(
+            "INSERT OR REPLACE INTO job_sections (job_id, section, content) VALUES (?, ?, ?)",
+            (job_id, section, content)
+        )
+
+    def finish(self, job_id):
+        get_connection(self.path).execute(
+            "UPDATE jobs SET status = 'done', finished_at = ? WHERE id = ?", (time.time(), job_id)
+        )
+
+    def fail(self, job_id, error):
+        get_connection(self.path).execute(
+            "UPDATE jobs SET status = 'failed', error = ?, finished_at = ? WHERE id = ?",
+            (error, time.time(), job_id)
+        )
+
+    def cancel(self, job_id, error="任务已取消"):
+        """取消仍在排队的任务，已开始运行的任务不受影响"""
+        get_connection(self.path).execute(
+            "UPDATE jobs SET status = 'failed', error = ?, finished_at = ? WHERE id = ? AND status = 'queued'",
+            (error, time.time(), job_id)
+        )
+
+    def get(self, job_id):
+        """返回任务状态、排队位置和已完成的部分，任务不存在时返回None"""
+        conn = get_connection(self.path)
+        row = conn.execute(
+            "SELECT status, bazi_info, error, created_at FROM jobs WHERE id = ?", (job_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        status, bazi_info, error, created_at = row
+
+        queue_position = None
+        if status == 'queued':
+            queue_position = conn.execute(
+                "SELECT COUNT(*) FROM jobs WHERE status = 'queued' AND created_at < ?", (created_at,)
+            ).fetchone()[0]
+
+        sections = dict(conn.execute(
+            "SELECT section, content FROM job_sections WHERE job_id = ?", (job_id,)
+        ).fetchall())
+        return {
+            "id": job_id,
+            "status": status,
+            "queue_position": queue_position,
+            "bazi_info": json.loads(bazi_info) if bazi_info else None,
+            "sections": sections,
+            "error": error
+        }
+
+    def purge(self):
+        """删除超过保留时间的已结束任务"""
+        conn = get_connection(self.path)
+        cutoff = time.time() - self.retention
+        conn.execute(
+            "DELETE FROM job_sections WHERE job_id IN "
+            "(SELECT id FROM jobs WHERE status IN ('done', 'failed') AND finished_at < ?)",
+            (cutoff,)
+        )
+        conn.execute("DELETE FROM jobs WHERE status IN ('done', 'failed') AND finished_at < ?", (cutoff,))
+        conn.execute(
+            "DELETE FROM job_clients WHERE served_at < ? AND client NOT IN "
+            "(SELECT client FROM jobs WHERE status = 'queued')",
+            (cutoff,)
+        )
+
+    def wait_stats(self, window=3600):
+        """最近window秒内开始执行的任务，按客户端类别统计排队等待时间（秒）"""
+        rows = get_connection(self.path).execute(
+            "SELECT client_class, started_at - created_at FROM jobs WHERE started_at > ?",
+            (time.time() - window,)
+        ).fetchall()
+        waits = {}
+        for client_class, wait in rows:
+            waits.setdefault(client_class, []).append(wait)
+        stats = {}
+        for client_class, values in waits.items():
+            values.sort()
+            stats[client_class] = {
+                "jobs": len(values),
+                "wait_p50": round(values[int(round(0.5 * (len(values) - 1)))], 3),
+                "wait_p95": round(values[int(round(0.95 * (len(values) - 1)))], 3),
+                "wait_max": round(values[-1], 3)
+            }
+        return stats
+
+class JobRunner(object):
+    """在后台线程中领取并执行任务
+
+    handler(job)执行任务本身，抛出异常时任务记为失败。
+    """
+
+    def __init__(self, queue, handler, workers=2, poll_interval=0.5, heartbeat_interval=30):
+        self.queue = queue
+        self.handler = handler
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.heartbeat_interval = heartbeat_interval
+        self.owner = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self._running = set()
+        self._lock = threading.Lock()
+        self._started = False
+
+    def start(self):
+        """启动执行线程（幂等）"""
+        with self._lock:
+            if self._started or self.workers <= 0:
+                return
+            self._started = True
+        for i in range(self.workers):
+            threading.Thread(target=self._work_loop, name=f"job-worker-{i}", daemon=True).start()
+        threading.Thread(target=self._heartbeat_loop, name="job-heartbeat", daemon=True).start()
+        logger.info(f"任务执行线程已启动: {self.workers}个, owner={self.owner}")
+
+    def _work_loop(self):
+        idle_rounds = 0
+        while True:
+            try:
+                job = self.queue.claim(self.owner)
+            except Exception as e:
+                logger.error(f"领取任务出错: {e}")
+                job = None
+
+            if job is None:
+                idle_rounds += 1
+                # 空闲时顺带清理过期任务
+                if idle_rounds % 1000 == 0:
+                    try:
+                        self.queue.purge()
+                    except Exception as e:
+                        logger.error(f"清理过期任务出错: {e}")
+                time.sleep(self.poll_interval)
+                continue
+
+            idle_rounds = 0
+            self._execute(job)
+
+    def _execute(self, job):
+        job_id = job["id"]
+        with self._lock:
+            self._running.add(job_id)
+        try:
+            logger.info(f"开始执行任务: {job_id}")
+            self.handler(job)
+            self.queue.finish(job_id)
+            logger.info(f"任务执行完成: {job_id}")
+        except Exception as e:
+            logger.error(f"任务执行失败 {job_id}: {e}")
+            self.queue.fail(job_id, str(e))
+        finally:
+            with self._lock:
+                self._running.discard(job_id)
+
+    def _heartbeat_loop(self):
+        while True:
+            time.sleep(self.heartbeat_interval)
+            with self._lock:
+                running = list(self._running)
+            try:
+                self.queue.heartbeat(running)
+            except Exception as e:
+                logger.error(f"更新任务心跳出错: {e}")
@@ -0,0 +1,323 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# 上游准入控制：令牌桶限制发起速率，AIMD并发窗口限制同时在途的调用数
+#
+# 状态保存在SQLite中，同一台机器上的所有gunicorn worker共享同一个窗口和令牌桶。
+# 上游返回429或响应变慢时窗口按比例缩小，调用顺利时窗口缓慢增大（加性增、乘性减），
+# 拿不到许可的调用在有界的等待队列里排队，超出等待预算时立即以"繁忙"失败，不再进入重试流程。
+#
+# 调用分为两个优先级：interactive（用户正在等待的请求）和background（缓存预热、批量重新生成等）。
+# 任一worker中有interactive调用在等待时，background一律让路；background只使用窗口中的空闲部分，
+# 始终为interactive留出一部分并发。
+
+import logging
+import threading
+import time
+import uuid
+
+from db import get_connection
+from resilience import UpstreamError
+
+logger = logging.getLogger(__name__)
+
+INTERACTIVE = "interactive"
+BACKGROUND = "background"
+PRIORITIES = (INTERACTIVE, BACKGROUND)
+
+class UpstreamBusyError(UpstreamError):
+    """上游并发已满且等待超出预算，调用未发出"""
+
+class Permit(object):
+    """一次上游调用的许可，用with语句持有，退出时归还并按结果调整窗口
+
+    拿到响应头时调用responded()记录延迟，成功时调用succeeded()，遇到429时调用throttled()。
+    """
+
+    def __init__(self, limiter, slot_id, priority=INTERACTIVE):
+        self.limiter = limiter
+        self.slot_id = slot_id
+        self.priority = priority
+        self.acquired_at = time.monotonic()
+        self.latency = None
+        self.outcome = "error"
+
+    def responded(self):
+        if self.latency is None:
+            self.latency = time.monotonic() - self.acquired_at
+
+    def succeeded(self):
+        self.outcome = "ok"
+
+    def throttled(self):
+        self.outcome = "throttled"
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            self.limiter.release(self)
+        except Exception as e:
+            # 归还失败时许可会在slot_ttl后过期，不影响调用结果
+            logger.error(f"归还{self.limiter.name}调用许可出错: {e}")
+        return False
+
+class AdaptiveLimiter(object):
+    """跨worker共享的上游调用限制器
+
+    rate/burst：令牌桶的每秒补充量和容量，限制发起调用的速率；
+    window：同时在途调用数的上限，在min_window与max_window之间按AIMD调整——
+    每次成功增加1/window（约每一窗口的调用增加1），遇到429乘以decrease_factor，
+    首字节延迟超过latency_target乘以latency_factor；两次缩小至少间隔decrease_interval秒，
+    避免同一批并发调用的429把窗口连续压到最低。
+    background调用只在没有interactive调用等待、且在途调用数低于窗口减去预留
+    （窗口的background_reserve，至少1个；减去后至少仍有1个）时放行，令牌桶同样为interactive保留这一比例；
+    background可以等待更久（background_max_wait秒）。
+    等待中的调用只做只读检查，判断能放行时才开启写事务取许可。
+    """
+
+    def __init__(self, name, path, rate=5.0, burst=10.0, initial_window=8, min_window=1, max_window=32,
+                 decrease_factor=0.5, latency_target=20.0, latency_factor=0.9, decrease_interval=2.0,
+                 max_waiters=32, max_wait=10.0, poll_interval=0.1, max_poll_interval=0.8, slot_ttl=300,
+                 background_reserve=0.25, background_max_wait=60.0):
+        self.name = name
+        self.path = path
+        self.rate = rate
+        self.burst = burst
+        self.min_window = min_window
+        self.max_window = max_window
+        self.decrease_factor = decrease_factor
+        self.latency_target = latency_target
+        self.latency_factor = latency_factor
+        self.decrease_interval = decrease_interval
+        self.max_waiters = max_waiters
+        self.max_wait = max_wait
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.slot_ttl = slot_ttl  # 持有许可的worker崩溃时，许可在该时间后自动失效
+        self.background_reserve = background_reserve
+        self.background_max_wait = background_max_wait
+
+        # 按优先级分别统计
+        self.waiters = dict((priority, 0) for priority in PRIORITIES)
+        self.admitted = dict((priority, 0) for priority in PRIORITIES)
+        self.waited = dict((priority, 0) for priority in PRIORITIES)
+        self.wait_seconds = dict((priority, 0.0) for priority in PRIORITIES)
+        self.rejected = dict((priority, 0) for priority in PRIORITIES)
+        self.throttled = 0
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+
+        conn = get_connection(path)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS limiter_state (
+                name TEXT PRIMARY KEY,
+                window REAL NOT NULL,
+                tokens REAL NOT NULL,
+                updated_at REAL NOT NULL,
+                decreased_at REAL NOT NULL
+            )
+        """)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS limiter_slots (
+                id TEXT PRIMARY KEY,
+                name TEXT NOT NULL,
+                expires_at REAL NOT NULL
+            )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_limiter_slots_name ON limiter_slots (name, expires_at)")
+        # 正在等待许可的interactive调用，background据此让路
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS limiter_demand (
+                id TEXT PRIMARY KEY,
+                name TEXT NOT NULL,
+                expires_at REAL NOT NULL
+            )
+        """)
+        conn.execute(
+            "INSERT OR IGNORE INTO limiter_state (name, window, tokens, updated_at, decreased_at) VALUES (?, ?, ?, ?, 0)",
+            (name, float(initial_window), float(burst), time.time())
+        )
+
+    def acquire(self, timeout=None, priority=INTERACTIVE):
+        """获取调用许可，interactive最多等待min(timeout, max_wait)秒，background最多等待min(timeout, background_max_wait)秒
+
+        等待队列已满或等待超时时抛出UpstreamBusyError。
+        """
+        limit = self.max_wait if priority == INTERACTIVE else self.background_max_wait
+        wait = limit if timeout is None else max(min(timeout, limit), 0.0)
+        with self._lock:
+            if self.waiters[priority] >= self.max_waiters:
+                self.rejected[priority] += 1
+                raise UpstreamBusyError(f"{self.name}等待队列已满（{self.max_waiters}个），请稍后再试")
+            self.waiters[priority] += 1
+
+        started = time.monotonic()
+        delay = self.poll_interval
+        demand_id = None
+        try:
+            while True:
+                slot_id = self._try_acquire(priority)
+                if slot_id is not None:
+                    waited = time.monotonic() - started
+                    with self._lock:
+                        self.admitted[priority] += 1
+                        if waited >= self.poll_interval:
+                            self.waited[priority] += 1
+                            self.wait_seconds[priority] += waited
+                    return Permit(self, slot_id, priority)
+
+                remaining = wait - (time.monotonic() - started)
+                if remaining <= 0:
+                    with self._lock:
+                        self.rejected[priority] += 1
+                    raise UpstreamBusyError(f"{self.name}上游繁忙，等待{wait:.1f}秒仍未获得调用许可")
+                if priority == INTERACTIVE and demand_id is None:
+                    demand_id = self._register_demand(remaining)
+                # 本进程内有许可归还时会被唤醒，其他worker归还的许可靠轮询发现；
+                # 轮询间隔从poll_interval起按指数退避，最长max_poll_interval
+                with self._cond:
+                    self._cond.wait(min(delay, remaining))
+                delay = min(delay * 2, self.max_poll_interval)
+        finally:
+            if demand_id is not None:
+                self._clear_demand(demand_id)
+            with self._lock:
+                self.waiters[priority] -= 1
+
+    def _register_demand(self, wait):
+        demand_id = uuid.uuid4().hex
+        get_connection(self.path).execute(
+            "INSERT INTO limiter_demand (id, name, expires_at) VALUES (?, ?, ?)",
+            (demand_id, self.name, time.time() + wait + self.poll_interval)
+        )
+        return demand_id
+
+    def _clear_demand(self, demand_id):
+        try:
+            get_connection(self.path).execute("DELETE FROM limiter_demand WHERE id = ?", (demand_id,))
+        except Exception as e:
+            # 清理失败时记录会自行过期
+            logger.error(f"清理{self.name}等待记录出错: {e}")
+
+    def _refill(self, tokens, updated_at, now):
+        return min(self.burst, tokens + max(now - updated_at, 0.0) * self.rate)
+
+    def _check(self, conn, now, priority):
+        """按当前状态判断能否放行，返回(能否放行, 补充后的令牌数)；只读，过期的许可和等待记录按时间排除"""
+        window, tokens, updated_at = conn.execute(
+            "SELECT window, tokens, updated_at FROM limiter_state WHERE name = ?", (self.name,)
+        ).fetchone()
+        tokens = self._refill(tokens, updated_at, now)
+        in_flight = conn.execute(
+            "SELECT COUNT(*) FROM limiter_slots WHERE name = ? AND expires_at >= ?", (self.name, now)
+        ).fetchone()[0]
+
+        capacity = int(window)
+        min_tokens = 1.0
+        if priority == BACKGROUND:
+            demand = conn.execute(
+                "SELECT COUNT(*) FROM limiter_demand WHERE name = ? AND expires_at >= ?", (self.name, now)
+            ).fetchone()[0]
+            # 有interactive在等待时不放行；否则只用窗口和令牌桶中预留之外的空闲部分，
+            # 但至少可以有1个在途，窗口缩到1时background也不会永远拿不到许可
+            capacity = 0 if demand else max(1, capacity - max(1, int(window * self.background_reserve)))
+            min_tokens += self.burst * self.background_reserve
+        return in_flight < capacity and tokens >= min_tokens, tokens
+
+    def _try_acquire(self, priority=INTERACTIVE):
+        conn = get_connection(self.path)
+        # 先做只读检查，等待者轮询时不取写锁，不与同一个WAL文件中报告缓存和任务队列的写入争用
+        if not self._check(conn, time.time(), priority)[0]:
+            return None
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # 取得写锁后重新检查，其他worker可能刚刚取走了许可
+            now = time.time()
+            admissible, tokens = self._check(conn, now, priority)
+            slot_id = None
+            if admissible:
+                conn.execute("DELETE FROM limiter_slots WHERE name = ? AND expires_at < ?", (self.name, now))
+                conn.execute("DELETE FROM limiter_demand WHERE name = ? AND expires_at < ?", (self.name, now))
+                slot_id = uuid.uuid4().hex
+                conn.execute(
+                    "INSERT INTO limiter_slots (id, name, expires_at) VALUES (?, ?, ?)",
+                    (slot_id, self.name, now + self.slot_ttl)
+                )
+                conn.execute(
+                    "UPDATE limiter_state SET tokens = ?, updated_at = ? WHERE name = ?", (tokens - 1.0, now, self.name)
+                )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return slot_id
+
+    def release(self, permit):
+        """归还许可，并按调用结果调整并发窗口"""
+        conn = get_connection(self.path)
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("DELETE FROM limiter_slots WHERE id = ?", (permit.slot_id,))
+            window, tokens, updated_at, decreased_at = conn.execute(
+                "SELECT window, tokens, updated_at, decreased_at FROM limiter_state WHERE name = ?", (self.name,)
+            ).fetchone()
+            tokens = self._refill(tokens, updated_at, now)
+
+            factor = None
+            if permit.outcome == "throttled":
+                factor = self.decrease_factor
+                tokens = 0.0  # 被限流后清空令牌桶，让上游喘口气
+            elif permit.latency is not None and permit.latency > self.latency_target:
+                factor = self.latency_factor
+            elif permit.outcome == "ok":
+                window = min(self.max_window, window + 1.0 / window)
+
+            if factor is not None and now - decreased_at >= self.decrease_interval:
+                new_window = max(self.min_window, window * factor)
+                if int(new_window) < int(window):
+                    reason = "返回429" if permit.outcome == "throttled" else f"首字节延迟{permit.latency:.1f}秒"
+                    logger.warning(f"{self.name}{reason}，并发窗口从{window:.1f}缩小到{new_window:.1f}")
+                window = new_window
+                decreased_at = now
+
+            conn.execute(
+                "UPDATE limiter_state SET window = ?, tokens = ?, updated_at = ?, decreased_at = ? WHERE name = ?",
+                (window, tokens, now, decreased_at, self.name)
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        finally:
+            with self._cond:
+                if permit.outcome == "throttled":
+                    self.throttled += 1
+                # 唤醒所有等待者，由各自按优先级判断能否取得许可
+                self._cond.notify_all()
+
+    def snapshot(self):
+        conn = get_connection(self.path)
+        now = time.time()
+        window, tokens, updated_at = conn.execute(
+            "SELECT window, tokens, updated_at FROM limiter_state WHERE name = ?", (self.name,)
+        ).fetchone()
+        in_flight = conn.execute(
+            "SELECT COUNT(*) FROM limiter_slots WHERE name = ? AND expires_at >= ?", (self.name, now)
+        ).fetchone()[0]
+        with self._lock:
+            return {
+                "window": round(window, 2),
+                "in_flight": in_flight,
+                "tokens": round(self._refill(tokens, updated_at, now), 2),
+                "throttled": self.throttled,
+                "priorities": dict((priority, {
+                    "waiters": self.waiters[priority],
+                    "admitted": self.admitted[priority],
+                    "waited": self.waited[priority],
+                    "avg_wait_ms": round(self.wait_seconds[priority] / self.waited[priority] * 1000, 1)
+                                   if self.waited[priority] else 0.0,
+                    "rejected": self.rejected[priority]
+                }) for priority in PRIORITIES)
+            }
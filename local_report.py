@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# 本地规则生成的简版报告：上游超时或熔断时代替AI报告，也用作提交后立即显示的预览
+#
+# 结构与三个AI报告部分相同（命盘概览、十神解读、行动手册），内容由确定的规则拼成：
+# 命盘要点来自chart_facts（五行分数、强弱、十神、格局、神煞、干支关系），其余是日主、五行和十神的固定描述。
+# 不摘录bazi.py的断语：断语大多带有本地无法判断的条件（性别、柱位组合、数量），摘出来常常并不适用。
+# 不调用任何上游服务，一个命盘三个部分合计在1毫秒左右。
+
+from chart_facts import PILLAR_NAMES, STRONG_MEDIAN, compute_facts
+
+# 简版报告开头的标记，用于识别报告内容是否由本地规则生成
+LOCAL_MARKER = "【简版解读】"
+FALLBACK_NOTE = "AI详细解读暂时无法生成，以下是根据命理规则即时整理的简版解读，可稍后重新生成。"
+PREVIEW_NOTE = "以下是根据命理规则即时整理的预览，AI详细解读生成后会替换这里的内容。"
+
+# 日主天干的意象
+DAY_MASTER_IMAGES = {
+    "甲": "如参天大树，正直向上，有担当、重原则，不轻易弯曲",
+    "乙": "如花草藤萝，柔韧灵活，善于适应环境、协调关系",
+    "丙": "如当空的太阳，热情开朗、光明坦荡，乐于照亮他人",
+    "丁": "如烛火灯光，细腻温暖、专注内敛，善于洞察",
+    "戊": "如高山厚土，稳重可靠、包容守信",
+    "己": "如田园沃土，温和务实，善于滋养和经营",
+    "庚": "如刀剑之金，果断刚毅、重义气，行动力强",
+    "辛": "如珠玉首饰，精致敏锐、自尊心强，追求品质",
+    "壬": "如江河奔流，聪慧开阔、思维活跃，善于变通",
+    "癸": "如雨露之水，细腻敏感、想象丰富，润物无声",
+}
+
+# 五行偏旺、偏弱时的表现，以及补足偏弱五行的日常练习
+ELEMENT_STRONG = {
+    "木": "进取、坚持，也容易固执、急于求成",
+    "火": "热情外放，也容易急躁、情绪起伏大",
+    "土": "稳重踏实，也容易保守、思虑过多",
+    "金": "果断有原则，也容易苛刻、锋芒外露",
+    "水": "聪明灵活，也容易多虑、漂浮不定",
+}
+ELEMENT_WEAK = {
+    "木": "规划和成长的动力不足，遇事容易犹豫",
+    "火": "热情和表达不易点燃，需要主动寻找激励",
+    "土": "安全感和规律感不足，容易分心",
+    "金": "决断和边界感偏弱，不易拒绝他人",
+    "水": "变通和休整不足，容易紧绷",
+}
+ELEMENT_PRACTICES = {
+    "木": "制定小步可行的成长计划，多亲近自然，做舒展类运动",
+    "火": "多晒太阳、做有氧运动，多与信任的人交流表达",
+    "土": "保持规律作息和饮食，定期整理空间与账目",
+    "金": "练习设定边界和截止时间，适度断舍离，做呼吸练习",
+    "水": "给自己留出独处和休息的时间，冥想、阅读和复盘",
+}
+
+# 十神的(天赋, 互动, 成长课题)
+TEN_GOD_TRAITS = {
+    "比肩": ("独立自主、意志坚定，重视公平", "以平等的伙伴姿态与人相处，重视朋友与同侪", "过强时固执、易与人争执，需要学会合作与倾听"),
+    "劫财": ("行动果敢、好胜，善于争取机会", "社交活跃、讲义气，常在竞争与合作中成长", "容易冲动投入和花费，需要管理风险、守住财务边界"),
+    "食神": ("温和乐观、享受生活，富有创造力", "以分享和陪伴带给他人愉悦，擅长营造轻松氛围", "容易安逸、拖延，需要把灵感落实为行动"),
+    "伤官": ("才华横溢、表达力强，敢于突破", "在创造和表达中发光，关系中直率坦白", "锋芒太露易与规则和权威冲突，需要学会柔和地表达"),
+    "偏财": ("慷慨豁达、眼光灵活，善于把握机会", "交游广阔、行动导向，重视实际回报", "得失看得轻也容易大起大落，需要稳健的计划"),
+    "正财": ("勤恳踏实、务实守信，善于经营", "重视承诺与责任，是关系中可靠的伙伴", "过于保守计较时会错过机会，需要适度放开"),
+    "七杀": ("魄力十足、敢于挑战，抗压能力强", "在压力和竞争中展现领导力，保护身边的人", "压力过大时焦虑急躁，需要找到释放与节制之道"),
+    "正官": ("自律守规、责任心强，重视名誉", "在组织与规则中建立信任，受人尊重", "过于拘谨时压抑自我，需要允许自己有弹性"),
+    "偏印": ("直觉敏锐、思维独特，善于钻研", "偏好有深度的交流，常有独到见解", "容易孤僻多疑、有始无终，需要与人保持连接"),
+    "正印": ("仁慈包容、好学，给人安全感", "给予和接受关怀，重视学习与传承", "过于依赖和被动时，需要锻炼独立和行动力"),
+}
+
+# 十神对应的发展领域
+TEN_GOD_FIELDS = {
+    "比肩": "独立负责或合伙共创的项目", "劫财": "需要开拓和竞争的业务",
+    "食神": "创作、美食、教育与生活方式相关的领域", "伤官": "表达、设计、技术创新等需要突破的领域",
+    "偏财": "销售、投资、跨界经营", "正财": "财务、运营、稳健经营的事业",
+    "七杀": "管理、创业、需要担当与决断的角色", "正官": "组织管理、公职、制度与规划类工作",
+    "偏印": "研究、技术、心理与玄学等需要钻研的领域", "正印": "教育、咨询、助人与文化传承",
+}
+
+REFLECTION_OVERVIEW = (
+    "* 你在生活中，何时最感受到这种“日主”能量？",
+    "* 哪种五行能量在你身上最常浮现？你如何与它相处？",
+    "* 是否有经验让你意识到自己“失衡”了？你如何找回自己？",
+)
+REFLECTION_GOD = (
+    "* 你是否认得出这种天赋？你在哪些时刻看见它？",
+    "* 在你的人生中，它是否也曾带来困扰？你如何调和它？",
+)
+
+def is_local_report(content):
+    """内容是否为本地规则生成的简版报告"""
+    return isinstance(content, str) and content.startswith("> " + LOCAL_MARKER)
+
+def _pillars_text(bazi, facts):
+    pillars = bazi.split()
+    parts = [f"{name}柱：{pillar}" for name, pillar in zip(PILLAR_NAMES, pillars)]
+    parts[2] += f"（日主：{facts['me']}{facts['me_element']}）"
+    return "　".join(parts)
+
+def _god_positions(facts):
+    """命盘中出现的十神及其位置，按年、月、日、时先天干后地支的顺序"""
+    positions = {}
+    for index, god in enumerate(facts["gan_shens"]):
+        if index != 2:
+            positions.setdefault(god, []).append(f"{PILLAR_NAMES[index]}干")
+    for index, god in enumerate(facts["zhi_shens"]):
+        positions.setdefault(god, []).append(f"{PILLAR_NAMES[index]}支")
+    return positions
+
+def _overview(bazi, facts):
+    ranked = sorted(facts["scores"].items(), key=lambda item: -item[1])
+    strongest, weakest = ranked[0][0], ranked[-1][0]
+    if facts["is_strong"]:
+        strength = "自我能量充足，有主见、行动力强，宜把力量用在输出与担当上"
+    else:
+        strength = "更需要外在的支持与滋养，宜借助学习、合作与休整来蓄力"
+    lines = [
+        "### 【八字命盘展示】",
+        _pillars_text(bazi, facts),
+        "",
+        "### 【日主解读 · 我的内在之光】",
+        f"日主是命盘中代表自我的核心能量。你的日主为{facts['me']}{facts['me_element']}，"
+        f"{DAY_MASTER_IMAGES[facts['me']]}。",
+        f"日主生于{facts['month_zhi']}月，在月令处于{facts['me_status'][1]}之地；"
+        f"强弱值{facts['strong']}（中值{STRONG_MEDIAN}），整体{'偏强' if facts['is_strong'] else '偏弱'}，"
+        f"{'有' if not facts['weak'] else '没有'}强根，{strength}。格局取{facts['ge']}。",
+        "",
+        "### 【五行能量分布 · 我的内在气候】",
+        "五行分数：" + "　".join(f"{element}{score}" for element, score in ranked) + "。",
+        f"{strongest}最旺：{ELEMENT_STRONG[strongest]}；{weakest}最弱：{ELEMENT_WEAK[weakest]}。",
+    ]
+    if facts["relations"]:
+        lines.append("命盘中的干支关系：" + "；".join(facts["relations"]) + "。")
+    lines += ["", "### 【反思邀请 · 我的共鸣写作】"] + list(REFLECTION_OVERVIEW)
+    return lines
+
+def _ten_gods(bazi, facts):
+    lines = []
+    for god, places in _god_positions(facts).items():
+        gift, interaction, challenge = TEN_GOD_TRAITS[god]
+        shown = [place for place in places if place.endswith("干")]
+        state = f"透出于{'、'.join(shown)}" if shown else f"藏于{'、'.join(places)}"
+        lines += [
+            f"### 【{god}】（{'、'.join(places)}）",
+            "**1. 天赋之光 · 我如何闪耀？**", f"* {gift}。",
+            "**2. 互动之舞 · 我与世界的关系**", f"* {interaction}。",
+            "**3. 成长契机 · 我如何平衡？**", f"* {god}{state}；{challenge}。",
+        ]
+        lines += ["**4. 反思邀请 · 与我对话**"] + list(REFLECTION_GOD) + [""]
+    if facts["shens"]:
+        lines.append("命盘中的神煞：" + "；".join(
+            f"{name}（{''.join(places)}柱）" for name, places in facts["shens"].items()) + "。")
+    return lines
+
+def _action_guide(bazi, facts):
+    ranked = sorted(facts["scores"].items(), key=lambda item: -item[1])
+    strongest, weakest = ranked[0][0], ranked[-1][0]
+    positions = _god_positions(facts)
+    main_gods = sorted(positions, key=lambda god: -len(positions[god]))[:3]
+    lines = [
+        "### 【我的优势清单与运用策略】",
+        f"* 日主{facts['me']}{facts['me_element']}：{DAY_MASTER_IMAGES[facts['me']]}。",
+    ]
+    for god in main_gods:
+        lines.append(f"* {god}：{TEN_GOD_TRAITS[god][0]}，可以用在{TEN_GOD_FIELDS[god]}。")
+    lines += [
+        "",
+        "### 【我的成长课题与应对智慧】",
+        f"* {weakest}偏弱：{ELEMENT_WEAK[weakest]}。可以尝试{ELEMENT_PRACTICES[weakest]}。",
+        f"* {strongest}偏旺：{ELEMENT_STRONG[strongest]}，留意在压力下是否过度依赖这种模式。",
+    ]
+    if facts["is_strong"]:
+        lines.append("* 日主偏强：宜把能量投入到创造、服务和承担责任中，练习倾听与合作。")
+    else:
+        lines.append("* 日主偏弱：宜先照顾好身心节律，借助学习、导师和伙伴积蓄力量，再逐步拓展。")
+    lines += [
+        "",
+        "### 【目标导航仪·自我书写】",
+        "* " + "；".join(f"{god}的倾向可能对应{TEN_GOD_FIELDS[god]}" for god in main_gods) + "。",
+        f"* 问题一：哪一件事最能让你感到“{facts['me']}{facts['me_element']}”的自己在发光？",
+        f"* 问题二：如果为偏弱的{weakest}能量做一件小事，这周你会做什么？",
+        "* 问题三：一年后的你，希望自己在哪个领域更加自在？",
+        "把答案写下来，让书写成为一次与自己相约的小小仪式。",
+    ]
+    return lines
+
+# 各报告部分的生成函数，参数均为(八字, 命盘要点)，返回Markdown行列表
+SECTION_BUILDERS = {
+    "overview": _overview,
+    "ten_gods": _ten_gods,
+    "action_guide": _action_guide,
+}
+
+def build_local_report(bazi, sections=None, preview=False):
+    """用本地规则生成简版报告，返回{部分: Markdown内容}；八字格式不对时返回空dict
+
+    preview为True时开头注明这是预览，否则注明AI解读暂时无法生成。
+    """
+    facts = compute_facts(bazi)
+    if facts is None:
+        return {}
+    note = f"> {LOCAL_MARKER}{PREVIEW_NOTE if preview else FALLBACK_NOTE}"
+    sections = list(SECTION_BUILDERS) if sections is None else sections
+    return dict(
+        (section, "\n".join([note, ""] + SECTION_BUILDERS[section](bazi, facts)).rstrip())
+        for section in sections if section in SECTION_BUILDERS
+    )
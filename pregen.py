@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# 常见命盘的离线批量预生成
+#
+# 枚举日期范围内每一天的十二个时辰，用calculate_bazi算出四柱并去重，
+# 把尚未缓存的报告部分逐个生成写入报告缓存。上游调用以background优先级进行，
+# 只使用准入限制器的空闲配额，与线上服务同时运行也不会影响用户请求。
+#
+# 用法：
+#   python pregen.py                                  预生成1950-01-01至2010-12-31
+#   python pregen.py --start 1980-01-01 --end 1989-12-31 --rate 20 --concurrency 2
+#   python pregen.py --resume                         从检查点继续（崩溃或中断后），并重试上次失败的命盘
+#   python pregen.py --dry-run                        只统计命盘数量和预计花费，不调用上游
+
+import argparse
+import datetime
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+# 预生成时只保留警告和错误日志，进度由本脚本输出
+logging.disable(logging.INFO)
+
+import app
+from limiter import UpstreamBusyError, BACKGROUND
+from resilience import Deadline
+
+# 上游繁忙（没有空闲配额）时等待多久再试（秒）
+BUSY_BACKOFF_SECONDS = 5.0
+
+class RateLimiter(object):
+    """按固定间隔放行：每分钟最多rate次"""
+
+    def __init__(self, rate):
+        self.interval = 60.0 / rate if rate > 0 else 0.0
+        self.next_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            delay = self.next_at - now
+            self.next_at = max(now, self.next_at) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+class Checkpoint(object):
+    """检查点文件：记录已连续处理完的命盘位置、有部分生成失败的命盘和累计计数，原子写入
+
+    failed_charts为{命盘序号: 失败的部分数}，failed为其合计；检查点越过失败的命盘后仍记着它们，继续时先重试。
+    """
+
+    def __init__(self, path, start, end):
+        self.path = path
+        self.data = {"start": start, "end": end, "position": 0,
+                     "generated": 0, "cached": 0, "failed": 0, "failed_charts": {}}
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return False
+        with open(self.path, encoding='utf-8') as f:
+            data = json.load(f)
+        if data.get("start") != self.data["start"] or data.get("end") != self.data["end"]:
+            raise SystemExit(f"检查点{self.path}的日期范围为{data.get('start')}至{data.get('end')}，与本次参数不一致")
+        self.data.update(data)
+        return True
+
+    def record(self, index, failed):
+        """记录一个命盘的处理结果：有失败的部分时记下，全部成功时从失败记录中移除"""
+        if failed:
+            self.data["failed_charts"][str(index)] = failed
+        else:
+            self.data["failed_charts"].pop(str(index), None)
+        self.data["failed"] = sum(self.data["failed_charts"].values())
+
+    def save(self):
+        self.data["updated_at"] = datetime.datetime.now().isoformat(timespec='seconds')
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.data, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, self.path)
+
+def parse_date(value):
+    return datetime.datetime.strptime(value, "%Y-%m-%d").date()
+
+def enumerate_charts(start, end):
+    """返回日期范围内去重后的命盘列表[(八字, (年, 月, 日, 时辰))]，保持日期顺序"""
+    charts = []
+    seen = set()
+    day = start
+    while day <= end:
+        for shichen, (hour, _) in app.SHICHEN_MAP.items():
+            bazi_info = app.calculate_bazi(day.year, day.month, day.day, hour)
+            if bazi_info and bazi_info['bazi'] not in seen:
+                seen.add(bazi_info['bazi'])
+                charts.append((bazi_info['bazi'], (day.year, day.month, day.day, shichen)))
+        day += datetime.timedelta(days=1)
+    return charts
+
+def section_cost(args):
+    """单个报告部分的预计花费（元）"""
+    return (args.input_tokens * args.input_price + args.output_tokens * args.output_price) / 1e6
+
+def generate_chart(bazi, sections, rate_limiter, stop_event):
+    """生成一个命盘中未缓存的部分，返回(生成数, 失败数)；上游繁忙时等待空闲配额后重试"""
+    generated = failed = 0
+    for section in sections:
+        while not stop_event.is_set():
+            rate_limiter.wait()
+            report, error = app.generate_report_section(
+                bazi, section, Deadline(app.BACKGROUND_DEADLINE_SECONDS), BACKGROUND
+            )
+            if isinstance(error, UpstreamBusyError):
+                stop_event.wait(BUSY_BACKOFF_SECONDS)
+                continue
+            if error is None:
+                generated += 1
+            else:
+                failed += 1
+            break
+    return generated, failed
+
+def print_progress(checkpoint, total, started, start_position, miss_ratio, args):
+    position = checkpoint.data["position"]
+    elapsed = max(time.monotonic() - started, 1e-6)
+    throughput = (position - start_position) / elapsed
+    remaining = total - position
+    eta = remaining / throughput if throughput > 0 else float('inf')
+    remaining_sections = remaining * len(app.REPORT_PROMPTS) * miss_ratio
+    eta_text = str(datetime.timedelta(seconds=int(eta))) if eta != float('inf') else "未知"
+    print(f"[{position}/{total} {position / total * 100:.1f}%] "
+          f"生成{checkpoint.data['generated']}部分，已缓存{checkpoint.data['cached']}部分，失败{checkpoint.data['failed']}部分 | "
+          f"{throughput * 60:.1f}命盘/分钟，预计剩余{eta_text} | "
+          f"剩余约{remaining_sections:.0f}次上游调用，约{remaining_sections * section_cost(args):.2f}元",
+          flush=True)
+
+def run(args):
+    start, end = parse_date(args.start), parse_date(args.end)
+    checkpoint = Checkpoint(args.checkpoint, args.start, args.end)
+    if args.resume and checkpoint.load():
+        print(f"从检查点继续: 第{checkpoint.data['position']}个命盘")
+    elif os.path.exists(args.checkpoint) and not args.dry_run:
+        raise SystemExit(f"检查点{args.checkpoint}已存在，继续请加--resume，重新开始请先删除该文件")
+
+    enum_started = time.monotonic()
+    charts = enumerate_charts(start, end)
+    total = len(charts)
+    print(f"{args.start}至{args.end}共{total}个不同的命盘，枚举用时{time.monotonic() - enum_started:.1f}秒")
+
+    if args.dry_run:
+        sample = charts[::max(total // 500, 1)]
+        missing = sum(app.report_cost({"bazi": bazi}) for bazi, _ in sample)
+        miss_ratio = missing / float(len(sample) * len(app.REPORT_PROMPTS)) if sample else 0.0
+        sections = total * len(app.REPORT_PROMPTS) * miss_ratio
+        print(f"抽样{len(sample)}个命盘，未缓存比例{miss_ratio:.1%}；"
+              f"预计需要约{sections:.0f}次上游调用，约{sections * section_cost(args):.2f}元")
+        return
+
+    rate_limiter = RateLimiter(args.rate)
+    stop_event = threading.Event()
+    executor = ThreadPoolExecutor(max_workers=args.concurrency, thread_name_prefix="pregen")
+    start_position = position = checkpoint.data["position"]
+    started = last_report = time.monotonic()
+    checked_sections = missing_sections = 0
+    pending = {}   # future -> 命盘序号
+    finished = set()
+    # 检查点之前有部分生成失败的命盘先重试，已生成的部分会命中缓存，只补生成失败的部分；
+    # 检查点之后的命盘本来就会重新处理
+    retry = deque(sorted(index for index in map(int, checkpoint.data["failed_charts"]) if index < start_position))
+    if retry:
+        print(f"先重试上次有部分生成失败的{len(retry)}个命盘")
+
+    try:
+        while position < total or retry or pending:
+            # 保持最多concurrency个命盘在生成中
+            while (retry or position < total) and len(pending) < args.concurrency:
+                retrying = bool(retry)
+                if retrying:
+                    index = retry.popleft()
+                else:
+                    index = position
+                    position += 1
+                bazi, _ = charts[index]
+                sections = [section for section in app.REPORT_PROMPTS if app.get_cached_section(bazi, section) is None]
+                if not retrying:
+                    checked_sections += len(app.REPORT_PROMPTS)
+                    missing_sections += len(sections)
+                    checkpoint.data["cached"] += len(app.REPORT_PROMPTS) - len(sections)
+                if sections:
+                    pending[executor.submit(generate_chart, bazi, sections, rate_limiter, stop_event)] = index
+                else:
+                    checkpoint.record(index, 0)
+                    if not retrying:
+                        finished.add(index)
+
+            if pending:
+                done, _ = wait(list(pending), timeout=1.0, return_when=FIRST_COMPLETED)
+                for future in done:
+                    generated, failed = future.result()
+                    index = pending.pop(future)
+                    checkpoint.data["generated"] += generated
+                    checkpoint.record(index, failed)
+                    # 重试的命盘在检查点位置之前，不影响检查点前进
+                    if index >= start_position:
+                        finished.add(index)
+
+            # 检查点只前进到连续处理完的位置，崩溃后从这里继续，已生成的部分会命中缓存
+            while checkpoint.data["position"] in finished:
+                finished.discard(checkpoint.data["position"])
+                checkpoint.data["position"] += 1
+
+            now = time.monotonic()
+            if now - last_report >= args.progress_interval:
+                last_report = now
+                checkpoint.save()
+                miss_ratio = missing_sections / float(checked_sections) if checked_sections else 1.0
+                print_progress(checkpoint, total, started, start_position, miss_ratio, args)
+    except KeyboardInterrupt:
+        print("收到中断，等待进行中的生成结束后保存检查点……")
+        stop_event.set()
+        for future in list(pending):
+            future.result()
+    finally:
+        executor.shutdown(wait=True)
+        checkpoint.save()
+
+    miss_ratio = missing_sections / float(checked_sections) if checked_sections else 0.0
+    print_progress(checkpoint, total, started, start_position, miss_ratio, args)
+    if checkpoint.data["position"] >= total:
+        if checkpoint.data["failed_charts"]:
+            print(f"预生成完成，{len(checkpoint.data['failed_charts'])}个命盘有部分生成失败，已记在检查点中，"
+                  f"加--resume重新运行会只补生成这些部分")
+        else:
+            print("预生成完成")
+
+def main():
+    parser = argparse.ArgumentParser(description="常见命盘报告的离线批量预生成")
+    parser.add_argument("--start", default="1950-01-01", help="起始日期（公历，含）")
+    parser.add_argument("--end", default="2010-12-31", help="结束日期（公历，含）")
+    parser.add_argument("--rate", type=float, default=30, help="每分钟最多发起的报告部分生成数")
+    parser.add_argument("--concurrency", type=int, default=2, help="同时生成的命盘数")
+    parser.add_argument("--checkpoint", default="pregen_checkpoint.json", help="检查点文件")
+    parser.add_argument("--resume", action="store_true", help="从检查点继续")
+    parser.add_argument("--dry-run", action="store_true", help="只统计命盘数量和预计花费")
+    parser.add_argument("--progress-interval", type=float, default=10, help="输出进度的间隔（秒）")
+    # 花费估算：每个报告部分的平均token数和单价（元/百万token）
+    parser.add_argument("--input-tokens", type=int, default=600)
+    parser.add_argument("--output-tokens", type=int, default=1500)
+    parser.add_argument("--input-price", type=float, default=2.0)
+    parser.add_argument("--output-price", type=float, default=8.0)
+    args = parser.parse_args()
+    run(args)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# 报告提示词：系统消息、各部分写作要求，以及把命盘数据接在末尾的提示词构建
+#
+# DeepSeek会缓存请求中与之前请求相同的前缀，命中部分的输入token更便宜、首字更快。
+# 因此每次请求不变的内容（系统消息、写作要求）放在最前面并保持逐字节一致，
+# 随命盘变化的内容（命盘要点、检索到的参考资料、八字信息）放在最后。
+
+import hashlib
+
+# 提示词修订号，计入提示词版本：修改系统消息、命盘行或写作要求时加一，使该次修改在缓存版本中有明确的记录
+# 2：系统消息改为要求结合提供的参考资料
+PROMPT_REVISION = 2
+
+# 所有上游服务共用的系统消息
+SYSTEM_PROMPT = "请结合命理典籍知识和提供的参考资料，并会从来访者角度出发。用细腻的文笔代入具体的场景，引发共鸣与思考。"
+
+# 接在提示词末尾的命盘数据
+CHART_TEMPLATE = "八字信息：{bazi}"
+
+# 三个报告部分的写作要求（不含命盘），命盘数据由build_section_prompt接在末尾
+REPORT_PROMPTS = {
+    "overview": """你是一位八字教练，请根据以下命盘数据，撰写“命盘概览”模块，包含以下四部分：
+1. 【八字命盘展示】
+* 简洁文本方式列出年、月、日、时柱（带天干地支），并清晰标注“日主”。
+2. 【日主解读 · 我的内在之光】
+* 开篇解释“日主”概念（如：日主是你命盘中代表自我的核心能量）；
+* 分析日主五行属性、状态（得令/受制/得生等）及其在整张命盘中的互动；
+* 引出日主所象征的性格核心、行动风格和情绪表达方式；
+3. 【五行能量分布 · 我的内在气候】
+* 分析五行结构，指出偏旺/偏弱的元素；
+* 强调五行之间的互动关系（如：水火冲、木生火弱、土制水强等），并与情绪模式、身心体验或惯性反应相连结；
+4. 【反思邀请 · 我的共鸣写作】
+* 你在生活中，何时最感受到这种“日主”能量？
+* 哪种五行能量在你身上最常浮现？你如何与它相处？
+* 是否有经验让你意识到自己“失衡”了？你如何找回自己？
+请自由写下你此刻的共鸣、记忆或直觉……
+
+
+请以专业、客观的口吻撰写，避免使用过于玄学或迷信的表述，重点强调八字所反映的性格特点和潜能。
+""",
+    "ten_gods": """你是一位具备心理学与古典命理素养的八字分析者，请针对命盘中的十神结构，撰写人格互动分析。每个十神模块包含以下结构：
+【十神名称】（如：正财、偏印等）
+1. 天赋之光 · 我如何闪耀？
+    * 分析该十神的正向特质、具体展现方式（如“正印带来安全感与包容力”）；
+2. 互动之舞 · 我与世界的关系
+    * 阐述该十神在社会关系、亲密关系或创造模式中的作用（如“偏财常见于行动导向的关系风格”）；
+3. 成长契机 · 我如何平衡？
+    * 识别该十神在命盘中处于何种状态（透出/藏干/有根/受制），点出挑战、转化方向；
+4. 反思邀请 · 与我对话
+    * 你是否认得出这种天赋？你在哪些时刻看见它？
+    * 你在互动中是否常常展现这种模式？它带来什么？
+    * 在你的人生中，它是否也曾带来困扰？你如何调和它？
+输入格式：
+* 每个十神的命盘结构描述（藏干/透干/合化等）
+""",
+    "action_guide": """你是一位温柔而清晰的自我教练，请撰写“自我赋能与成长计划”模块，引导用户将认知转化为可落地的实践。模块结构如下：
+1. 【我的优势清单与运用策略】
+* 总结命盘中明显的优势特质（来自日主、十神、组合等）；
+* 提供如何具体运用这些特质的建议场景（如职场、人际、创作）；
+2. 【我的成长课题与应对智慧】
+* 点出用户当前命盘中可成长之处（五行失衡、过强或受克等）；
+* 给出温和可行的转化建议（身心练习、习惯建立、表达方式）；
+3. 【目标导航仪·自我书写】：
+* 简要提示命盘中的某些倾向（如偏印、比肩、食神等）可能对应的发展领域；
+* 提出 3 个开放式问题，帮助用户书写内心的答案；
+* 最后一句鼓励语，引导用户把书写变成一种仪式感的行动。
+
+
+"""
+}
+
+def build_section_prompt(section, bazi, context=""):
+    """单个部分的提示词：写作要求在前，命盘相关的上下文（要点、参考资料）和命盘在后"""
+    parts = [REPORT_PROMPTS[section].rstrip()]
+    if context:
+        parts.append(context)
+    parts.append(CHART_TEMPLATE.format(bazi=bazi))
+    return "\n\n".join(parts)
+
+def prompt_version(section, context_version=""):
+    """提示词版本：修订号、系统消息、命盘行、写作要求加上下文版本的哈希，修改其中任何一项后旧缓存即成为过期版本
+
+    context_version描述随命盘附带的上下文（命盘要点是否附带及其格式版本、参考资料的检索配置和语料），
+    由调用方给出；上下文的内容因命盘而异，只计入其配置。
+
+    只取决于内容，与命盘放在开头还是末尾无关，调整布局不会让已有缓存失效。
+    过期版本的缓存仍可先返回给用户，同时在后台重新生成（见app.get_cached_section）。
+    """
+    canonical = f"r{PROMPT_REVISION}\n" + SYSTEM_PROMPT + "\n" + CHART_TEMPLATE + "\n" + REPORT_PROMPTS[section]
+    if context_version:
+        canonical += "\n" + context_version
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()[:12]
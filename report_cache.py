@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# 报告缓存：进程内LRU + 磁盘SQLite两级缓存
+#
+# 报告内容只取决于四柱八字、报告部分、提示词版本和模型，
+# 因此以这四项的哈希作为键，不同生日只要排出相同的八字即可共用同一份报告。
+# 提示词修改后，旧版本的条目仍保留在磁盘上，可用get_stale取出先返回给用户，再在后台重新生成。
+# 安装了zstandard时，磁盘上的内容以字典压缩后的形式存放（见compression.py），读取时解压；
+# 进程内LRU只有几百个条目，存放解压后的文本，内存命中时不必每次解压。
+
+import hashlib
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from compression import ReportCodec, MAX_TRAIN_SAMPLES, MIN_TRAIN_SAMPLES
+from db import get_connection
+
+logger = logging.getLogger(__name__)
+
+# 每写入多少条检查一次磁盘缓存的容量和过期条目
+EVICT_CHECK_INTERVAL = 100
+
+class ReportCache(object):
+    """按(八字, 部分, 提示词版本, 模型)寻址的报告缓存
+
+    读取顺序：进程内LRU → SQLite；SQLite命中后回填LRU。
+    两级都有TTL；磁盘条目数超过max_entries时按最近访问时间淘汰。
+    compress为真且安装了zstandard时压缩存放；压缩字典由train_dictionary训练（flask cache-compress），
+    不在写入时训练，写入时只定期改用最近训练的字典。
+    """
+
+    def __init__(self, path, memory_size=512, max_entries=100000, ttl=90 * 86400, compress=True):
+        self.path = path
+        self.memory_size = memory_size
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._writes = 0
+        self.hits_memory = 0
+        self.hits_disk = 0
+        self.misses = 0
+        self.hits_stale = 0
+        self._init_db()
+        self.codec = ReportCodec(path, compress)
+
+    def _init_db(self):
+        conn = get_connection(self.path)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS reports (
+                key TEXT PRIMARY KEY,
+                pillars TEXT NOT NULL,
+                section TEXT NOT NULL,
+                prompt_version TEXT NOT NULL,
+                model TEXT NOT NULL,
+                content TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_reports_accessed ON reports (accessed_at)")
+        # 按命盘查找其他提示词版本的条目
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_reports_chart ON reports (pillars, section)")
+
+    @staticmethod
+    def make_key(pillars, section, prompt_version, model):
+        raw = "\x1f".join([pillars, section, prompt_version, model])
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+    def get(self, pillars, section, prompt_version, model):
+        """读取缓存的报告内容，未命中或已过期时返回None"""
+        key = self.make_key(pillars, section, prompt_version, model)
+        now = time.time()
+
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                content, created_at = entry
+                if now - created_at < self.ttl:
+                    self._memory.move_to_end(key)
+                    self.hits_memory += 1
+                else:
+                    del self._memory[key]
+                    entry = None
+        if entry is not None:
+            return content
+
+        try:
+            conn = get_connection(self.path)
+            row = conn.execute(
+                "SELECT content, created_at FROM reports WHERE key = ?", (key,)
+            ).fetchone()
+            if row is not None and now - row[1] < self.ttl:
+                content = self.codec.decode(row[0])
+                conn.execute("UPDATE reports SET accessed_at = ? WHERE key = ?", (now, key))
+                self._remember(key, content, row[1])
+                with self._lock:
+                    self.hits_disk += 1
+                return content
+        except Exception as e:
+            # 缓存故障不影响报告生成，只记录日志
+            logger.error(f"读取报告缓存出错: {e}")
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def get_stale(self, pillars, section, prompt_version, model):
+        """读取同一命盘、部分和模型在其他提示词版本下最新的未过期内容，返回(内容, 提示词版本)或None
+
+        只在get未命中后调用；不回填LRU，也不更新访问时间，重新生成后旧版本条目按容量自然淘汰。
+        """
+        try:
+            row = get_connection(self.path).execute(
+                "SELECT content, prompt_version FROM reports "
+                "WHERE pillars = ? AND section = ? AND model = ? AND prompt_version != ? AND created_at > ? "
+                "ORDER BY created_at DESC LIMIT 1",
+                (pillars, section, model, prompt_version, time.time() - self.ttl)
+            ).fetchone()
+            if row is None:
+                return None
+            content = self.codec.decode(row[0])
+        except Exception as e:
+            logger.error(f"读取过期版本的报告缓存出错: {e}")
+            return None
+        with self._lock:
+            self.hits_stale += 1
+        return content, row[1]
+
+    def set(self, pillars, section, prompt_version, model, content):
+        """写入报告内容，调用方需保证只写入成功生成的内容"""
+        key = self.make_key(pillars, section, prompt_version, model)
+        now = time.time()
+
+        try:
+            stored = self.codec.encode(content)
+            self._remember(key, content, now)
+            conn = get_connection(self.path)
+            conn.execute(
+                "INSERT OR REPLACE INTO reports "
+                "(key, pillars, section, prompt_version, model, content, created_at, accessed_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (key, pillars, section, prompt_version, model, stored, now, now)
+            )
+            with self._lock:
+                self._writes += 1
+                check = self._writes % EVICT_CHECK_INTERVAL == 0
+            if check:
+                self.evict()
+                # 其他进程（如flask cache-compress）训练了新字典时改用它
+                if self.codec.enabled:
+                    self.codec.load_latest()
+        except Exception as e:
+            logger.error(f"写入报告缓存出错: {e}")
+
+    def evict(self):
+        """删除过期条目，并把磁盘条目数压回max_entries以内"""
+        conn = get_connection(self.path)
+        conn.execute("DELETE FROM reports WHERE created_at < ?", (time.time() - self.ttl,))
+        count = conn.execute("SELECT COUNT(*) FROM reports").fetchone()[0]
+        if count > self.max_entries:
+            conn.execute(
+                "DELETE FROM reports WHERE key IN "
+                "(SELECT key FROM reports ORDER BY accessed_at LIMIT ?)",
+                (count - self.max_entries,)
+            )
+            logger.info(f"报告缓存超出容量，淘汰{count - self.max_entries}条")
+
+    def sample_contents(self, limit=MAX_TRAIN_SAMPLES):
+        """随机取出最多limit个条目的报告文本，无法解压的条目跳过"""
+        samples = []
+        rows = get_connection(self.path).execute(
+            "SELECT content FROM reports ORDER BY RANDOM() LIMIT ?", (limit,)
+        ).fetchall()
+        for row in rows:
+            try:
+                samples.append(self.codec.decode(row[0]))
+            except Exception:
+                continue
+        return samples
+
+    def train_dictionary(self):
+        """用已有条目的随机样本训练压缩字典，返回字典ID；条目不足MIN_TRAIN_SAMPLES或未启用压缩时返回0"""
+        if not self.codec.enabled:
+            return 0
+        samples = self.sample_contents()
+        if len(samples) < MIN_TRAIN_SAMPLES:
+            return 0
+        return self.codec.train(samples)
+
+    def recompress(self, batch_size=500):
+        """把未用当前字典压缩的条目（含未压缩的旧条目）用当前字典重新压缩，返回(改写条目数, 改写前字节数, 改写后字节数)
+
+        按rowid分批读写，不长时间占用写锁；删除的页留给之后的写入复用，要缩小文件需另行VACUUM。
+        """
+        conn = get_connection(self.path)
+        rewritten = before = after = 0
+        last_rowid = 0
+        while True:
+            rows = conn.execute(
+                "SELECT rowid, key, content FROM reports WHERE rowid > ? ORDER BY rowid LIMIT ?",
+                (last_rowid, batch_size)
+            ).fetchall()
+            if not rows:
+                break
+            last_rowid = rows[-1][0]
+            updates = []
+            for _, key, stored in rows:
+                if self.codec.is_current(stored):
+                    continue
+                try:
+                    encoded = self.codec.encode(self.codec.decode(stored))
+                except Exception as e:
+                    logger.error(f"重新压缩报告缓存条目出错: {e}")
+                    continue
+                before += len(stored.encode('utf-8')) if isinstance(stored, str) else len(stored)
+                after += len(encoded)
+                updates.append((encoded, key))
+            if updates:
+                conn.execute("BEGIN IMMEDIATE")
+                try:
+                    conn.executemany("UPDATE reports SET content = ? WHERE key = ?", updates)
+                    conn.execute("COMMIT")
+                except Exception:
+                    conn.execute("ROLLBACK")
+                    raise
+                rewritten += len(updates)
+        return rewritten, before, after
+
+    def version_counts(self):
+        """按(部分, 提示词版本, 模型)统计未过期的条目数，返回[(部分, 提示词版本, 模型, 条目数, 最近写入时间)]"""
+        return get_connection(self.path).execute(
+            "SELECT section, prompt_version, model, COUNT(*), MAX(created_at) FROM reports "
+            "WHERE created_at > ? GROUP BY section, prompt_version, model "
+            "ORDER BY section, MAX(created_at) DESC",
+            (time.time() - self.ttl,)
+        ).fetchall()
+
+    def _remember(self, key, content, created_at):
+        with self._lock:
+            self._memory[key] = (content, created_at)
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.memory_size:
+                self._memory.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "memory_entries": len(self._memory),
+                "hits_memory": self.hits_memory,
+                "hits_disk": self.hits_disk,
+                "hits_stale": self.hits_stale,
+                "misses": self.misses,
+                "compression": self.codec.snapshot()
+            }
@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# 上游故障处理：熔断器、全局重试预算和带抖动的退避
+#
+# 上游故障期间，熔断器打开后请求立即失败（由路由器切换到其他服务或降级），
+# 不再让每个worker线程把整套重试流程等完；重试总量受预算限制，避免重试风暴。
+
+import logging
+import random
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+class UpstreamError(Exception):
+    """上游调用失败（重试后仍失败、响应格式异常等）
+
+    retryable表示这类错误重试后可能成功，例如限流、服务端错误和网络中断。
+    """
+
+    def __init__(self, message, retryable=False):
+        super(UpstreamError, self).__init__(message)
+        self.retryable = retryable
+
+class CircuitOpenError(UpstreamError):
+    """熔断器处于打开状态，调用未发出"""
+
+class DeadlineExceeded(UpstreamError):
+    """请求的整体截止时间已到，不再发起或等待上游调用"""
+
+class Deadline(object):
+    """请求级截止时间，从接口入口一路传到每一次上游尝试"""
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.expires_at = time.monotonic() + seconds
+
+    def remaining(self):
+        return max(self.expires_at - time.monotonic(), 0.0)
+
+    def expired(self):
+        return time.monotonic() >= self.expires_at
+
+    def check(self):
+        if self.expired():
+            raise DeadlineExceeded(f"已超过{self.seconds:.0f}秒的请求截止时间")
+
+    def cap(self, seconds):
+        """把超时时间截短到剩余时间以内"""
+        return min(seconds, self.remaining())
+
+class CircuitBreaker(object):
+    """单个上游服务的熔断器
+
+    closed：正常放行，连续失败failure_threshold次后打开；
+    open：直接拒绝，reset_timeout秒后进入half_open；
+    half_open：只放行一个探测请求，成功则关闭，失败则重新打开。
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=30.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probe_in_flight = False
+        self.rejected = 0
+        self._lock = threading.Lock()
+
+    def available(self):
+        """是否可以调用：关闭状态，或打开已满reset_timeout可以探测"""
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN:
+                return time.monotonic() - self.opened_at >= self.reset_timeout
+            return not self.probe_in_flight
+
+    def allow(self):
+        """放行则返回，否则抛出CircuitOpenError"""
+        with self._lock:
+            if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                self.probe_in_flight = False
+                logger.info(f"{self.name}熔断器进入半开状态，放行探测请求")
+
+            if self.state == self.CLOSED:
+                return
+            if self.state == self.HALF_OPEN and not self.probe_in_flight:
+                self.probe_in_flight = True
+                return
+            self.rejected += 1
+        raise CircuitOpenError(f"{self.name}熔断中，暂停调用")
+
+    def record_success(self):
+        with self._lock:
+            if self.state != self.CLOSED:
+                logger.info(f"{self.name}探测请求成功，熔断器关闭")
+            self.state = self.CLOSED
+            self.failures = 0
+            self.probe_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    logger.warning(f"{self.name}连续失败{self.failures}次，熔断器打开{self.reset_timeout:.0f}秒")
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+                self.probe_in_flight = False
+
+    def release(self):
+        """调用被取消或因截止时间放弃，不计成败；半开状态下允许下一个探测请求"""
+        with self._lock:
+            self.probe_in_flight = False
+
+    def snapshot(self):
+        with self._lock:
+            return {"state": self.state, "failures": self.failures, "rejected": self.rejected}
+
+class RetryBudget(object):
+    """全局重试预算：重试次数不超过请求量的ratio，另有每秒min_per_second次的保底
+
+    每个首次请求存入ratio个令牌，每次重试取出一个；令牌不足时放弃重试。
+    """
+
+    def __init__(self, ratio=0.2, min_per_second=0.2, max_tokens=20.0):
+        self.ratio = ratio
+        self.min_per_second = min_per_second
+        self.max_tokens = max_tokens
+        self.tokens = max_tokens
+        self.updated_at = time.monotonic()
+        self.retries = 0
+        self.denied = 0
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.max_tokens, self.tokens + (now - self.updated_at) * self.min_per_second)
+        self.updated_at = now
+
+    def record_request(self):
+        with self._lock:
+            self._refill()
+            self.tokens = min(self.max_tokens, self.tokens + self.ratio)
+
+    def try_retry(self):
+        with self._lock:
+            self._refill()
+            if self.tokens >= 1.0:
+                self.tokens -= 1.0
+                self.retries += 1
+                return True
+            self.denied += 1
+            return False
+
+    def snapshot(self):
+        with self._lock:
+            self._refill()
+            return {"tokens": round(self.tokens, 2), "retries": self.retries, "denied": self.denied}
+
+def backoff_delay(attempt, base=1.0, cap=8.0):
+    """第attempt次重试前的等待时间：指数增长上限内的完全随机抖动"""
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
@@ -0,0 +1,329 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# 本地命理资料检索：进程内BM25倒排索引，替代远程的Flowith知识库
+#
+# 语料来自bazi.py随附的古籍和规则：《三命通会》(sizi.summarys)、《穷通宝鉴》(yue.months)、
+# 神煞说明(shens_infos)、金不换大运(jinbuhuan)、调候(tiaohous)，以及bazi.py里的断语规则字符串。
+# 断语规则用ast直接从bazi.py源码中提取，不需要导入bazi.py（它在导入时就会排盘输出）；
+# sizi/yue/datas等模块不在时跳过对应的语料，只用规则字符串建索引。
+# 规则字符串中附带的出处（如“母法总则P59-4”）和例盘（四柱干支）在载入时删去，
+# 只对男命或女命成立的规则不收入，检索时并不知道性别。
+#
+# 查询不直接用八字干支：干支字面相同不代表规则适用，反而会把带相同例盘的规则检索出来。
+# 查询用排盘算出的特征（日主五行、各柱十神、身强身弱、格局、五行偏旺偏弱），
+# 检索结果还要完整包含其中某个特征才保留，只共用一个二字词（如“时支正财”与“时支正印”共用“时支”）的规则不算；
+# 规则中写明的柱位十神、格局、身强身弱与命盘不符时（如命盘月支伤官，规则写“月支正官”）也不用。
+#
+# 中文不分词，按字的二元组（bigram）建索引：命理术语基本是两字词（正印、偏财、建禄、魁罡），
+# 查询里连写的“时柱正印”同时能匹配“时柱”“柱正”“正印”。
+# 几千条短文本的索引常驻内存，一次检索只遍历查询词的倒排表，单核几毫秒以内。
+
+import ast
+import hashlib
+import heapq
+import logging
+import math
+import os
+import re
+import threading
+import time
+from collections import defaultdict
+
+from chart_facts import PILLAR_NAMES, compute_facts
+
+logger = logging.getLogger(__name__)
+
+# bazi.py的位置，与本模块同目录
+BAZI_SOURCE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bazi.py")
+
+# 检索版本，计入提示词版本：修改特征、筛选规则或参考资料的排版时加一，已有缓存随之成为过期版本
+RETRIEVAL_VERSION = 3
+
+# 规则字符串至少包含多少个汉字才收入语料（过滤掉打印用的标题和分隔符）
+MIN_RULE_CHINESE = 8
+
+CHINESE_RUN = re.compile(r"[一-鿿]+")
+ASCII_WORD = re.compile(r"[A-Za-z0-9]+")
+
+# 规则字符串中的出处，如“母法总则P59-4：”“基52女：”“基础89”
+RULE_CITATION = re.compile(r"(?:子平)?母法\d*(?:总则)?\s*(?:P\d+(?:-\d+)?)?\s*[:：]?|\bP\d+(?:-\d+)?|基(?:础)?\d+[男女]?\s*[:：]?")
+# 整理规则时留下的备注，如“书上例子不对”“d第10点暂未编码。”
+RULE_NOTE = re.compile(r"[A-Za-z]?[^。，,：:]*(?:例子不对|暂未编码)[^。，,]*[。，,]?")
+# 规则字符串中的例盘：连续四柱干支，如“甲子 戊辰 庚戌 己卯”
+RULE_EXAMPLE = re.compile(r"(?:[甲乙丙丁戊己庚辛壬癸][子丑寅卯辰巳午未申酉戌亥]\s*){4}")
+# 只对男命或女命成立的规则：写明男、女（“子女”“男女”除外），或说的是妻妾、丈夫（“夫妻”除外）
+RULE_GENDERED = re.compile(r"男(?!女)|(?<![子男])女(?!儿)|[妻妾娶嫁]|惧内|续弦|内助|老婆|老公|夫(?!妻)")
+# 规则字符串中充当分隔和标题装饰的符号串，如“----”“****食神分析****”
+RULE_SEPARATOR = re.compile(r"[-—*=#~_]{2,}")
+
+# 规则中写明的条件，与命盘不符的规则不用：某柱天干或地支为某十神，日支（“坐”“自坐”）为某类十神，
+# 某格（“时上正财格”指时干正财），身强或身弱
+RULE_POSITION = re.compile(r"([年月日时][干支])(比肩|劫财|食神|伤官|正财|偏财|正官|七杀|偏官|正印|偏印)")
+RULE_SITTING = re.compile(r"(?<![年月时])坐(比|劫|食|伤|财|官|杀|印)(?!库)")
+RULE_GE = re.compile(r"(时上?)?(比肩|劫财|食神|伤官|正财|偏财|正官|七杀|偏官|正印|偏印|建禄|阳刃|月劫)格")
+RULE_STRENGTH = re.compile(r"身强|身弱")
+# “坐”后的单字所指的十神类别
+SITTING_GROUPS = {"比": "比劫", "劫": "比劫", "食": "食伤", "伤": "食伤", "财": "财",
+                  "官": "官杀", "杀": "官杀", "印": "印"}
+
+# 十神归类，用于按类统计数量
+TEN_GOD_GROUPS = {"比肩": "比劫", "劫财": "比劫", "食神": "食伤", "伤官": "食伤", "正财": "财",
+                  "偏财": "财", "正官": "官杀", "七杀": "官杀", "正印": "印", "偏印": "印"}
+# 同类十神在干支中出现至少多少次才记为“多”
+TEN_GOD_MANY = 3
+
+class Passage(object):
+    """一条可检索的资料：来源、键（按命盘直接查找的键，规则字符串为None）和正文"""
+    __slots__ = ("source", "key", "text")
+
+    def __init__(self, source, key, text):
+        self.source = source
+        self.key = key
+        self.text = text
+
+def tokenize(text):
+    """汉字按相邻二字切分（单字成段时保留单字），字母数字按词切分并转小写"""
+    tokens = []
+    for run in CHINESE_RUN.findall(text):
+        if len(run) == 1:
+            tokens.append(run)
+        else:
+            tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+    tokens.extend(word.lower() for word in ASCII_WORD.findall(text))
+    return tokens
+
+class BM25Index(object):
+    """BM25倒排索引：词 -> [(文档序号, 词频)]，建好后只读，可被多个线程同时检索"""
+
+    def __init__(self, documents, k1=1.5, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self.size = len(documents)
+        postings = defaultdict(list)
+        lengths = []
+        for doc_id, text in enumerate(documents):
+            counts = defaultdict(int)
+            tokens = tokenize(text)
+            for token in tokens:
+                counts[token] += 1
+            for token, tf in counts.items():
+                postings[token].append((doc_id, tf))
+            lengths.append(len(tokens))
+        avg_length = sum(lengths) / float(len(lengths)) if lengths else 0.0
+        # 预先算好每篇文档的长度归一项，检索时只做加法和除法
+        self.norms = [k1 * (1 - b + b * length / avg_length) if avg_length else k1 for length in lengths]
+        self.postings = dict(postings)
+        self.idf = dict(
+            (token, math.log(1 + (self.size - len(docs) + 0.5) / (len(docs) + 0.5)))
+            for token, docs in self.postings.items()
+        )
+
+    def search(self, query, top_k=5):
+        """返回得分最高的top_k个[(得分, 文档序号)]，得分从高到低"""
+        weights = defaultdict(int)
+        for token in tokenize(query):
+            if token in self.postings:
+                weights[token] += 1
+        scores = defaultdict(float)
+        for token, query_tf in weights.items():
+            idf = self.idf[token] * query_tf
+            for doc_id, tf in self.postings[token]:
+                scores[doc_id] += idf * tf * (self.k1 + 1) / (tf + self.norms[doc_id])
+        return heapq.nlargest(top_k, ((score, doc_id) for doc_id, score in scores.items()))
+
+def clean_rule(text):
+    """删去规则字符串中的出处、例盘和分隔符，合并多余的空白"""
+    text = RULE_NOTE.sub(" ", RULE_EXAMPLE.sub(" ", RULE_CITATION.sub(" ", RULE_SEPARATOR.sub(" ", text))))
+    return " ".join(text.split()).strip(" ,，:：")
+
+def load_rule_passages(path=BAZI_SOURCE):
+    """用ast提取bazi.py中的断语规则字符串，去掉出处和例盘、跳过分男女的规则，去重后保持源码顺序"""
+    try:
+        with open(path, encoding='utf-8') as f:
+            tree = ast.parse(f.read())
+    except (OSError, SyntaxError) as e:
+        logger.warning(f"读取断语规则失败: {e}")
+        return []
+    passages = []
+    seen = set()
+    for node in ast.walk(tree):
+        if not isinstance(node, ast.Constant) or not isinstance(node.value, str):
+            continue
+        text = clean_rule(node.value)
+        if text in seen or len("".join(CHINESE_RUN.findall(text))) < MIN_RULE_CHINESE or RULE_GENDERED.search(text):
+            continue
+        seen.add(text)
+        passages.append(Passage("命理规则", None, text))
+    return passages
+
+def _import_table(module_name, attribute):
+    try:
+        module = __import__(module_name)
+    except Exception as e:
+        logger.info(f"未找到{module_name}.{attribute}，跳过该部分语料: {e}")
+        return {}
+    table = getattr(module, attribute, None)
+    return table if isinstance(table, dict) else {}
+
+# 可选的古籍语料：(来源名称, 模块, 变量)；bazi.py以from datas import *引入神煞、金不换和调候
+CLASSIC_TABLES = (
+    ("三命通会", "sizi", "summarys"),
+    ("穷通宝鉴", "yue", "months"),
+    ("神煞", "datas", "shens_infos"),
+    ("金不换大运", "datas", "jinbuhuan"),
+    ("调候", "datas", "tiaohous"),
+)
+
+def load_classic_passages():
+    """导入bazi.py所用的古籍数据模块，每个条目作为一条带键的资料"""
+    passages = []
+    for source, module_name, attribute in CLASSIC_TABLES:
+        for key, value in _import_table(module_name, attribute).items():
+            text = str(value).strip()
+            if text:
+                passages.append(Passage(source, str(key), text))
+    return passages
+
+def chart_features(bazi):
+    """从“甲子 乙丑 丙寅 丁卯”形式的八字中算出检索用的特征
+
+    返回(特征列表, 直接查找的键{来源: 键})。特征按bazi.py断语的写法连写，
+    如“丙火日主”“月干正印”“时支伤官”“身弱”“正官格”“比劫多”“水旺”，不含八字干支本身；
+    古籍条目按日干和月令等直接查找。八字格式不对时返回([], {})。
+    """
+    facts = compute_facts(bazi)
+    if facts is None:
+        return [], {}
+    me, month_zhi = facts["me"], facts["month_zhi"]
+    terms = [f"{me}{facts['me_element']}日主", "身强" if facts["is_strong"] else "身弱", facts["ge"]]
+    gods = []
+    for index, name in enumerate(PILLAR_NAMES):
+        if index != 2:
+            terms.append(f"{name}干{facts['gan_shens'][index]}")
+            gods.append(facts["gan_shens"][index])
+        terms.append(f"{name}支{facts['zhi_shens'][index]}")
+        gods.append(facts["zhi_shens"][index])
+    counts = defaultdict(int)
+    for god in gods:
+        counts[TEN_GOD_GROUPS[god]] += 1
+    terms.extend(f"{group}多" for group, count in counts.items() if count >= TEN_GOD_MANY)
+    ranked = sorted(facts["scores"].items(), key=lambda item: -item[1])
+    terms.extend([f"{ranked[0][0]}旺", f"{ranked[-1][0]}弱"])
+    pillars = bazi.split()
+    keys = {
+        "穷通宝鉴": me + month_zhi,
+        "调候": me + month_zhi,
+        "金不换大运": me + month_zhi,
+        "三命通会": me + "日" + pillars[3],
+    }
+    return terms, keys
+
+def rule_applies(text, terms):
+    """规则中写明的柱位十神、日支、格局和身强身弱是否都与命盘特征相符"""
+    for position, god in RULE_POSITION.findall(text):
+        if position + god.replace("偏官", "七杀") not in terms:
+            return False
+    day_group = next((TEN_GOD_GROUPS[term[2:]] for term in terms if term.startswith("日支")), None)
+    for char in RULE_SITTING.findall(text):
+        if SITTING_GROUPS[char] != day_group:
+            return False
+    for hour, god in RULE_GE.findall(text):
+        god = god.replace("偏官", "七杀")
+        if (f"时干{god}" if hour else f"{god}格") not in terms:
+            return False
+    return all(strength in terms for strength in RULE_STRENGTH.findall(text))
+
+class Retriever(object):
+    """命盘资料检索：先按命盘直接查找古籍条目，再用BM25补足，并统计检索耗时"""
+
+    def __init__(self, passages):
+        started = time.monotonic()
+        self.passages = passages
+        self.index = BM25Index([passage.text for passage in passages])
+        self.by_key = dict(
+            ((passage.source, passage.key), passage) for passage in passages if passage.key is not None
+        )
+        # 语料内容的哈希，语料变化（如sizi等模块装上或更新）时提示词版本随之改变
+        digest = hashlib.sha256()
+        for passage in passages:
+            digest.update(f"{passage.source}\x1f{passage.key}\x1f{passage.text}\x1e".encode('utf-8'))
+        self.corpus_hash = digest.hexdigest()[:12]
+        self.build_seconds = time.monotonic() - started
+        self._lock = threading.Lock()
+        self.lookups = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+
+    def retrieve(self, bazi, top_k=5, max_chars=1200):
+        """返回与命盘最相关的资料列表，最多top_k条、正文合计不超过max_chars字"""
+        started = time.monotonic()
+        terms, keys = chart_features(bazi)
+        results = []
+        for source, key in keys.items():
+            passage = self.by_key.get((source, key))
+            if passage is not None:
+                results.append(passage)
+        if len(results) < top_k and terms:
+            # 多取一些，只保留完整包含某个特征的，并去掉与直接查找重复的
+            for _, doc_id in self.index.search(" ".join(terms), (top_k + len(results)) * 5):
+                passage = self.passages[doc_id]
+                if passage in results or not any(term in passage.text for term in terms):
+                    continue
+                if passage.key is None and not rule_applies(passage.text, terms):
+                    continue
+                results.append(passage)
+                if len(results) >= top_k:
+                    break
+        selected = []
+        used = 0
+        for passage in results[:top_k]:
+            if used + len(passage.text) > max_chars:
+                continue
+            selected.append(passage)
+            used += len(passage.text)
+
+        elapsed = time.monotonic() - started
+        with self._lock:
+            self.lookups += 1
+            self.total_seconds += elapsed
+            self.max_seconds = max(self.max_seconds, elapsed)
+        return selected
+
+    def snapshot(self):
+        with self._lock:
+            sources = defaultdict(int)
+            for passage in self.passages:
+                sources[passage.source] += 1
+            return {
+                "passages": len(self.passages),
+                "corpus_hash": self.corpus_hash,
+                "sources": dict(sources),
+                "build_ms": round(self.build_seconds * 1000, 1),
+                "lookups": self.lookups,
+                "avg_ms": round(self.total_seconds / self.lookups * 1000, 3) if self.lookups else 0.0,
+                "max_ms": round(self.max_seconds * 1000, 3)
+            }
+
+def format_references(passages):
+    """把检索结果排成提示词中的参考资料段落，没有结果时返回空字符串"""
+    if not passages:
+        return ""
+    lines = ["参考资料（节选自命理典籍与断语，供分析时参考，不必逐条引用）："]
+    for index, passage in enumerate(passages, 1):
+        label = f"{passage.source}·{passage.key}" if passage.key else passage.source
+        lines.append(f"{index}. 【{label}】{passage.text}")
+    return "\n".join(lines)
+
+_retriever = None
+_retriever_lock = threading.Lock()
+
+def get_retriever():
+    """进程内共享的检索器，第一次使用时建索引"""
+    global _retriever
+    if _retriever is None:
+        with _retriever_lock:
+            if _retriever is None:
+                retriever = Retriever(load_classic_passages() + load_rule_passages())
+                logger.info(f"命理资料索引已建立: {retriever.snapshot()}")
+                _retriever = retriever
+    return _retriever
@@ -0,0 +1,373 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# 上游服务路由：在DeepSeek与Flowith之间按延迟和错误率选择主服务，并发出对冲请求
+#
+# 主服务在"首字节延迟的P90"内还没有返回响应头时，向备用服务发出一份相同的请求，
+# 谁先成功就用谁的结果，另一份立即取消（关闭连接），以此压低长尾延迟。
+
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+logger = logging.getLogger(__name__)
+
+class CallCancelled(Exception):
+    """对冲中落败的调用被取消"""
+
+class CallContext(object):
+    """单次上游调用的上下文：上报首字节时间，并响应取消
+
+    上游调用函数拿到响应头后调用mark_first_byte()，并用attach()登记响应对象，
+    取消时关闭这些响应，阻塞中的读取会立即出错返回。
+    """
+
+    def __init__(self, deadline=None, priority=None, max_tokens=None, route=None):
+        self.deadline = deadline  # resilience.Deadline，为None时不限时
+        self.priority = priority  # 调用的优先级，由上游调用函数交给准入限制器
+        self.max_tokens = max_tokens  # 最大输出token数，为None时用上游调用函数的默认值
+        self.route = route  # ModelRoute，指定模型和生成参数，为None时用上游调用函数的默认值
+        self.started = time.monotonic()
+        self.first_byte_at = None
+        self.first_byte_event = threading.Event()
+        self.cancel_event = threading.Event()
+        self._responses = []
+        self._lock = threading.Lock()
+
+    @property
+    def cancelled(self):
+        return self.cancel_event.is_set()
+
+    def mark_first_byte(self):
+        if self.first_byte_at is None:
+            self.first_byte_at = time.monotonic()
+        self.first_byte_event.set()
+
+    def attach(self, response):
+        with self._lock:
+            self._responses.append(response)
+        if self.cancelled:
+            response.close()
+            raise CallCancelled("调用已被取消")
+
+    def check_cancelled(self):
+        if self.cancelled:
+            raise CallCancelled("调用已被取消")
+
+    def cancel(self):
+        self.cancel_event.set()
+        with self._lock:
+            responses = list(self._responses)
+        for response in responses:
+            try:
+                response.close()
+            except Exception:
+                pass
+
+def percentile(values, q):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(int(round(q * (len(ordered) - 1))), len(ordered) - 1)
+    return ordered[index]
+
+class ProviderStats(object):
+    """单个上游服务最近window次调用的首字节延迟、总延迟和成败"""
+
+    def __init__(self, window=50):
+        self._lock = threading.Lock()
+        self.first_byte = deque(maxlen=window)
+        self.total = deque(maxlen=window)
+        self.outcomes = deque(maxlen=window)
+        self.hedged = 0
+        self.hedge_wins = 0
+
+    def record(self, first_byte, total, ok):
+        with self._lock:
+            if first_byte is not None:
+                self.first_byte.append(first_byte)
+            if ok and total is not None:
+                self.total.append(total)
+            self.outcomes.append(ok)
+
+    def record_hedge(self):
+        with self._lock:
+            self.hedged += 1
+
+    def record_hedge_win(self):
+        with self._lock:
+            self.hedge_wins += 1
+
+    def error_rate(self):
+        with self._lock:
+            if not self.outcomes:
+                return 0.0
+            return 1.0 - sum(self.outcomes) / float(len(self.outcomes))
+
+    def samples(self):
+        with self._lock:
+            return len(self.outcomes)
+
+    def first_byte_percentile(self, q):
+        with self._lock:
+            return percentile(list(self.first_byte), q)
+
+    def total_percentile(self, q):
+        with self._lock:
+            return percentile(list(self.total), q)
+
+    def snapshot(self):
+        p50 = self.total_percentile(0.5)
+        p99 = self.total_percentile(0.99)
+        fb90 = self.first_byte_percentile(0.9)
+        with self._lock:
+            hedged, hedge_wins = self.hedged, self.hedge_wins
+        return {
+            "samples": self.samples(),
+            "error_rate": round(self.error_rate(), 3),
+            "first_byte_p90": round(fb90, 3) if fb90 is not None else None,
+            "total_p50": round(p50, 3) if p50 is not None else None,
+            "total_p99": round(p99, 3) if p99 is not None else None,
+            "hedged": hedged,
+            "hedge_wins": hedge_wins
+        }
+
+class ProviderRouter(object):
+    """按延迟和错误率对上游服务排序，并对慢请求发出对冲请求
+
+    providers是有序字典：服务名 → fn(prompt, ctx)，成功返回文本，失败抛出异常。
+    排在前面的是默认主服务；不可用或样本足够后错误率过高的服务会被排到后面。
+    neutral_errors中的异常（如本地限流、截止时间已到）不是服务本身的问题，不计入延迟和错误率。
+    """
+
+    def __init__(self, providers, hedge_percentile=0.9, default_hedge_delay=20.0,
+                 min_samples=5, max_error_rate=0.5, workers=8, available=None, neutral_errors=()):
+        self.providers = providers
+        self.available = available  # available(name)为False的服务（如熔断中）视为不健康
+        self.neutral_errors = tuple(neutral_errors)
+        self.hedge_percentile = hedge_percentile
+        self.default_hedge_delay = default_hedge_delay
+        self.min_samples = min_samples
+        self.max_error_rate = max_error_rate
+        self.stats = dict((name, ProviderStats()) for name in providers)
+        self.route_stats = {}  # 模型路由名 → ProviderStats
+        self._route_lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="provider")
+
+    def healthy(self, name):
+        if self.available is not None and not self.available(name):
+            return False
+        stats = self.stats[name]
+        return stats.samples() < self.min_samples or stats.error_rate() <= self.max_error_rate
+
+    def rank(self):
+        """健康的服务在前；同为健康时，有足够样本的按P50总延迟排序，否则保持配置顺序"""
+        order = list(self.providers)
+
+        def key(name):
+            stats = self.stats[name]
+            p50 = stats.total_percentile(0.5) if stats.samples() >= self.min_samples else None
+            return (0 if self.healthy(name) else 1, p50 if p50 is not None else float('inf'), order.index(name))
+
+        return sorted(order, key=key)
+
+    def hedge_delay(self, name):
+        """主服务等待多久还没有首字节就发出对冲请求"""
+        stats = self.stats[name]
+        if stats.samples() < self.min_samples:
+            return self.default_hedge_delay
+        value = stats.first_byte_percentile(self.hedge_percentile)
+        return value if value is not None else self.default_hedge_delay
+
+    def _run(self, name, prompt, ctx):
+        try:
+            result = self.providers[name](prompt, ctx)
+        except CallCancelled:
+            raise
+        except Exception as e:
+            if not ctx.cancelled and not isinstance(e, self.neutral_errors):
+                self._record(name, ctx, False)
+            raise
+        self._record(name, ctx, True)
+        return result
+
+    def _record(self, name, ctx, ok):
+        first_byte = ctx.first_byte_at - ctx.started if ctx.first_byte_at is not None else None
+        total = time.monotonic() - ctx.started
+        if ctx.max_tokens is not None:
+            # 输出长度不同的调用延迟不可比，只计成败，不影响排序、对冲阈值和路由的SLO判断
+            if ctx.route is not None:
+                self.record_route(ctx.route.name, None, None, ok)
+            self.stats[name].record(None, None, ok)
+            return
+        if ctx.route is not None:
+            self.record_route(ctx.route.name, first_byte, total, ok)
+        self.stats[name].record(first_byte, total, ok)
+
+    def stats_for_route(self, route_name):
+        with self._route_lock:
+            if route_name not in self.route_stats:
+                self.route_stats[route_name] = ProviderStats()
+            return self.route_stats[route_name]
+
+    def record_route(self, route_name, first_byte, total, ok):
+        """记录一次模型路由调用的首字节时间和总耗时（流式调用由调用方直接上报）"""
+        self.stats_for_route(route_name).record(first_byte, total, ok)
+
+    def call(self, prompt, deadline=None, priority=None, hedge=True, max_tokens=None, route=None):
+        """调用上游并返回最先成功的结果；deadline到期时取消所有调用并抛出DeadlineExceeded
+
+        hedge为False时（如后台任务）不发对冲请求，只在主服务失败后才改用备用服务。
+        max_tokens用于输出较长的调用（如合并生成多个部分）。
+        route为ModelRoute时按其模型和参数调用，并按路由统计延迟。
+        """
+        ranked = self.rank()
+        primary = ranked[0]
+        secondary = next((name for name in ranked[1:] if self.healthy(name)), None)
+
+        calls = {}
+        primary_ctx = CallContext(deadline, priority, max_tokens, route)
+        calls[self._executor.submit(self._run, primary, prompt, primary_ctx)] = (primary, primary_ctx)
+
+        # 在对冲阈值内等待主服务的首字节；主服务先失败也立即改用备用服务
+        if secondary is not None:
+            future = next(iter(calls))
+            if hedge:
+                delay = self.hedge_delay(primary)
+                if deadline is not None:
+                    delay = deadline.cap(delay)
+                hedge_at = time.monotonic() + delay
+                while not primary_ctx.first_byte_event.is_set() and not future.done():
+                    remaining = hedge_at - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    primary_ctx.first_byte_event.wait(min(remaining, 0.2))
+                fallback = not primary_ctx.first_byte_event.is_set() or (future.done() and future.exception() is not None)
+            else:
+                # 不对冲时等主服务结束，失败了再改用备用服务
+                wait([future], timeout=deadline.remaining() if deadline is not None else None)
+                fallback = future.done() and future.exception() is not None
+            if fallback and (deadline is None or not deadline.expired()):
+                if hedge:
+                    logger.info(f"{primary}在{delay:.1f}秒内无首字节或已失败，向{secondary}发出对冲请求")
+                    self.stats[secondary].record_hedge()
+                else:
+                    logger.info(f"{primary}调用失败，改用{secondary}")
+                secondary_ctx = CallContext(deadline, priority, max_tokens, route)
+                calls[self._executor.submit(self._run, secondary, prompt, secondary_ctx)] = (secondary, secondary_ctx)
+
+        # 取最先成功的结果，取消其余调用
+        pending = set(calls)
+        last_error = None
+        while pending:
+            timeout = deadline.remaining() if deadline is not None else None
+            done, pending = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            if not done:
+                for future in pending:
+                    calls[future][1].cancel()
+                deadline.check()
+            for future in done:
+                name, ctx = calls[future]
+                try:
+                    result = future.result()
+                except Exception as e:
+                    last_error = e
+                    logger.warning(f"上游服务{name}调用失败: {e}")
+                    continue
+                for other in pending:
+                    calls[other][1].cancel()
+                if name != primary and hedge:
+                    self.stats[name].record_hedge_win()
+                return result
+        raise last_error
+
+    def snapshot(self):
+        return dict((name, stats.snapshot()) for name, stats in self.stats.items())
+
+class ModelRoute(object):
+    """一条模型路由：模型名和生成参数"""
+
+    def __init__(self, name, model, max_tokens, temperature):
+        self.name = name
+        self.model = model
+        self.max_tokens = max_tokens
+        self.temperature = temperature
+
+    def describe(self):
+        return {"model": self.model, "max_tokens": self.max_tokens, "temperature": self.temperature}
+
+class SectionRoute(object):
+    """一个报告部分的路由配置：主路由、备用路由和延迟SLO（秒，为None时不检查）"""
+
+    def __init__(self, primary, fallback=None, slo_seconds=None, ttft_slo_seconds=None):
+        self.primary = primary
+        self.fallback = fallback
+        self.slo_seconds = slo_seconds
+        self.ttft_slo_seconds = ttft_slo_seconds
+        self.degraded_calls = 0
+        self.fallback_calls = 0
+
+class SectionRouter(object):
+    """按延迟SLO为各报告部分选择模型路由
+
+    主路由最近调用的总耗时或首字节时间的slo_percentile分位数超出SLO时，改用备用路由（更快或更小的模型）；
+    改用期间每probe_every次仍走一次主路由，主路由恢复达标后自动切回。
+    延迟数据来自ProviderRouter按路由统计的滚动窗口。
+    """
+
+    def __init__(self, routes, provider_router, min_samples=5, slo_percentile=0.9, probe_every=10):
+        self.routes = routes
+        self.provider_router = provider_router
+        self.min_samples = min_samples
+        self.slo_percentile = slo_percentile
+        self.probe_every = probe_every
+        self._lock = threading.Lock()
+
+    def breaching(self, section):
+        """主路由是否在持续超出SLO"""
+        route = self.routes[section]
+        stats = self.provider_router.stats_for_route(route.primary.name)
+        if stats.samples() < self.min_samples:
+            return False
+        total = stats.total_percentile(self.slo_percentile)
+        first_byte = stats.first_byte_percentile(self.slo_percentile)
+        if route.slo_seconds is not None and total is not None and total > route.slo_seconds:
+            return True
+        if route.ttft_slo_seconds is not None and first_byte is not None and first_byte > route.ttft_slo_seconds:
+            return True
+        return False
+
+    def choose(self, section):
+        route = self.routes[section]
+        if route.fallback is None or not self.breaching(section):
+            return route.primary
+        with self._lock:
+            route.degraded_calls += 1
+            if route.degraded_calls % self.probe_every == 0:
+                return route.primary
+            route.fallback_calls += 1
+        return route.fallback
+
+    def models(self, section):
+        """该部分可能用到的模型，主路由在前"""
+        route = self.routes[section]
+        models = [route.primary.model]
+        if route.fallback is not None and route.fallback.model not in models:
+            models.append(route.fallback.model)
+        return models
+
+    def snapshot(self):
+        result = {}
+        for section, route in self.routes.items():
+            entry = {
+                "slo_seconds": route.slo_seconds,
+                "ttft_slo_seconds": route.ttft_slo_seconds,
+                "breaching": self.breaching(section),
+                "fallback_calls": route.fallback_calls,
+                "primary": dict(route.primary.describe(), **self.provider_router.stats_for_route(route.primary.name).snapshot())
+            }
+            if route.fallback is not None:
+                entry["fallback"] = dict(route.fallback.describe(), **self.provider_router.stats_for_route(route.fallback.name).snapshot())
+            result[section] = entry
+        return result
@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# 相同报告生成请求的合并：同一时刻每个(八字, 部分)只有一次上游生成在进行
+#
+# 进程内用SingleFlight让等待者共享领头调用的结果；
+# 跨gunicorn worker用SQLite租约表保证只有一个worker在生成，其余worker轮询缓存取结果。
+
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+
+from db import get_connection
+
+logger = logging.getLogger(__name__)
+
+class _Call(object):
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+class SingleFlight(object):
+    """进程内请求合并：同一键同时只执行一次fn，其余调用等待并共享结果或异常
+
+    等待者可以给出timeout，超时后抛出TimeoutError，领头调用不受影响。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.coalesced = 0
+
+    def do(self, key, fn, timeout=None):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            if not call.event.wait(timeout):
+                raise TimeoutError("等待相同请求的结果超时")
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+
+HOSTNAME = socket.gethostname()
+
+def make_owner():
+    """租约持有者标识：主机名:进程号:随机串，用于识别已退出进程留下的租约"""
+    return f"{HOSTNAME}:{os.getpid()}:{uuid.uuid4().hex}"
+
+def owner_alive(owner):
+    """持有者进程是否还在；其他主机或无法判断时视为存活"""
+    parts = owner.split(":")
+    if len(parts) != 3 or parts[0] != HOSTNAME:
+        return True
+    try:
+        os.kill(int(parts[1]), 0)
+    except ProcessLookupError:
+        return False
+    except (PermissionError, ValueError):
+        return True
+    return True
+
+class LeaseTable(object):
+    """基于SQLite的跨进程租约
+
+    持有者崩溃时，租约到期后自动失效；同一主机上持有者进程已退出的租约可以立即接手。
+    """
+
+    def __init__(self, path, ttl=200):
+        self.path = path
+        self.ttl = ttl
+        get_connection(path).execute("""
+            CREATE TABLE IF NOT EXISTS leases (
+                key TEXT PRIMARY KEY,
+                owner TEXT NOT NULL,
+                expires_at REAL NOT NULL
+            )
+        """)
+
+    def acquire(self, key, owner):
+        """尝试获取租约，成功返回True；其他持有者的租约未过期时返回False"""
+        conn = get_connection(self.path)
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT owner, expires_at FROM leases WHERE key = ?", (key,)).fetchone()
+            if row is not None and row[0] != owner and row[1] > now:
+                if owner_alive(row[0]):
+                    conn.execute("ROLLBACK")
+                    return False
+                logger.info(f"租约持有者进程已退出，接手生成: {key[:12]}")
+            conn.execute(
+                "INSERT OR REPLACE INTO leases (key, owner, expires_at) VALUES (?, ?, ?)",
+                (key, owner, now + self.ttl)
+            )
+            conn.execute("COMMIT")
+            return True
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def release(self, key, owner):
+        get_connection(self.path).execute("DELETE FROM leases WHERE key = ? AND owner = ?", (key, owner))
+
+class Coalescer(object):
+    """进程内与跨进程两级合并
+
+    run(key, lookup, generate, timeout)：lookup读取已有结果（如缓存），generate执行真正的生成并写入缓存，
+    timeout限制本次调用等待其他请求结果的时间。
+    其他worker持有租约时，本worker每隔poll_interval秒查一次lookup，
+    直到结果出现；对方失败或崩溃导致租约释放/过期后，由本worker接手生成。
+    """
+
+    def __init__(self, leases, poll_interval=0.5, wait_timeout=240):
+        self.leases = leases
+        self.poll_interval = poll_interval
+        self.wait_timeout = wait_timeout
+        self.flight = SingleFlight()
+        self.waited_on_peer = 0
+
+    def run(self, key, lookup, generate, timeout=None):
+        wait_timeout = self.wait_timeout if timeout is None else min(timeout, self.wait_timeout)
+        return self.flight.do(key, lambda: self._run_across_workers(key, lookup, generate, wait_timeout), timeout)
+
+    def _run_across_workers(self, key, lookup, generate, wait_timeout):
+        owner = make_owner()
+        started = time.time()
+        waiting = False
+
+        while True:
+            result = lookup()
+            if result is not None:
+                return result
+
+            try:
+                acquired = self.leases.acquire(key, owner)
+            except Exception as e:
+                # 租约表不可用时退化为仅进程内合并
+                logger.error(f"获取生成租约出错: {e}")
+                return generate()
+
+            if acquired:
+                try:
+                    return generate()
+                finally:
+                    self.leases.release(key, owner)
+
+            if not waiting:
+                waiting = True
+                self.waited_on_peer += 1
+                logger.info(f"其他worker正在生成相同内容，等待其结果: {key[:12]}")
+            if time.time() - started > wait_timeout:
+                raise TimeoutError("等待其他worker生成报告超时")
+            time.sleep(self.poll_interval)
@@ -11,6 +11,7 @@ document.addEventListener('DOMContentLoaded', function() {
     const reportSection = document.getElementById('reportSection');
     const reportContent = document.getElementById('reportContent');
     const baziInfoEl = document.getElementById('baziInfo');
+    const loadingStatus = document.getElementById('loadingStatus');
     
     // 报告内容区域元素
     const overviewReport = document.getElementById('overviewReport');
@@ -39,16 +40,495 @@ document.addEventListener('DOMContentLoaded', function() {
         const month = document.getElementById('month').value;
         const day = document.getElementById('day').value;
         const shichen = document.getElementById('shichen').value;
+        currentBirth = { year: year, month: month, day: day, shichen: shichen };
         
         // 显示加载动画，隐藏其他区域
+        loadingStatus.textContent = '这可能需要几分钟时间，请耐心等待';
         loadingSection.classList.remove('d-none');
         reportSection.classList.add('d-none');
         generateBtn.disabled = true;
         
-        // 调用API生成报告
-        generateReport(year, month, day, shichen);
+        // 先取本地规则生成的即时预览，再提交后台任务并轮询进度；任务接口不可用时回退到流式或一次性接口
+        loadPreview(currentBirth);
+        submitReportJob(year, month, day, shichen);
     });
     
+    // 轮询任务进度的间隔（毫秒）
+    const JOB_POLL_INTERVAL = 1500;
+    
+    /**
+     * 提交报告生成任务，然后轮询任务进度
+     * @param {string} year - 年份
+     * @param {string} month - 月份
+     * @param {string} day - 日期
+     * @param {string} shichen - 时辰
+     */
+    function submitReportJob(year, month, day, shichen) {
+        const requestData = {
+            year: year,
+            month: month,
+            day: day,
+            shichen: shichen
+        };
+        
+        // 支持IntersectionObserver时使用按需生成：先只生成概览，其余部分浏览到时再生成
+        resetLazySections();
+        if (lazyObserver) {
+            lazyBirth = Object.assign({}, requestData);
+            requestData.lazy = true;
+        }
+        
+        fetch('/reports', {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json'
+            },
+            body: JSON.stringify(requestData)
+        })
+        .then(response => {
+            // 提交过多被限流时直接提示，不再改用其他接口重复提交
+            if (response.status === 429) {
+                return response.json().then(data => {
+                    alert(data.error || '提交的报告请求过多，请稍后再试');
+                    generateBtn.disabled = false;
+                    loadingSection.classList.add('d-none');
+                    return null;
+                });
+            }
+            if (!response.ok) {
+                throw new Error('网络错误：' + response.statusText);
+            }
+            return response.json();
+        })
+        .then(job => {
+            if (job) {
+                pollReportJob(job.id, false);
+            }
+        })
+        .catch(error => {
+            console.error('提交报告任务出错，改用直接生成:', error);
+            // 回退接口一次生成全部部分
+            resetLazySections();
+            // 浏览器支持流式读取时使用SSE接口，边生成边显示；否则回退到一次性接口
+            if (window.ReadableStream && window.TextDecoder) {
+                streamReport(year, month, day, shichen);
+            } else {
+                generateReport(year, month, day, shichen);
+            }
+        });
+    }
+    
+    /**
+     * 轮询任务状态，逐步显示命盘和已完成的报告部分
+     * @param {string} jobId - 任务ID
+     * @param {boolean} shown - 报告区域是否已经显示
+     */
+    function pollReportJob(jobId, shown) {
+        fetch('/reports/' + encodeURIComponent(jobId))
+        .then(response => {
+            if (!response.ok) {
+                throw new Error('网络错误：' + response.statusText);
+            }
+            return response.json();
+        })
+        .then(job => {
+            // 排队中时显示前面还有多少个任务
+            if (job.status === 'queued') {
+                loadingStatus.textContent = job.queue_position > 0
+                    ? `正在排队，前面还有 ${job.queue_position} 位用户，请耐心等待`
+                    : '即将开始生成，请耐心等待';
+            } else if (job.status === 'running') {
+                loadingStatus.textContent = '正在生成报告，这可能需要几分钟时间';
+            }
+            
+            // 命盘算出后先显示八字表格，报告部分完成一个显示一个
+            if (job.bazi_info && !shown) {
+                shown = true;
+                loadingSection.classList.add('d-none');
+                Object.keys(sectionElements).forEach(section => {
+                    showPending(section, '正在生成，请稍候……');
+                });
+                if (lazyBirth) {
+                    LAZY_SECTIONS.forEach(section => {
+                        showPending(section, '浏览到此处时开始生成……');
+                        lazyObserver.observe(sectionElements[section]);
+                    });
+                }
+                showBaziInfo(job.bazi_info);
+                reportSection.scrollIntoView({ behavior: 'smooth' });
+            }
+            Object.entries(job.sections || {}).forEach(([section, content]) => {
+                if (!sectionElements[section]) return;
+                if ((job.failed_sections || []).includes(section)) {
+                    showSectionError(section, content, () => regenerateSection(section));
+                } else if ((job.fallback_sections || []).includes(section)) {
+                    showFallbackSection(section, content, () => regenerateSection(section));
+                } else {
+                    sectionElements[section].innerHTML = formatReportContent(content);
+                }
+            });
+            
+            if (job.status === 'done' || job.status === 'failed') {
+                if (job.status === 'failed') {
+                    alert('生成报告时出现错误：' + (job.error || '未知错误'));
+                }
+                generateBtn.disabled = false;
+                loadingSection.classList.add('d-none');
+                return;
+            }
+            setTimeout(() => pollReportJob(jobId, shown), JOB_POLL_INTERVAL);
+        })
+        .catch(error => {
+            console.error('查询任务进度出错:', error);
+            alert('查询报告进度时出现错误：' + error.message);
+            generateBtn.disabled = false;
+            loadingSection.classList.add('d-none');
+        });
+    }
+    
+    // 报告部分名称与页面元素的对应关系
+    const sectionElements = {
+        overview: overviewReport,
+        ten_gods: tenGodsReport,
+        action_guide: actionGuideReport
+    };
+    
+    // 按需生成的部分：只看概览就离开的用户不会为这些部分产生上游调用
+    const LAZY_SECTIONS = ['ten_gods', 'action_guide'];
+    // 当前报告的出生信息，重新生成单个部分时使用
+    let currentBirth = null;
+    // 当前按需生成报告的出生信息，为null时表示本次报告一次生成全部部分
+    let lazyBirth = null;
+    // 本地规则生成的即时预览，AI报告的各部分完成前先显示预览
+    let previewReports = null;
+    // 部分进入视口（提前200像素）时开始生成
+    const lazyObserver = ('IntersectionObserver' in window) ? new IntersectionObserver(entries => {
+        entries.forEach(entry => {
+            if (!entry.isIntersecting) return;
+            lazyObserver.unobserve(entry.target);
+            const section = Object.keys(sectionElements).find(name => sectionElements[name] === entry.target);
+            loadLazySection(section);
+        });
+    }, { rootMargin: '200px' }) : null;
+    
+    // 开始新报告时停止观察上一份报告的部分
+    function resetLazySections() {
+        lazyBirth = null;
+        if (lazyObserver) {
+            lazyObserver.disconnect();
+        }
+    }
+    
+    /**
+     * 获取本地规则生成的即时预览；AI报告尚未开始显示时，先显示命盘和预览
+     * @param {Object} birth - 出生信息
+     */
+    function loadPreview(birth) {
+        previewReports = null;
+        fetch('/generate_report/preview', {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json'
+            },
+            body: JSON.stringify(birth)
+        })
+        .then(response => response.ok ? response.json() : null)
+        .then(data => {
+            // 期间用户已提交了新的报告，丢弃旧结果
+            if (!data || birth !== currentBirth) return;
+            previewReports = data.reports;
+            if (reportSection.classList.contains('d-none')) {
+                Object.keys(sectionElements).forEach(section => {
+                    showPending(section, 'AI详细解读正在生成，请稍候……');
+                });
+                showBaziInfo(data.bazi_info);
+            }
+        })
+        .catch(error => {
+            console.error('获取即时预览出错:', error);
+        });
+    }
+    
+    /**
+     * 显示等待中的报告部分：提示文字，有预览时接着显示预览内容
+     * @param {string} section - 报告部分名称
+     * @param {string} message - 提示文字
+     */
+    function showPending(section, message) {
+        const el = sectionElements[section];
+        const preview = previewReports && previewReports[section];
+        el.innerHTML = '<p class="text-muted"></p>' + (preview ? formatReportContent(preview) : '');
+        el.querySelector('p').textContent = message;
+    }
+    
+    /**
+     * 请求生成单个报告部分：已缓存时立即显示，否则轮询服务端返回的任务
+     * @param {string} section - 报告部分名称
+     */
+    function loadLazySection(section) {
+        const birth = lazyBirth;
+        if (!birth) return;
+        showPending(section, '正在生成，请稍候……');
+        const isCurrent = () => birth === lazyBirth;
+        const retry = () => loadLazySection(section);
+        
+        fetch('/generate_report/section', {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json'
+            },
+            body: JSON.stringify(Object.assign({ section: section }, birth))
+        })
+        .then(response => response.json().then(data => ({ status: response.status, ok: response.ok, location: response.headers.get('Location'), data: data })))
+        .then(({ status, ok, location, data }) => {
+            // 期间用户已提交了新的报告，丢弃旧结果
+            if (!isCurrent()) return;
+            if (status === 202) {
+                pollSectionJob(location || '/reports/' + encodeURIComponent(data.id), section, isCurrent, retry);
+                return;
+            }
+            if (ok && data.fallback) {
+                showFallbackSection(section, data.content, retry);
+                return;
+            }
+            if (ok) {
+                sectionElements[section].innerHTML = formatReportContent(data.content);
+                return;
+            }
+            showSectionError(section, data.error || `生成${section}报告时发生错误，请稍后再试。`, retry);
+        })
+        .catch(error => {
+            console.error('按需生成报告部分出错:', error);
+            if (isCurrent()) {
+                showSectionError(section, '网络错误，请稍后再试。', retry);
+            }
+        });
+    }
+    
+    /**
+     * 轮询只生成一个部分的任务，完成后显示该部分
+     * @param {string} location - 任务地址
+     * @param {string} section - 报告部分名称
+     * @param {Function} isCurrent - 结果是否仍属于当前报告
+     * @param {Function} retry - 失败时的重试操作
+     */
+    function pollSectionJob(location, section, isCurrent, retry) {
+        fetch(location)
+        .then(response => {
+            if (!response.ok) {
+                throw new Error('网络错误：' + response.statusText);
+            }
+            return response.json();
+        })
+        .then(job => {
+            if (!isCurrent()) return;
+            if (job.status !== 'done' && job.status !== 'failed') {
+                setTimeout(() => pollSectionJob(location, section, isCurrent, retry), JOB_POLL_INTERVAL);
+                return;
+            }
+            const content = (job.sections || {})[section];
+            if (content === undefined || (job.failed_sections || []).includes(section)) {
+                showSectionError(section, content || job.error || `生成${section}报告时发生错误，请稍后再试。`, retry);
+            } else if ((job.fallback_sections || []).includes(section)) {
+                showFallbackSection(section, content, retry);
+            } else {
+                sectionElements[section].innerHTML = formatReportContent(content);
+            }
+        })
+        .catch(error => {
+            console.error('查询报告部分进度出错:', error);
+            if (isCurrent()) {
+                showSectionError(section, '网络错误，请稍后再试。', retry);
+            }
+        });
+    }
+    
+    /**
+     * 显示报告部分的错误提示和"重新生成"按钮
+     * @param {string} section - 报告部分名称
+     * @param {string} message - 错误提示
+     * @param {Function} retry - 点击按钮时的重试操作
+     */
+    function showSectionError(section, message, retry) {
+        const el = sectionElements[section];
+        el.innerHTML = '<p class="text-muted"></p><button type="button" class="btn btn-outline-primary btn-sm">重新生成</button>';
+        el.querySelector('p').textContent = message;
+        el.querySelector('button').addEventListener('click', retry);
+    }
+    
+    /**
+     * 显示上游超时或熔断时的本地简版报告，以及生成AI解读的按钮
+     * @param {string} section - 报告部分名称
+     * @param {string} content - 简版报告内容
+     * @param {Function} retry - 点击按钮时的重试操作
+     */
+    function showFallbackSection(section, content, retry) {
+        const el = sectionElements[section];
+        el.innerHTML = formatReportContent(content) + '<button type="button" class="btn btn-outline-primary btn-sm">重新生成AI解读</button>';
+        el.querySelector('button').addEventListener('click', retry);
+    }
+    
+    /**
+     * 只重新生成失败的一个部分，其余部分保持不变（服务端从缓存取出，不再调用上游）
+     * @param {string} section - 报告部分名称
+     */
+    function regenerateSection(section) {
+        const birth = currentBirth;
+        if (!birth) return;
+        const el = sectionElements[section];
+        el.innerHTML = '<p class="text-muted">正在重新生成，请稍候……</p>';
+        const isCurrent = () => birth === currentBirth;
+        const retry = () => regenerateSection(section);
+        
+        fetch('/generate_report/regenerate', {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json'
+            },
+            body: JSON.stringify(Object.assign({ section: section }, birth))
+        })
+        .then(response => response.json().then(data => ({ status: response.status, ok: response.ok, location: response.headers.get('Location'), data: data })))
+        .then(({ status, ok, location, data }) => {
+            // 期间用户已提交了新的报告，丢弃旧结果
+            if (!isCurrent()) return;
+            if (status === 202) {
+                pollSectionJob(location || '/reports/' + encodeURIComponent(data.id), section, isCurrent, retry);
+                return;
+            }
+            if (!ok || data.failed.includes(section)) {
+                const message = ok ? data.reports[section] : (data.error || '重新生成失败，请稍后再试。');
+                showSectionError(section, message, retry);
+                return;
+            }
+            if (data.fallback.includes(section)) {
+                showFallbackSection(section, data.reports[section], retry);
+                return;
+            }
+            el.innerHTML = formatReportContent(data.reports[section]);
+        })
+        .catch(error => {
+            console.error('重新生成报告部分出错:', error);
+            if (isCurrent()) {
+                showSectionError(section, '网络错误，请稍后再试。', retry);
+            }
+        });
+    }
+    
+    /**
+     * 通过SSE流式接口生成报告，逐段显示生成中的内容
+     * @param {string} year - 年份
+     * @param {string} month - 月份
+     * @param {string} day - 日期
+     * @param {string} shichen - 时辰
+     */
+    function streamReport(year, month, day, shichen) {
+        const requestData = {
+            year: year,
+            month: month,
+            day: day,
+            shichen: shichen
+        };
+        
+        // 各部分已收到的文本
+        const buffers = {overview: '', ten_gods: '', action_guide: ''};
+        // 等待重绘的部分，合并到下一帧统一渲染，避免每个增量都重排页面
+        const dirtySections = new Set();
+        let renderScheduled = false;
+        
+        function scheduleRender(section) {
+            dirtySections.add(section);
+            if (renderScheduled) return;
+            renderScheduled = true;
+            requestAnimationFrame(() => {
+                renderScheduled = false;
+                dirtySections.forEach(name => {
+                    sectionElements[name].innerHTML = formatReportContent(buffers[name]);
+                });
+                dirtySections.clear();
+            });
+        }
+        
+        // 处理单个SSE事件
+        function handleEvent(event, data) {
+            if (event === 'bazi') {
+                loadingSection.classList.add('d-none');
+                Object.keys(sectionElements).forEach(section => {
+                    showPending(section, '正在生成，请稍候……');
+                });
+                showBaziInfo(data);
+                reportSection.scrollIntoView({ behavior: 'smooth' });
+            } else if (event === 'delta') {
+                buffers[data.section] += data.text;
+                scheduleRender(data.section);
+            } else if (event === 'section_done' && data.fallback) {
+                buffers[data.section] = data.content;
+                dirtySections.delete(data.section);
+                showFallbackSection(data.section, data.content, () => regenerateSection(data.section));
+            } else if (event === 'section_done') {
+                buffers[data.section] = data.content;
+                scheduleRender(data.section);
+            } else if (event === 'section_error') {
+                buffers[data.section] = data.error;
+                dirtySections.delete(data.section);
+                showSectionError(data.section, data.error, () => regenerateSection(data.section));
+            }
+        }
+        
+        fetch('/generate_report/stream', {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json',
+                'Accept': 'text/event-stream'
+            },
+            body: JSON.stringify(requestData)
+        })
+        .then(async response => {
+            if (!response.ok || !response.body) {
+                throw new Error('网络错误：' + response.statusText);
+            }
+            
+            const reader = response.body.getReader();
+            const decoder = new TextDecoder('utf-8');
+            let pending = '';
+            
+            while (true) {
+                const { done, value } = await reader.read();
+                if (done) break;
+                // stream模式解码，保证被切开的多字节汉字能正确拼接
+                pending += decoder.decode(value, { stream: true });
+                
+                // SSE事件之间以空行分隔
+                let boundary;
+                while ((boundary = pending.indexOf('\n\n')) !== -1) {
+                    const rawEvent = pending.slice(0, boundary);
+                    pending = pending.slice(boundary + 2);
+                    
+                    let event = 'message';
+                    const dataLines = [];
+                    rawEvent.split('\n').forEach(line => {
+                        if (line.startsWith('event:')) {
+                            event = line.slice(6).trim();
+                        } else if (line.startsWith('data:')) {
+                            dataLines.push(line.slice(5).trim());
+                        }
+                    });
+                    // 注释行（心跳）没有data，直接忽略
+                    if (dataLines.length > 0) {
+                        handleEvent(event, JSON.parse(dataLines.join('\n')));
+                    }
+                }
+            }
+        })
+        .catch(error => {
+            console.error('生成报告出错:', error);
+            alert('生成报告时出现错误：' + error.message);
+        })
+        .finally(() => {
+            generateBtn.disabled = false;
+            loadingSection.classList.add('d-none');
+        });
+    }
+    
     /**
      * 调用后端API生成报告
      * @param {string} year - 年份
@@ -77,19 +557,22 @@ document.addEventListener('DOMContentLoaded', function() {
             if (!response.ok) {
                 throw new Error('网络错误：' + response.statusText);
             }
-            return response.json();
+            return response.json().then(data => ({ accepted: response.status === 202, data: data }));
         })
-        .then(data => {
-            // 处理成功响应
+        .then(({ accepted, data }) => {
+            // 未全部缓存时接口返回202和任务，改为轮询任务进度，由轮询结束时恢复按钮
+            if (accepted) {
+                pollReportJob(data.id, false);
+                return;
+            }
             displayReport(data);
+            generateBtn.disabled = false;
+            loadingSection.classList.add('d-none');
         })
         .catch(error => {
             // 处理错误
             console.error('生成报告出错:', error);
             alert('生成报告时出现错误：' + error.message);
-        })
-        .finally(() => {
-            // 无论成功或失败，都重新启用按钮
             generateBtn.disabled = false;
             loadingSection.classList.add('d-none');
         });
@@ -106,23 +589,34 @@ document.addEventListener('DOMContentLoaded', function() {
             return;
         }
         
-        // 显示报告部分
-        reportSection.classList.remove('d-none');
+        // 显示报告部分和八字信息
+        showBaziInfo(data.bazi_info);
+        
+        // 填充报告内容，失败的部分显示"重新生成"按钮
+        Object.entries(sectionElements).forEach(([section, el]) => {
+            if ((data.failed || []).includes(section)) {
+                showSectionError(section, data.reports[section], () => regenerateSection(section));
+            } else if ((data.fallback || []).includes(section)) {
+                showFallbackSection(section, data.reports[section], () => regenerateSection(section));
+            } else {
+                el.innerHTML = formatReportContent(data.reports[section]);
+            }
+        });
         
-        // 显示八字信息
-        const baziInfo = data.bazi_info;
+        // 滚动到报告部分
+        reportSection.scrollIntoView({ behavior: 'smooth' });
+    }
+    
+    /**
+     * 显示报告区域并填充八字信息
+     * @param {Object} baziInfo - 八字信息数据
+     */
+    function showBaziInfo(baziInfo) {
+        reportSection.classList.remove('d-none');
         baziInfoEl.textContent = `阳历：${baziInfo.solar_date} | 阴历：${baziInfo.lunar_date} | 八字：${baziInfo.bazi}`;
         
         // 填充八字信息可视化表格
         fillBaziChart(baziInfo);
-        
-        // 填充报告内容
-        overviewReport.innerHTML = formatReportContent(data.reports.overview);
-        tenGodsReport.innerHTML = formatReportContent(data.reports.ten_gods);
-        actionGuideReport.innerHTML = formatReportContent(data.reports.action_guide);
-        
-        // 滚动到报告部分
-        reportSection.scrollIntoView({ behavior: 'smooth' });
     }
     
     /**
@@ -244,6 +738,17 @@ document.addEventListener('DOMContentLoaded', function() {
                 continue;
             }
             
+            // 处理引用（如简版报告开头的说明）
+            if (line.match(/^>\s?/)) {
+                if (inList) {
+                    processedLines.push(listType === 'ul' ? '</ul>' : '</ol>');
+                    inList = false;
+                    listType = null;
+                }
+                processedLines.push(`<blockquote class="text-muted">${formatInlineMarkdown(line.replace(/^>\s?/, ''))}</blockquote>`);
+                continue;
+            }
+            
             // 处理水平线
             if (line.match(/^---+$/) || line.match(/^\*\*\*+$/)) {
                 processedLines.push('<hr>');
@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# 上游HTTP客户端：DeepSeek/Flowith调用共用的连接池
+#
+# 每个gunicorn worker一个客户端，连接保持keep-alive并在线程间复用，
+# 同一主机的后续请求省去DNS、TCP握手和TLS握手。
+# 新建连接的耗时会被记录下来，用于估算连接复用节省的握手时间。
+
+import logging
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+logger = logging.getLogger(__name__)
+
+try:
+    import httpx
+except ImportError:  # HTTP/2模式是可选的，未安装httpx[http2]时只能使用HTTP/1.1连接池
+    httpx = None
+
+class ConnectionStats(object):
+    """统计请求数、新建连接数和建连耗时"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.connections_opened = 0
+        self.connect_seconds = 0.0
+
+    def record_request(self):
+        with self._lock:
+            self.requests += 1
+
+    def record_connect(self, seconds):
+        with self._lock:
+            self.connections_opened += 1
+            self.connect_seconds += seconds
+
+    def snapshot(self):
+        with self._lock:
+            requests_count = self.requests
+            opened = self.connections_opened
+            connect_seconds = self.connect_seconds
+        reused = max(requests_count - opened, 0)
+        avg_connect = connect_seconds / opened if opened else 0.0
+        return {
+            "requests": requests_count,
+            "connections_opened": opened,
+            "connections_reused": reused,
+            "reuse_rate": round(reused / requests_count, 4) if requests_count else 0.0,
+            "avg_connect_ms": round(avg_connect * 1000, 2),
+            # 每次复用连接按平均建连耗时估算节省的DNS+TCP+TLS时间
+            "handshake_seconds_saved": round(reused * avg_connect, 3)
+        }
+
+def _timed_connection_class(base, stats):
+    class TimedConnection(base):
+        def connect(self):
+            started = time.perf_counter()
+            super(TimedConnection, self).connect()
+            stats.record_connect(time.perf_counter() - started)
+    return TimedConnection
+
+class InstrumentedAdapter(HTTPAdapter):
+    """为连接池换上会记录建连耗时的连接类"""
+
+    def __init__(self, stats, **kwargs):
+        self.stats = stats
+        super(InstrumentedAdapter, self).__init__(**kwargs)
+
+    def init_poolmanager(self, connections, maxsize, block=False, **pool_kwargs):
+        super(InstrumentedAdapter, self).init_poolmanager(connections, maxsize, block=block, **pool_kwargs)
+        stats = self.stats
+
+        class TimedHTTPConnectionPool(HTTPConnectionPool):
+            ConnectionCls = _timed_connection_class(HTTPConnection, stats)
+
+        class TimedHTTPSConnectionPool(HTTPSConnectionPool):
+            ConnectionCls = _timed_connection_class(HTTPSConnection, stats)
+
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": TimedHTTPConnectionPool,
+            "https": TimedHTTPSConnectionPool
+        }
+
+class _Http2Response(object):
+    """把httpx的流式响应包装成调用方使用的requests.Response接口"""
+
+    def __init__(self, response):
+        self._response = response
+        self.status_code = response.status_code
+
+    @property
+    def text(self):
+        self._response.read()
+        return self._response.text
+
+    def json(self):
+        self._response.read()
+        return self._response.json()
+
+    def iter_content(self, chunk_size=512):
+        return self._response.iter_bytes(chunk_size)
+
+    def iter_lines(self, decode_unicode=False):
+        for line in self._response.iter_lines():
+            yield line if decode_unicode else line.encode('utf-8')
+
+    def close(self):
+        self._response.close()
+
+class UpstreamClient(object):
+    """线程安全的上游HTTP客户端
+
+    默认使用requests.Session + 连接池（HTTP/1.1 keep-alive）；
+    http2=True且安装了httpx[http2]时，改用单连接多路复用的HTTP/2。
+    """
+
+    def __init__(self, pool_connections=4, pool_maxsize=16, http2=False):
+        self.stats = ConnectionStats()
+        self.http2 = bool(http2 and httpx is not None)
+        if http2 and httpx is None:
+            logger.warning("未安装httpx[http2]，上游客户端使用HTTP/1.1连接池")
+
+        if self.http2:
+            self._client = httpx.Client(
+                http2=True,
+                limits=httpx.Limits(max_connections=pool_maxsize, max_keepalive_connections=pool_maxsize)
+            )
+        else:
+            self._session = requests.Session()
+            adapter = InstrumentedAdapter(
+                self.stats,
+                pool_connections=pool_connections,
+                pool_maxsize=pool_maxsize,
+                max_retries=0  # 重试由调用方控制
+            )
+            self._session.mount("https://", adapter)
+            self._session.mount("http://", adapter)
+
+    def post(self, url, headers=None, json=None, timeout=None, stream=False):
+        self.stats.record_request()
+        if not self.http2:
+            return self._session.post(url, headers=headers, json=json, timeout=timeout, stream=stream)
+
+        # httpx的异常转换为requests的异常，调用方的错误处理保持不变
+        try:
+            request = self._client.build_request("POST", url, headers=headers, json=json, timeout=timeout)
+            return _Http2Response(self._client.send(request, stream=True))
+        except httpx.TimeoutException as e:
+            raise requests.exceptions.Timeout(str(e))
+        except httpx.TransportError as e:
+            raise requests.exceptions.ConnectionError(str(e))
+
+    def snapshot(self):
+        if self.http2:
+            # HTTP/2下所有请求复用少量连接，httpx不暴露建连信息，只统计请求数
+            return {"http2": True, "requests": self.stats.requests}
+        result = self.stats.snapshot()
+        result["http2"] = False
+        return result